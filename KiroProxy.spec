@@ -31,6 +31,7 @@ all_modules = [
     'kiro_proxy.core.browser',
     'kiro_proxy.core.flow_monitor',
     'kiro_proxy.core.usage',
+    'kiro_proxy.core.http_client',
     'kiro_proxy.handlers',
     'kiro_proxy.handlers.anthropic',
     'kiro_proxy.handlers.openai',
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""会话前缀转换缓存基准测试
+
+用法:
+    python benchmarks/bench_conversion_cache.py [--turns 200] [--tool-kb 20]
+
+模拟 Agent 会话：每轮追加 assistant(tool_use) + user(tool_result) 并重发完整对话，
+分别测量关闭缓存（每轮全量转换）和开启缓存（每轮只转换新增消息）时的单轮转换耗时。
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy.converters import (  # noqa: E402
+    convert_anthropic_messages_to_kiro, conversion_cache,
+)
+
+
+def build_session(turns: int, tool_kb: int) -> list:
+    """生成 turns 轮的 Anthropic 对话（每轮一次工具调用，工具结果约 tool_kb KB）"""
+    blob = ("line of tool output " * 52 + "\n") * tool_kb
+    messages = [{"role": "user", "content": "Refactor the project."}]
+    for i in range(turns):
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Step {i}: reading file."},
+            {"type": "tool_use", "id": f"toolu_{i}", "name": "read_file", "input": {"path": f"src/m{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": [{"type": "text", "text": f"{i}\n{blob}"}]},
+        ]})
+    return messages
+
+
+def run(messages: list, turns: int, enabled: bool) -> list:
+    """逐轮转换，返回每轮耗时（毫秒）"""
+    conversion_cache.clear()
+    times = []
+    for turn in range(1, turns + 1):
+        conversation = messages[:1 + 2 * turn]
+        if not enabled:
+            conversion_cache.clear()
+        start = time.perf_counter()
+        convert_anthropic_messages_to_kiro(conversation, "You are a coding agent.")
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="前缀转换缓存基准")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--tool-kb", type=int, default=20)
+    args = parser.parse_args()
+
+    messages = build_session(args.turns, args.tool_kb)
+    print(f"session: {args.turns} turns, ~{args.tool_kb} KB per tool result")
+    cold = run(messages, args.turns, enabled=False)
+    warm = run(messages, args.turns, enabled=True)
+
+    print(f"{'turn':>6} {'no cache ms':>12} {'cache ms':>10}")
+    for turn in sorted({1, 10, 50, 100, args.turns // 2, args.turns}):
+        if 1 <= turn <= args.turns:
+            print(f"{turn:>6} {cold[turn - 1]:>12.2f} {warm[turn - 1]:>10.2f}")
+    print(f"{'total':>6} {sum(cold):>12.1f} {sum(warm):>10.1f}")
+    print(conversion_cache.get_stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""EventStreamDecoder 吞吐量基准测试 (MB/s)
+
+用法:
+    python benchmarks/bench_event_stream.py [--size-mb 8] [--repeat 5]
+
+构造与 Kiro 响应结构相同的 event-stream（文本增量 + 工具调用片段 + 计量事件），
+按不同的网络分块大小喂给解码器，验证跨块帧不丢失并输出吞吐量。
+"""
+import argparse
+import json
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy.providers.event_stream import (  # noqa: E402
+    EventStreamDecoder, ResponseAccumulator, TextDelta, ToolUseDelta,
+)
+
+
+def encode_frame(event_type: str, payload: dict) -> bytes:
+    """编码一帧 AWS event-stream"""
+    headers = b""
+    for name, value in ((":event-type", event_type), (":content-type", "application/json"),
+                        (":message-type", "event")):
+        name_b, value_b = name.encode(), value.encode()
+        headers += bytes([len(name_b)]) + name_b + b"\x07" + struct.pack(">H", len(value_b)) + value_b
+    body = json.dumps(payload).encode()
+    total_len = 12 + len(headers) + len(body) + 4
+    prelude = struct.pack(">II", total_len, len(headers))
+    prelude += struct.pack(">I", zlib.crc32(prelude))
+    message = prelude + headers + body
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+def build_stream(size_mb: float) -> tuple:
+    """生成约 size_mb 大小的响应，返回 (raw, 文本帧数, 工具帧数)"""
+    target = int(size_mb * 1024 * 1024)
+    frames = []
+    size = 0
+    text_frames = tool_frames = 0
+    i = 0
+    while size < target:
+        if i % 10 < 7:
+            frame = encode_frame("assistantResponseEvent", {"content": f"token {i} " * 4})
+            text_frames += 1
+        else:
+            frame = encode_frame("toolUseEvent", {
+                "name": "write_file", "toolUseId": f"tool_{i // 100}",
+                "input": json.dumps({"line": i})[:-1] if i % 2 else "",
+            })
+            tool_frames += 1
+        frames.append(frame)
+        size += len(frame)
+        i += 1
+    frames.append(encode_frame("meteringEvent", {"unit": "credit", "usage": 0.1}))
+    return b"".join(frames), text_frames, tool_frames
+
+
+def run(raw: bytes, chunk_size: int) -> tuple:
+    """按 chunk_size 分块解码，返回 (耗时秒, 文本事件数, 工具事件数)"""
+    decoder = EventStreamDecoder()
+    accumulator = ResponseAccumulator()
+    text_events = tool_events = 0
+    view = memoryview(raw)
+    start = time.perf_counter()
+    for pos in range(0, len(raw), chunk_size):
+        for event in decoder.feed(view[pos:pos + chunk_size]):
+            accumulator.add(event)
+            if isinstance(event, TextDelta):
+                text_events += 1
+            elif isinstance(event, ToolUseDelta):
+                tool_events += 1
+    accumulator.to_result()
+    elapsed = time.perf_counter() - start
+    assert decoder.pending_bytes == 0 and decoder.error is None
+    return elapsed, text_events, tool_events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EventStreamDecoder 吞吐量基准")
+    parser.add_argument("--size-mb", type=float, default=8.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    raw, text_frames, tool_frames = build_stream(args.size_mb)
+    mb = len(raw) / (1024 * 1024)
+    print(f"stream: {mb:.2f} MB, text frames={text_frames}, tool frames={tool_frames}")
+    print(f"{'chunk':>10} {'best MB/s':>10} {'avg MB/s':>10}")
+
+    for chunk_size in (97, 1024, 4096, 16384, 65536, len(raw)):
+        times = []
+        for _ in range(args.repeat):
+            elapsed, text_events, tool_events = run(raw, chunk_size)
+            assert text_events == text_frames, "text frames lost across chunk boundaries"
+            assert tool_events == tool_frames, "tool frames lost across chunk boundaries"
+            times.append(elapsed)
+        label = "whole" if chunk_size == len(raw) else str(chunk_size)
+        print(f"{label:>10} {mb / min(times):>10.1f} {mb / (sum(times) / len(times)):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""历史交替修复基准测试
+
+用法:
+    python benchmarks/bench_history_alternation.py [--sizes 50,200,1000] [--tool-kb 8]
+
+对比旧实现（先 deepcopy 整个历史再修复）和当前的写时复制实现。
+历史中混入连续 user、缺失 toolResults 等需要修复的情况。
+"""
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy.converters import fix_history_alternation  # noqa: E402
+
+
+def build_history(count: int, tool_kb: int) -> list:
+    """生成约 count 条的 Kiro 历史（每轮 assistant 调用工具，user 返回工具结果）"""
+    blob = ("line of tool output " * 52 + "\n") * tool_kb
+    history = []
+    i = 0
+    while len(history) < count:
+        tool_id = f"toolu_{i}"
+        history.append({"userInputMessage": {
+            "content": f"turn {i}",
+            "modelId": "claude-sonnet-4",
+            "origin": "AI_EDITOR",
+            "userInputMessageContext": {"toolResults": [{
+                "toolUseId": f"toolu_{i - 1}",
+                "content": [{"text": blob}],
+                "status": "success",
+            }]} if i else {},
+        }})
+        if i % 25 == 7:
+            # 连续 user：需要合并 toolResults
+            history.append({"userInputMessage": {
+                "content": "extra",
+                "modelId": "claude-sonnet-4",
+                "origin": "AI_EDITOR",
+                "userInputMessageContext": {"toolResults": [{
+                    "toolUseId": f"toolu_{i - 1}_b",
+                    "content": [{"text": "ok"}],
+                    "status": "success",
+                }]},
+            }})
+        history.append({"assistantResponseMessage": {
+            "content": f"step {i}",
+            "toolUses": [{"toolUseId": tool_id, "name": "read_file", "input": {"path": f"src/m{i}.py"}}],
+        }})
+        if i % 25 == 13:
+            # 下一条 user 没有 toolResults：需要去掉 toolUses
+            history.append({"userInputMessage": {"content": "interrupt", "modelId": "claude-sonnet-4", "origin": "AI_EDITOR"}})
+            history.append({"assistantResponseMessage": {"content": "ok"}})
+        i += 1
+    return history[:count]
+
+
+def legacy_fix(history: list) -> list:
+    """旧实现：深拷贝后修复"""
+    return fix_history_alternation(copy.deepcopy(history))
+
+
+def measure(func, history: list, repeat: int) -> float:
+    """返回单次调用的最短耗时（毫秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(history)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史交替修复基准")
+    parser.add_argument("--sizes", default="50,200,1000")
+    parser.add_argument("--tool-kb", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'messages':>9} {'deepcopy ms':>12} {'cow ms':>9} {'speedup':>8}")
+    for size in (int(x) for x in args.sizes.split(",")):
+        history = build_history(size, args.tool_kb)
+        assert legacy_fix(history) == fix_history_alternation(history)
+        old = measure(legacy_fix, history, args.repeat)
+        new = measure(fix_history_alternation, history, args.repeat)
+        print(f"{size:>9} {old:>12.2f} {new:>9.3f} {old / new:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
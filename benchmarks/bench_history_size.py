@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""历史大小统计与截断基准测试
+
+用法:
+    python benchmarks/bench_history_size.py [--sizes 100,1000] [--tool-kb 2]
+
+模拟一次请求在 HistoryManager 中的大小查询：
+should_auto_truncate_summarize -> should_smart_summarize -> estimate_request_chars
+-> truncate_by_chars -> estimate_history_size。
+旧实现每次查询都重新序列化整个历史，截断时逐条序列化并 insert(0)；
+当前实现按消息内容签名缓存长度、前缀和 O(1) 查询、二分截断。
+"cold" 为新会话（消息长度未缓存），"warm" 为后续轮次：和真实请求一样，
+每轮的历史条目是 copy_entry 的新副本，内层对象由转换缓存共享。
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy import jsonfast  # noqa: E402
+from kiro_proxy.converters import copy_entry  # noqa: E402
+from kiro_proxy.core.history_manager import HistoryConfig, HistoryManager, TruncateStrategy, message_sizes  # noqa: E402
+
+from bench_history_alternation import build_history  # noqa: E402
+
+
+def legacy_request(history: list, config: HistoryConfig):
+    """旧实现的同一组查询"""
+    len(jsonfast.dumps(history))                    # should_auto_truncate_summarize
+    len(jsonfast.dumps(history))                    # should_smart_summarize
+    len(jsonfast.dumps(history))                    # estimate_request_chars
+    if len(jsonfast.dumps(history)) > config.max_chars:  # truncate_by_chars
+        result = []
+        current = 0
+        for msg in reversed(history):
+            size = len(jsonfast.dumps(msg))
+            if current + size > config.max_chars and result:
+                break
+            result.insert(0, msg)
+            current += size
+        history = result
+    len(jsonfast.dumps(history))                    # estimate_history_size
+    return history
+
+
+def current_request(history: list, config: HistoryConfig):
+    manager = HistoryManager(config)
+    manager.should_auto_truncate_summarize(history)
+    manager.should_smart_summarize(history)
+    manager.estimate_request_chars(history, "continue")
+    history = manager.truncate_by_chars(history, config.max_chars)
+    manager.estimate_history_size(history)
+    return history
+
+
+def measure(func, history: list, config: HistoryConfig, repeat: int, cold: bool = False) -> float:
+    """返回单次请求的最短耗时（毫秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        if cold:
+            message_sizes.clear()
+        request_history = [copy_entry(msg) for msg in history]
+        start = time.perf_counter()
+        func(request_history, config)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="历史大小统计基准")
+    parser.add_argument("--sizes", default="100,1000")
+    parser.add_argument("--tool-kb", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    config = HistoryConfig(
+        strategies=[TruncateStrategy.AUTO_TRUNCATE, TruncateStrategy.SMART_SUMMARY],
+        max_messages=10 ** 6,
+    )
+    print(f"{'messages':>9} {'KB':>7} {'legacy ms':>10} {'cold ms':>9} {'warm ms':>9} {'speedup':>8}")
+    for size in (int(x) for x in args.sizes.split(",")):
+        history = build_history(size, args.tool_kb)
+        # 截断到约一半
+        config.max_chars = len(jsonfast.dumps(history)) // 2
+        assert legacy_request(history, config) == current_request(history, config)
+        old = measure(legacy_request, history, config, args.repeat)
+        cold = measure(current_request, history, config, args.repeat, cold=True)
+        warm = measure(current_request, history, config, args.repeat)
+        kb = len(jsonfast.dumps(history)) / 1024
+        print(f"{size:>9} {kb:>7.0f} {old:>10.2f} {cold:>9.2f} {warm:>9.3f} {old / warm:>7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
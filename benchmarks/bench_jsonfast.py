@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""JSON 后端基准测试（orjson vs 标准库）
+
+用法:
+    python benchmarks/bench_jsonfast.py [--kb 500] [--repeat 20]
+
+按一个典型 Agent 请求的路径测量单个请求的 JSON CPU 耗时：
+解析请求体 -> 会话 ID -> 历史大小估算 -> 编码上游请求体 -> 解码 event-stream 帧 -> 编码 SSE 事件。
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy import jsonfast  # noqa: E402
+from kiro_proxy.converters import convert_anthropic_messages_to_kiro, conversion_cache  # noqa: E402
+from kiro_proxy.core.history_manager import HistoryManager  # noqa: E402
+from kiro_proxy.core.sse import AnthropicSSE  # noqa: E402
+from kiro_proxy.kiro_api import build_kiro_request, encode_kiro_request  # noqa: E402
+from kiro_proxy.providers.event_stream import EventStreamDecoder  # noqa: E402
+
+from bench_event_stream import encode_frame  # noqa: E402
+
+
+def build_payload(kb: int) -> bytes:
+    """生成约 kb KB 的 Anthropic 请求体（工具调用 + 工具结果，含少量中文）"""
+    chunk = "def handler(request):\n    return process(request)  # 处理请求\n" * 20
+    messages = [{"role": "user", "content": "Refactor the project."}]
+    i = 0
+    while len(json.dumps(messages)) < kb * 1024:
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Reading file {i}."},
+            {"type": "tool_use", "id": f"toolu_{i}", "name": "read_file", "input": {"path": f"src/m{i}.py"}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i}", "content": chunk},
+        ]})
+        i += 1
+    messages.append({"role": "user", "content": "Continue."})
+    tools = [{
+        "name": f"tool_{n}",
+        "description": "Tool description " * 10,
+        "input_schema": {"type": "object", "properties": {"path": {"type": "string"}}, "required": ["path"]},
+    } for n in range(40)]
+    return json.dumps({"model": "claude-sonnet-4", "max_tokens": 8192, "stream": True,
+                       "messages": messages, "tools": tools}).encode()
+
+
+def one_request(raw: bytes, frames: bytes):
+    body = jsonfast.loads(raw)
+    messages = body["messages"]
+    jsonfast.dumpb(messages[:3], sort_keys=True)
+    conversion_cache.clear()
+    user_content, history, tool_results = convert_anthropic_messages_to_kiro(messages, "system")
+    HistoryManager().estimate_request_chars(history, user_content)
+    request = build_kiro_request(user_content, "claude-sonnet-4", history, None, None, tool_results)
+    encode_kiro_request(request)
+    for _ in EventStreamDecoder().feed(frames):
+        pass
+    for i in range(200):
+        AnthropicSSE.message_delta("end_turn", i)
+
+
+def measure(raw: bytes, frames: bytes, repeat: int) -> float:
+    one_request(raw, frames)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        one_request(raw, frames)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 后端基准")
+    parser.add_argument("--kb", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    raw = build_payload(args.kb)
+    frames = b"".join(encode_frame("assistantResponseEvent", {"content": f"token {i} "}) for i in range(500))
+    print(f"payload: {len(raw) / 1024:.0f} KB, 500 event-stream frames, 200 SSE events")
+
+    if not jsonfast.ORJSON_AVAILABLE:
+        print("orjson 未安装，只测量标准库")
+    results = {}
+    for name in ("json", "orjson"):
+        if name == "orjson" and not jsonfast.ORJSON_AVAILABLE:
+            continue
+        jsonfast.set_backend(name)
+        results[name] = measure(raw, frames, args.repeat)
+        print(f"{name:>7}: {results[name]:8.2f} ms / request")
+    if len(results) == 2:
+        print(f"saving: {results['json'] - results['orjson']:.2f} ms ({results['json'] / results['orjson']:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""SSE 编码与增量合并基准测试
+
+用法:
+    python benchmarks/bench_sse.py [--deltas 20000]
+
+1. 编码吞吐：原 f-string + json.dumps 写法 vs 预编码模板（events/sec）
+2. 每个响应的 send 次数（约等于 write 系统调用次数）：模拟 Kiro 以 1~2 个
+   token 为单位、按网络块到达的增量，比较不同合并窗口下的事件数
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy.core.sse import AnthropicSSE, OpenAIChunkSSE, DeltaCoalescer  # noqa: E402
+
+
+def legacy_anthropic(index: int, text: str) -> str:
+    return f'event: content_block_delta\ndata: {{"type":"content_block_delta","index":{index},"delta":{{"type":"text_delta","text":{json.dumps(text)}}}}}\n\n'
+
+
+def legacy_openai(text: str) -> str:
+    data = {
+        "id": "chatcmpl-bench",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "claude-sonnet-4",
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+    }
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def bench_encode(deltas):
+    openai_sse = OpenAIChunkSSE("chatcmpl-bench", 0, "claude-sonnet-4")
+    cases = [
+        ("anthropic f-string", lambda t: legacy_anthropic(0, t).encode()),
+        ("anthropic template", lambda t: AnthropicSSE.text_delta(0, t)),
+        ("openai json.dumps", lambda t: legacy_openai(t).encode()),
+        ("openai template", openai_sse.content),
+    ]
+    print(f"{'encoder':<22} {'events/sec':>12}")
+    for name, fn in cases:
+        best = None
+        for _ in range(3):
+            start = time.perf_counter()
+            for text in deltas:
+                fn(text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name:<22} {len(deltas) / best:>12,.0f}")
+
+
+def simulate_stream(n_deltas: int, seed: int = 1):
+    """生成 (到达时间, 同一网络块中的增量列表)"""
+    rng = random.Random(seed)
+    words = ["the", " quick", " brown", " fox", " jumps", " over", " lazy", " dog", ",", "\n", " 函数", " 返回"]
+    chunks = []
+    t = 0.0
+    remaining = n_deltas
+    while remaining > 0:
+        t += rng.expovariate(1 / 0.008)  # 平均 8ms 到达一个网络块
+        k = min(remaining, rng.choice((1, 1, 1, 2, 3)))
+        chunks.append((t, [rng.choice(words) for _ in range(k)]))
+        remaining -= k
+    return chunks
+
+
+def count_sends(chunks, window_ms: float, max_bytes: int) -> int:
+    """按 handler 的方式计数 send：每个网络块最多一次，窗口到期 flush 一次"""
+    coalescer = DeltaCoalescer(window_ms=window_ms, max_bytes=max_bytes)
+    sends = 0
+    for t, deltas in chunks:
+        left = coalescer.time_left(now=t)
+        if left is not None and left <= 0:
+            coalescer.flush()
+            sends += 1
+        out = 0
+        for text in deltas:
+            if coalescer.add(text, now=t):
+                out += 1
+        if out:
+            sends += 1
+    if coalescer.pending:
+        coalescer.flush()
+        sends += 1
+    return sends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 编码 / 合并基准")
+    parser.add_argument("--deltas", type=int, default=20000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    deltas = [rng.choice(["Hello", " world", "\n", " \"quoted\"", " 你好", " x"]) for _ in range(args.deltas)]
+    bench_encode(deltas)
+
+    chunks = simulate_stream(2000)
+    print()
+    print(f"simulated response: 2000 deltas in {len(chunks)} network chunks")
+    print(f"{'mode':<28} {'sends/response':>15}")
+    print(f"{'per delta (before)':<28} {2000:>15}")
+    for window_ms in (0, 15, 50):
+        print(f"{f'coalesce {window_ms}ms / 4096B':<28} {count_sends(chunks, window_ms, 4096):>15}")
+
+
+if __name__ == "__main__":
+    main()
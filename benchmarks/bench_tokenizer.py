@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Token 计数基准测试（准确度 / 速度）
+
+用法:
+    python benchmarks/bench_tokenizer.py [--samples samples.jsonl] [--turns 200]
+
+准确度：需要参考计数。--samples 读取 JSONL（每行 {"text": ..., "tokens": N}，
+例如用 Anthropic count_tokens 接口得到的真实计数）；安装了 tiktoken 且本地有
+cl100k_base 词表时也可以 --reference tiktoken 作为近似参考。没有参考时只打印各方法的估算值。
+
+速度：模拟 Agent 会话逐轮重发完整历史，对比 len/4、近似分词（无缓存）和近似分词（缓存）的耗时。
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from kiro_proxy.core.tokenizer import TokenCounter, _TOKEN_RE  # noqa: E402
+
+
+SAMPLES = {
+    "english": "The quick brown fox jumps over the lazy dog. " * 40
+               + "Refactoring large codebases requires careful planning and incremental changes.\n" * 20,
+    "python": "def handler(request):\n    result = process(request.body, timeout=30)\n"
+              "    if not result.ok:\n        raise ValueError(f\"failed: {result.error}\")\n    return result\n" * 40,
+    "json": json.dumps([{"id": i, "name": f"item_{i}", "tags": ["alpha", "beta"], "price": i * 1.5,
+                         "description": "A sample product entry"} for i in range(60)], indent=2),
+    "chinese": "这是一个用于测试分词器的中文段落，包含常见的标点符号和一些技术术语，例如缓存、并发和流式响应。" * 30,
+    "mixed": "用户说：please fix the bug in `src/server.py` line 42 — 服务启动后 HTTPServer 报错 ECONNRESET。\n" * 40,
+}
+
+
+def naive(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+def approx(text: str) -> int:
+    return len(_TOKEN_RE.findall(text))
+
+
+def load_reference(args):
+    """返回 [(name, text, tokens)]，没有参考时返回 None"""
+    if args.samples:
+        rows = []
+        with open(args.samples, encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if line.strip():
+                    row = json.loads(line)
+                    rows.append((row.get("name", f"#{i}"), row["text"], int(row["tokens"])))
+        return rows
+    if args.reference == "tiktoken":
+        try:
+            import tiktoken
+            enc = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"tiktoken 参考不可用: {e}")
+            return None
+        return [(name, text, len(enc.encode(text))) for name, text in SAMPLES.items()]
+    return None
+
+
+def accuracy(args):
+    reference = load_reference(args)
+    if reference is None:
+        print(f"{'sample':>10} {'chars':>7} {'len/4':>7} {'approx':>7}   (no reference)")
+        for name, text in SAMPLES.items():
+            print(f"{name:>10} {len(text):>7} {naive(text):>7} {approx(text):>7}")
+        return
+
+    print(f"{'sample':>10} {'ref':>7} {'len/4':>7} {'err':>7} {'approx':>7} {'err':>7}")
+    naive_err = approx_err = 0.0
+    for name, text, tokens in reference:
+        n, a = naive(text), approx(text)
+        e1, e2 = (n - tokens) / tokens * 100, (a - tokens) / tokens * 100
+        naive_err += abs(e1)
+        approx_err += abs(e2)
+        print(f"{name:>10} {tokens:>7} {n:>7} {e1:>+6.1f}% {a:>7} {e2:>+6.1f}%")
+    print(f"{'mean |err|':>10} {'':>7} {'':>7} {naive_err / len(reference):>6.1f}% {'':>7} {approx_err / len(reference):>6.1f}%")
+
+
+def speed(turns: int):
+    """逐轮重发完整会话，统计每种方法的总耗时"""
+    blocks = list(SAMPLES.values())
+    history = [blocks[i % len(blocks)] + f"\n# turn {i}\n" for i in range(turns)]
+
+    def run(count) -> float:
+        start = time.perf_counter()
+        for turn in range(1, turns + 1):
+            sum(count(text) for text in history[:turn])
+        return (time.perf_counter() - start) * 1000
+
+    counter = TokenCounter()
+    results = [("len/4", run(naive)), ("approx", run(approx)), ("approx+cache", run(counter.count))]
+    total_chars = sum(len(t) for t in history)
+    print(f"\nsession: {turns} turns, {total_chars / 1024:.0f} KB final history, full history recounted each turn")
+    for name, ms in results:
+        print(f"{name:>13}: {ms:9.1f} ms total, {ms / turns:7.3f} ms / turn")
+    print(f"cache: {counter.get_stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token 计数基准")
+    parser.add_argument("--samples", help="参考计数 JSONL: {\"text\": ..., \"tokens\": N}")
+    parser.add_argument("--reference", choices=["tiktoken"], help="使用 tiktoken cl100k_base 作为近似参考")
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+    accuracy(args)
+    speed(args.turns)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,10 +9,14 @@
 - web_search 特殊工具支持
 - tool_results 去重
 """
+import copy
 import json
 import hashlib
-import re
+import marshal
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 from typing import List, Dict, Any, Tuple, Optional
+from . import jsonfast
 
 # 常量
 MAX_TOOLS = 50
@@ -21,8 +25,24 @@ MAX_TOOL_DESCRIPTION_LENGTH = 500
 
 def generate_session_id(messages: list) -> str:
     """基于消息内容生成会话ID"""
-    content = json.dumps(messages[:3], sort_keys=True)
-    return hashlib.sha256(content.encode()).hexdigest()[:16]
+    content = jsonfast.dumpb(messages[:3], sort_keys=True)
+    return hashlib.sha256(content).hexdigest()[:16]
+
+
+def parse_image_data_url(url: str) -> Optional[dict]:
+    """解析 data:image/<fmt>;base64,<data> 形式的图片 URL
+
+    只检查逗号前的头部，base64 数据按逗号位置切片取出，不对整段（可能数 MB）做正则匹配。
+    """
+    if not url.startswith("data:image/"):
+        return None
+    comma = url.find(",", 0, 256)
+    if comma < 0:
+        return None
+    fmt, _, encoding = url[11:comma].partition(";")
+    if encoding != "base64" or not fmt.isalnum() or comma + 1 >= len(url):
+        return None
+    return {"format": fmt, "source": {"bytes": url[comma + 1:]}}
 
 
 def extract_images_from_content(content) -> Tuple[str, List[dict]]:
@@ -74,15 +94,9 @@ def extract_images_from_content(content) -> Tuple[str, List[dict]]:
                 image_url = block.get("image_url", {})
                 url = image_url.get("url", "")
                 
-                if url.startswith("data:"):
-                    match = re.match(r'data:image/(\w+);base64,(.+)', url)
-                    if match:
-                        fmt = match.group(1)
-                        data = match.group(2)
-                        images.append({
-                            "format": fmt,
-                            "source": {"bytes": data}
-                        })
+                image = parse_image_data_url(url)
+                if image:
+                    images.append(image)
     
     return "\n".join(text_parts), images
 
@@ -94,9 +108,87 @@ def truncate_description(desc: str, max_length: int = MAX_TOOL_DESCRIPTION_LENGT
     return desc[:max_length - 3] + "..."
 
 
+# ==================== 工具定义缓存 ====================
+
+class KiroTools(list):
+    """转换后的 Kiro 工具列表，encoded 为预序列化的 JSON（jsonfast 编码）
+
+    列表在多个请求间共享，调用方不能原地修改。
+    """
+    __slots__ = ("encoded",)
+
+
+class ToolSpecCache:
+    """工具定义转换缓存
+
+    Claude Code / Codex 每个请求都带着同一组 30~50 个工具和很大的 schema。
+    按协议 + 工具内容缓存转换结果及其 JSON，请求体编码时直接拼接。
+
+    键是工具列表的 marshal 序列化（不含引用的版本 2，同样的内容得到同样的字节），
+    比 JSON 编码快得多，命中时按完整字节比较，不会误命中。
+    """
+
+    def __init__(self, max_entries: int = 64, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, KiroTools]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, protocol: str, tools: list, convert) -> KiroTools:
+        """返回 tools 的转换结果，未命中时调用 convert(tools) 并缓存"""
+        try:
+            key = (protocol, marshal.dumps(tools, 2))
+        except ValueError:
+            # 含有非 JSON 类型，不缓存
+            self.misses += 1
+            result = KiroTools(convert(tools) or [])
+            result.encoded = jsonfast.dumpb(result)
+            return result
+        cached = self._entries.get(key)
+        if cached is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        result = KiroTools(convert(tools) or [])
+        result.encoded = jsonfast.dumpb(result)
+        self._entries[key] = result
+        self._bytes += len(key[1]) + len(result.encoded)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            (_, raw), evicted = self._entries.popitem(last=False)
+            self._bytes -= len(raw) + len(evicted.encoded)
+        return result
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / total * 100:.1f}%" if total else "0.0%",
+        }
+
+
+# 全局实例
+tool_spec_cache = ToolSpecCache()
+
+
 # ==================== Anthropic 转换 ====================
 
 def convert_anthropic_tools_to_kiro(tools: List[dict]) -> List[dict]:
+    """将 Anthropic 工具格式转换为 Kiro 格式（结果缓存共享，不要原地修改）"""
+    return tool_spec_cache.get("anthropic", tools, _convert_anthropic_tools)
+
+
+def _convert_anthropic_tools(tools: List[dict]) -> List[dict]:
     """将 Anthropic 工具格式转换为 Kiro 格式
     
     增强：
@@ -142,24 +234,53 @@ def convert_anthropic_tools_to_kiro(tools: List[dict]) -> List[dict]:
     return kiro_tools
 
 
-def fix_history_alternation(history: List[dict], model_id: str = "claude-sonnet-4") -> List[dict]:
-    """修复历史记录，确保 user/assistant 严格交替，并验证 toolUses/toolResults 配对
-    
-    Kiro API 规则：
-    1. 消息必须严格交替：user -> assistant -> user -> assistant
-    2. 当 assistant 有 toolUses 时，下一条 user 必须有对应的 toolResults
-    3. 当 assistant 没有 toolUses 时，下一条 user 不能有 toolResults
+def _user_placeholder(model_id: str) -> dict:
+    return {
+        "userInputMessage": {
+            "content": "Continue",
+            "modelId": model_id,
+            "origin": "AI_EDITOR"
+        }
+    }
+
+
+def _assistant_placeholder() -> dict:
+    return {
+        "assistantResponseMessage": {
+            "content": "I understand."
+        }
+    }
+
+
+def copy_entry(entry: dict) -> dict:
+    """复制历史条目的消息层和 context 层（文本、工具结果内容仍共享）
+
+    转换缓存中的条目在多个请求间共享，从 run_conversion 的结果取出历史后必须先复制。
+    下游（摘要、截断、补全 content）只会修改这两层，复制后修改不会影响缓存中的条目。
     """
-    if not history:
-        return history
-    
-    # 深拷贝以避免修改原始数据
-    import copy
-    history = copy.deepcopy(history)
-    
-    fixed = []
-    
-    for i, item in enumerate(history):
+    copied = {}
+    for key, msg in entry.items():
+        if isinstance(msg, dict):
+            msg = dict(msg)
+            ctx = msg.get("userInputMessageContext")
+            if isinstance(ctx, dict):
+                ctx = dict(ctx)
+                if isinstance(ctx.get("toolResults"), list):
+                    ctx["toolResults"] = list(ctx["toolResults"])
+                msg["userInputMessageContext"] = ctx
+            if isinstance(msg.get("toolUses"), list):
+                msg["toolUses"] = list(msg["toolUses"])
+        copied[key] = msg
+    return copied
+
+
+def _fold_history(fixed: List[dict], items, model_id: str) -> None:
+    """把 items 逐条并入 fixed，保证 user/assistant 交替及 toolUses/toolResults 配对
+
+    只会替换 fixed[-1] 或当前条目，需要修改时先复制（写时复制），
+    因此 fixed 中已有的条目和 items 本身都不会被原地修改，可以被缓存共享。
+    """
+    for item in items:
         is_user = "userInputMessage" in item
         is_assistant = "assistantResponseMessage" in item
         
@@ -173,109 +294,280 @@ def fix_history_alternation(history: List[dict], model_id: str = "claude-sonnet-
                 
                 if has_tool_results:
                     # 合并 tool_results 到上一条 user 消息
-                    new_results = ctx["toolResults"]
-                    last_user = fixed[-1]["userInputMessage"]
-                    
-                    if "userInputMessageContext" not in last_user:
-                        last_user["userInputMessageContext"] = {}
-                    
-                    last_ctx = last_user["userInputMessageContext"]
-                    if "toolResults" in last_ctx and last_ctx["toolResults"]:
-                        last_ctx["toolResults"].extend(new_results)
+                    last = copy_entry(fixed[-1])
+                    last_user = last["userInputMessage"]
+                    last_ctx = last_user.setdefault("userInputMessageContext", {})
+                    if last_ctx.get("toolResults"):
+                        last_ctx["toolResults"] = last_ctx["toolResults"] + list(ctx["toolResults"])
                     else:
-                        last_ctx["toolResults"] = new_results
+                        last_ctx["toolResults"] = list(ctx["toolResults"])
+                    fixed[-1] = last
                     continue
                 else:
                     # 插入一个占位 assistant 消息（不带 toolUses）
-                    fixed.append({
-                        "assistantResponseMessage": {
-                            "content": "I understand."
-                        }
-                    })
+                    fixed.append(_assistant_placeholder())
             
             # 验证 toolResults 与前一个 assistant 的 toolUses 配对
             if fixed and "assistantResponseMessage" in fixed[-1]:
-                last_assistant = fixed[-1]["assistantResponseMessage"]
-                has_tool_uses = bool(last_assistant.get("toolUses"))
+                has_tool_uses = bool(fixed[-1]["assistantResponseMessage"].get("toolUses"))
                 
-                user_msg = item["userInputMessage"]
-                ctx = user_msg.get("userInputMessageContext", {})
+                ctx = item["userInputMessage"].get("userInputMessageContext", {})
                 has_tool_results = bool(ctx.get("toolResults"))
                 
                 if has_tool_uses and not has_tool_results:
                     # assistant 有 toolUses 但 user 没有 toolResults
                     # 这是不允许的，需要清除 assistant 的 toolUses
-                    last_assistant.pop("toolUses", None)
+                    last = copy_entry(fixed[-1])
+                    last["assistantResponseMessage"].pop("toolUses", None)
+                    fixed[-1] = last
                 elif not has_tool_uses and has_tool_results:
                     # assistant 没有 toolUses 但 user 有 toolResults
                     # 这是不允许的，需要清除 user 的 toolResults
+                    item = copy_entry(item)
                     item["userInputMessage"].pop("userInputMessageContext", None)
             
             fixed.append(item)
         
         elif is_assistant:
-            # 检查上一条是否也是 assistant
-            if fixed and "assistantResponseMessage" in fixed[-1]:
-                # 插入一个占位 user 消息（不带 toolResults）
-                fixed.append({
-                    "userInputMessage": {
-                        "content": "Continue",
-                        "modelId": model_id,
-                        "origin": "AI_EDITOR"
-                    }
-                })
-            
-            # 如果历史为空，先插入一个 user 消息
-            if not fixed:
-                fixed.append({
-                    "userInputMessage": {
-                        "content": "Continue",
-                        "modelId": model_id,
-                        "origin": "AI_EDITOR"
-                    }
-                })
+            # 检查上一条是否也是 assistant，或历史为空：先插入一个占位 user 消息（不带 toolResults）
+            if not fixed or "assistantResponseMessage" in fixed[-1]:
+                fixed.append(_user_placeholder(model_id))
             
             fixed.append(item)
-    
-    # 确保以 assistant 结尾（如果最后是 user，添加占位 assistant）
+
+
+def _close_history(fixed: List[dict]) -> List[dict]:
+    """确保以 assistant 结尾（如果最后是 user，添加占位 assistant）"""
+    # 不需要清除 toolResults，因为它是与前一个 assistant 的 toolUses 配对的
+    # 占位 assistant 只是为了满足交替规则
     if fixed and "userInputMessage" in fixed[-1]:
-        # 不需要清除 toolResults，因为它是与前一个 assistant 的 toolUses 配对的
-        # 占位 assistant 只是为了满足交替规则
-        fixed.append({
-            "assistantResponseMessage": {
-                "content": "I understand."
-            }
-        })
-    
-    return fixed
+        return fixed + [_assistant_placeholder()]
+    return list(fixed)
 
 
-def convert_anthropic_messages_to_kiro(messages: List[dict], system="") -> Tuple[str, List[dict], List[dict]]:
-    """将 Anthropic 消息格式转换为 Kiro 格式
+def fix_history_alternation(history: List[dict], model_id: str = "claude-sonnet-4") -> List[dict]:
+    """修复历史记录，确保 user/assistant 严格交替，并验证 toolUses/toolResults 配对
     
-    Returns:
-        (user_content, history, tool_results)
+    Kiro API 规则：
+    1. 消息必须严格交替：user -> assistant -> user -> assistant
+    2. 当 assistant 有 toolUses 时，下一条 user 必须有对应的 toolResults
+    3. 当 assistant 没有 toolUses 时，下一条 user 不能有 toolResults
+
+    不修改传入的 history：未改动的条目直接共享，只为合并的 toolResults、
+    占位消息和去掉 toolUses 的条目分配新字典。
     """
-    history = []
-    user_content = ""
-    current_tool_results = []
+    if not history:
+        return history
     
-    # 处理 system
-    system_text = ""
-    if isinstance(system, list):
-        for block in system:
-            if isinstance(block, dict) and block.get("type") == "text":
-                system_text += block.get("text", "") + "\n"
-            elif isinstance(block, str):
-                system_text += block + "\n"
-        system_text = system_text.strip()
-    elif isinstance(system, str):
-        system_text = system
+    fixed = []
+    _fold_history(fixed, history, model_id)
+    return _close_history(fixed)
+
+
+# ==================== 前缀转换缓存 ====================
+
+def _freeze(obj) -> Tuple[Any, int]:
+    """把 JSON 结构转换为可哈希的元组，同时统计字符数
+
+    非字符串叶子带上类型，避免 1 / 1.0 / True 被视为相同。
+    """
+    if isinstance(obj, str):
+        return obj, len(obj)
+    if isinstance(obj, dict):
+        items = []
+        size = 0
+        for key, value in obj.items():
+            frozen, n = _freeze(value)
+            items.append((key, frozen))
+            size += n + len(key)
+        return tuple(items), size
+    if isinstance(obj, list):
+        items = []
+        size = 0
+        for value in obj:
+            frozen, n = _freeze(value)
+            items.append(frozen)
+            size += n
+        return tuple(items), size
+    return (obj.__class__, obj), 8
+
+
+class PrefixConversionCache:
+    """会话前缀转换缓存
+
+    Agent 客户端每一轮都会重发完整对话。按消息前缀的滚动哈希缓存转换状态
+    （原始历史 + 已修复交替的历史），下一轮只需转换新增的后缀消息。
+    缓存的状态只会被复制后续算，不会被原地修改。
+
+    单条消息的指纹使用进程内随机化的 hash()（比序列化后再做摘要快一个数量级），
+    再与前缀摘要滚动组合。hash() 会碰撞（如 hash(-1) == hash(-2)），因此条目同时保存
+    前缀消息的冻结形式，命中时逐条比较（字符串比较走 memcmp，叶子带类型），
+    不一致时按未命中处理，不会把其他会话的内容发往上游。
+    同一会话的新状态会替换它续算的父状态，缓存占用约等于各活跃会话的对话大小。
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.messages_reused = 0
+        self.messages_converted = 0
+
+    @staticmethod
+    def prefix_digests(seed: str, items: list, count: int) -> Tuple[List[bytes], List[int], list]:
+        """items[:i+1] 的滚动哈希、累计字符数（i < count），以及每条消息的冻结形式"""
+        digests = []
+        sizes = []
+        frozen_items = []
+        digest = hashlib.blake2b(seed.encode(), digest_size=16).digest()
+        size = 0
+        for item in items[:count]:
+            frozen, n = _freeze(item)
+            frozen_items.append(frozen)
+            size += n
+            digest = hashlib.blake2b(
+                digest + hash(frozen).to_bytes(8, "little", signed=True) + n.to_bytes(8, "little"),
+                digest_size=16,
+            ).digest()
+            digests.append(digest)
+            sizes.append(size)
+        return digests, sizes, frozen_items
+
+    def lookup(self, digests: List[bytes], frozen_items: list) -> Tuple[int, Any]:
+        """返回 (已缓存的最长前缀长度, 状态)，未命中时为 (0, None)
+
+        摘要相同但前缀内容不同（hash() 碰撞）的条目不会被使用。
+        """
+        for length in range(len(digests), 0, -1):
+            entry = self._entries.get(digests[length - 1])
+            if entry is not None:
+                if entry[2] != frozen_items[:length]:
+                    self.collisions += 1
+                    continue
+                self._entries.move_to_end(digests[length - 1])
+                self.hits += 1
+                self.messages_reused += length
+                return length, entry[0]
+        self.misses += 1
+        return 0, None
+
+    def store(self, digest: bytes, state, size: int, frozen_items: list, parent: bytes = None):
+        """保存前缀状态及其消息的冻结形式；parent 为本次续算所用的缓存前缀，新状态已包含它，直接替换"""
+        for key in (digest, parent):
+            old = self._entries.pop(key, None) if key is not None else None
+            if old is not None:
+                self._bytes -= old[1]
+        self._entries[digest] = (state, size, frozen_items)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / total * 100:.1f}%" if total else "0.0%",
+            "collisions": self.collisions,
+            "messages_reused": self.messages_reused,
+            "messages_converted": self.messages_converted,
+        }
+
+
+conversion_cache = PrefixConversionCache()
+
+
+class ConversionState(ABC):
+    """逐条转换的状态基类（前缀转换缓存的扩展点）
+
+    新协议的转换器继承本类实现 step()，再交给 run_conversion 运行即可复用前缀缓存
+    （如 handlers/responses.py）。snapshot() 只浅复制，子类中会被原地修改的可变字段
+    （列表等）需要覆盖 snapshot() 另行复制，否则会改到缓存中的状态。
+
+    history 为转换得到的原始历史；fixed 为已并入 _fold_history 的部分（原始历史的前 folded 条）。
+    最后一条原始历史可能在结束时被丢弃，所以始终滞后一条再并入。
+    """
+
+    def __init__(self, model_id: str = "claude-sonnet-4"):
+        self.model_id = model_id
+        self.history: List[dict] = []
+        self.fixed: List[dict] = []
+        self.folded = 0
+
+    @abstractmethod
+    def step(self, msg: dict, index: int, is_last: bool):
+        """转换第 index 条消息（is_last 为最后一条，不进入缓存）"""
+        pass
+
+    def fold(self, upto: int = None):
+        """把原始历史并入 fixed（默认保留最后一条）"""
+        if upto is None:
+            upto = len(self.history) - 1
+        if upto > self.folded:
+            _fold_history(self.fixed, self.history[self.folded:upto], self.model_id)
+            self.folded = upto
+
+    def snapshot(self) -> "ConversionState":
+        state = copy.copy(self)
+        state.history = list(self.history)
+        state.fixed = list(self.fixed)
+        return state
+
+
+def run_conversion(protocol: str, seed_parts: list, items: list, state: ConversionState) -> ConversionState:
+    """逐条转换 items；除最后一条外的前缀状态按滚动哈希缓存，下一轮从缓存处续算
+
+    protocol 和 seed_parts 参与缓存键（系统提示、模型等会影响转换结果的参数）。
+    返回的 state.fixed / history 与缓存共享条目，修改前先用 copy_entry 复制。
+    """
+    prefix_len = len(items) - 1
+    start = 0
+    digests = sizes = frozen_items = None
+    if prefix_len > 0:
+        seed = jsonfast.dumps([protocol] + seed_parts, default=str)
+        digests, sizes, frozen_items = conversion_cache.prefix_digests(seed, items, prefix_len)
+        start, cached = conversion_cache.lookup(digests, frozen_items)
+        if cached is not None:
+            state = cached.snapshot()
+    
+    for i in range(start, prefix_len):
+        state.step(items[i], i, False)
+    conversion_cache.messages_converted += max(0, prefix_len - start) + (1 if items else 0)
     
-    for i, msg in enumerate(messages):
+    if prefix_len > start:
+        state.fold()
+        parent = digests[start - 1] if start else None
+        conversion_cache.store(digests[-1], state.snapshot(), sizes[-1], frozen_items, parent)
+    
+    if items:
+        state.step(items[-1], prefix_len, True)
+    return state
+
+
+class _AnthropicConversion(ConversionState):
+    """convert_anthropic_messages_to_kiro 的逐条转换状态"""
+
+    def __init__(self, system_text: str):
+        super().__init__()
+        self.system_text = system_text
+        self.user_content = ""
+        self.current_tool_results = []
+
+    def step(self, msg: dict, index: int, is_last: bool):
+        history = self.history
         role = msg.get("role", "")
         content = msg.get("content", "")
-        is_last = (i == len(messages) - 1)
         
         # 处理 content 列表
         tool_results = []
@@ -322,8 +614,8 @@ def convert_anthropic_messages_to_kiro(messages: List[dict], system="") -> Tuple
             tool_results = unique_results
             
             if is_last:
-                current_tool_results = tool_results
-                user_content = content if content else "Tool results provided."
+                self.current_tool_results = tool_results
+                self.user_content = content if content else "Tool results provided."
             else:
                 history.append({
                     "userInputMessage": {
@@ -335,14 +627,14 @@ def convert_anthropic_messages_to_kiro(messages: List[dict], system="") -> Tuple
                         }
                     }
                 })
-            continue
+            return
         
         if role == "user":
-            if system_text and not history:
-                content = f"{system_text}\n\n{content}" if content else system_text
+            if self.system_text and not history:
+                content = f"{self.system_text}\n\n{content}" if content else self.system_text
             
             if is_last:
-                user_content = content if content else "Continue"
+                self.user_content = content if content else "Continue"
             else:
                 history.append({
                     "userInputMessage": {
@@ -386,11 +678,35 @@ def convert_anthropic_messages_to_kiro(messages: List[dict], system="") -> Tuple
                 assistant_msg["assistantResponseMessage"]["toolUses"] = tool_uses
             
             history.append(assistant_msg)
+
+
+def convert_anthropic_messages_to_kiro(messages: List[dict], system="") -> Tuple[str, List[dict], List[dict]]:
+    """将 Anthropic 消息格式转换为 Kiro 格式
+    
+    除最后一条外的消息按前缀缓存，多轮对话每轮只转换新增的消息。
+    
+    Returns:
+        (user_content, history, tool_results)
+    """
+    # 处理 system
+    system_text = ""
+    if isinstance(system, list):
+        for block in system:
+            if isinstance(block, dict) and block.get("type") == "text":
+                system_text += block.get("text", "") + "\n"
+            elif isinstance(block, str):
+                system_text += block + "\n"
+        system_text = system_text.strip()
+    elif isinstance(system, str):
+        system_text = system
+    
+    state = run_conversion("anthropic", [system_text], messages, _AnthropicConversion(system_text))
     
     # 修复历史交替
-    history = fix_history_alternation(history)
+    state.fold(len(state.history))
+    history = [copy_entry(h) for h in _close_history(state.fixed)]
     
-    return user_content, history, current_tool_results
+    return state.user_content, history, state.current_tool_results
 
 
 def convert_kiro_response_to_anthropic(result: dict, model: str, msg_id: str) -> dict:
@@ -428,6 +744,11 @@ def is_tool_choice_required(tool_choice) -> bool:
 
 
 def convert_openai_tools_to_kiro(tools: List[dict]) -> List[dict]:
+    """将 OpenAI 工具格式转换为 Kiro 格式（结果缓存共享，不要原地修改）"""
+    return tool_spec_cache.get("openai", tools, _convert_openai_tools)
+
+
+def _convert_openai_tools(tools: List[dict]) -> List[dict]:
     """将 OpenAI 工具格式转换为 Kiro 格式"""
     kiro_tools = []
     function_count = 0
@@ -471,38 +792,38 @@ def convert_openai_tools_to_kiro(tools: List[dict]) -> List[dict]:
     return kiro_tools
 
 
-def convert_openai_messages_to_kiro(
-    messages: List[dict], 
-    model: str,
-    tools: List[dict] = None,
-    tool_choice = None
-) -> Tuple[str, List[dict], List[dict], List[dict]]:
-    """将 OpenAI 消息格式转换为 Kiro 格式
-    
-    增强：
-    - 支持 tool 角色消息
-    - 支持 assistant 的 tool_calls
-    - 支持 tool_choice: required
-    - 历史交替修复
-    
-    Returns:
-        (user_content, history, tool_results, kiro_tools)
-    """
-    system_content = ""
-    history = []
-    user_content = ""
-    current_tool_results = []
-    pending_tool_results = []  # 待处理的 tool 消息
-    
-    # 处理 tool_choice: required
-    tool_instruction = ""
-    if is_tool_choice_required(tool_choice) and tools:
-        tool_instruction = "\n\n[CRITICAL INSTRUCTION] You MUST use one of the provided tools to respond. Do NOT respond with plain text. Call a tool function immediately."
-    
-    for i, msg in enumerate(messages):
+def _dedupe_tool_results(tool_results: List[dict]) -> List[dict]:
+    """按 toolUseId 去重，保留首次出现的结果"""
+    seen_ids = set()
+    unique_results = []
+    for tr in tool_results:
+        if tr["toolUseId"] not in seen_ids:
+            seen_ids.add(tr["toolUseId"])
+            unique_results.append(tr)
+    return unique_results
+
+
+class _OpenAIConversion(ConversionState):
+    """convert_openai_messages_to_kiro 的逐条转换状态"""
+
+    def __init__(self, model: str, tool_instruction: str):
+        super().__init__(model)
+        self.tool_instruction = tool_instruction
+        self.system_content = ""
+        self.user_content = ""
+        self.current_tool_results = []
+        self.pending_tool_results = []  # 待处理的 tool 消息
+
+    def snapshot(self) -> "_OpenAIConversion":
+        state = super().snapshot()
+        state.pending_tool_results = list(self.pending_tool_results)
+        return state
+
+    def step(self, msg: dict, index: int, is_last: bool):
+        history = self.history
+        model = self.model_id
         role = msg.get("role", "")
         content = msg.get("content", "")
-        is_last = (i == len(messages) - 1)
         
         # 提取文本内容
         if isinstance(content, list):
@@ -511,12 +832,12 @@ def convert_openai_messages_to_kiro(
             content = ""
         
         if role == "system":
-            system_content = content + tool_instruction
+            self.system_content = content + self.tool_instruction
         
         elif role == "tool":
             # OpenAI tool 角色消息 -> Kiro toolResults
             tool_call_id = msg.get("tool_call_id", "")
-            pending_tool_results.append({
+            self.pending_tool_results.append({
                 "content": [{"text": str(content)}],
                 "status": "success",
                 "toolUseId": tool_call_id
@@ -524,17 +845,11 @@ def convert_openai_messages_to_kiro(
         
         elif role == "user":
             # 如果有待处理的 tool results，先处理
-            if pending_tool_results:
-                # 去重
-                seen_ids = set()
-                unique_results = []
-                for tr in pending_tool_results:
-                    if tr["toolUseId"] not in seen_ids:
-                        seen_ids.add(tr["toolUseId"])
-                        unique_results.append(tr)
+            if self.pending_tool_results:
+                unique_results = _dedupe_tool_results(self.pending_tool_results)
                 
                 if is_last:
-                    current_tool_results = unique_results
+                    self.current_tool_results = unique_results
                 else:
                     history.append({
                         "userInputMessage": {
@@ -546,14 +861,14 @@ def convert_openai_messages_to_kiro(
                             }
                         }
                     })
-                pending_tool_results = []
+                self.pending_tool_results = []
             
             # 合并 system prompt
-            if system_content and not history:
-                content = f"{system_content}\n\n{content}"
+            if self.system_content and not history:
+                content = f"{self.system_content}\n\n{content}"
             
             if is_last:
-                user_content = content
+                self.user_content = content
             else:
                 history.append({
                     "userInputMessage": {
@@ -565,25 +880,18 @@ def convert_openai_messages_to_kiro(
         
         elif role == "assistant":
             # 如果有待处理的 tool results，先创建 user 消息
-            if pending_tool_results:
-                seen_ids = set()
-                unique_results = []
-                for tr in pending_tool_results:
-                    if tr["toolUseId"] not in seen_ids:
-                        seen_ids.add(tr["toolUseId"])
-                        unique_results.append(tr)
-                
+            if self.pending_tool_results:
                 history.append({
                     "userInputMessage": {
                         "content": "Tool results provided.",
                         "modelId": model,
                         "origin": "AI_EDITOR",
                         "userInputMessageContext": {
-                            "toolResults": unique_results
+                            "toolResults": _dedupe_tool_results(self.pending_tool_results)
                         }
                     }
                 })
-                pending_tool_results = []
+                self.pending_tool_results = []
             
             # 处理 tool_calls
             tool_uses = []
@@ -614,16 +922,38 @@ def convert_openai_messages_to_kiro(
                 assistant_msg["assistantResponseMessage"]["toolUses"] = tool_uses
             
             history.append(assistant_msg)
+
+
+def convert_openai_messages_to_kiro(
+    messages: List[dict], 
+    model: str,
+    tools: List[dict] = None,
+    tool_choice = None
+) -> Tuple[str, List[dict], List[dict], List[dict]]:
+    """将 OpenAI 消息格式转换为 Kiro 格式
+    
+    增强：
+    - 支持 tool 角色消息
+    - 支持 assistant 的 tool_calls
+    - 支持 tool_choice: required
+    - 历史交替修复
+    - 除最后一条外的消息按前缀缓存，每轮只转换新增的消息
+    
+    Returns:
+        (user_content, history, tool_results, kiro_tools)
+    """
+    # 处理 tool_choice: required
+    tool_instruction = ""
+    if is_tool_choice_required(tool_choice) and tools:
+        tool_instruction = "\n\n[CRITICAL INSTRUCTION] You MUST use one of the provided tools to respond. Do NOT respond with plain text. Call a tool function immediately."
+    
+    state = run_conversion("openai", [model, tool_instruction], messages, _OpenAIConversion(model, tool_instruction))
+    user_content = state.user_content
+    current_tool_results = state.current_tool_results
     
     # 处理末尾的 tool results
-    if pending_tool_results:
-        seen_ids = set()
-        unique_results = []
-        for tr in pending_tool_results:
-            if tr["toolUseId"] not in seen_ids:
-                seen_ids.add(tr["toolUseId"])
-                unique_results.append(tr)
-        current_tool_results = unique_results
+    if state.pending_tool_results:
+        current_tool_results = _dedupe_tool_results(state.pending_tool_results)
         if not user_content:
             user_content = "Tool results provided."
     
@@ -636,11 +966,13 @@ def convert_openai_messages_to_kiro(
             user_content = "Continue"
     
     # 历史不包含最后一条用户消息
-    if history and "userInputMessage" in history[-1]:
-        history = history[:-1]
+    history_len = len(state.history)
+    if state.history and "userInputMessage" in state.history[-1]:
+        history_len -= 1
     
     # 修复历史交替
-    history = fix_history_alternation(history, model)
+    state.fold(history_len)
+    history = [copy_entry(h) for h in _close_history(state.fixed)] if history_len else []
     
     # 转换工具
     kiro_tools = convert_openai_tools_to_kiro(tools) if tools else []
@@ -697,6 +1029,11 @@ def convert_kiro_response_to_openai(result: dict, model: str, msg_id: str) -> di
 # ==================== Gemini 转换 ====================
 
 def convert_gemini_tools_to_kiro(tools: List[dict]) -> List[dict]:
+    """将 Gemini 工具格式转换为 Kiro 格式（结果缓存共享，不要原地修改）"""
+    return tool_spec_cache.get("gemini", tools, _convert_gemini_tools)
+
+
+def _convert_gemini_tools(tools: List[dict]) -> List[dict]:
     """将 Gemini 工具格式转换为 Kiro 格式
     
     Gemini 工具格式：
@@ -741,44 +1078,41 @@ def convert_gemini_tools_to_kiro(tools: List[dict]) -> List[dict]:
     return kiro_tools
 
 
-def convert_gemini_contents_to_kiro(
-    contents: List[dict], 
-    system_instruction: dict, 
-    model: str,
-    tools: List[dict] = None,
-    tool_config: dict = None
-) -> Tuple[str, List[dict], List[dict], List[dict]]:
-    """将 Gemini 消息格式转换为 Kiro 格式
-    
-    增强：
-    - 支持 functionCall 和 functionResponse
-    - 支持 tool_config
-    
-    Returns:
-        (user_content, history, tool_results, kiro_tools)
-    """
-    history = []
-    user_content = ""
-    current_tool_results = []
-    pending_tool_results = []
-    
-    # 处理 system instruction
-    system_text = ""
-    if system_instruction:
-        parts = system_instruction.get("parts", [])
-        system_text = " ".join(p.get("text", "") for p in parts if "text" in p)
-    
-    # 处理 tool_config（类似 tool_choice）
-    tool_instruction = ""
-    if tool_config:
-        mode = tool_config.get("functionCallingConfig", {}).get("mode", "")
-        if mode in ("ANY", "REQUIRED"):
-            tool_instruction = "\n\n[CRITICAL INSTRUCTION] You MUST use one of the provided tools to respond. Do NOT respond with plain text."
-    
-    for i, content in enumerate(contents):
+class _GeminiConversion(ConversionState):
+    """convert_gemini_contents_to_kiro 的逐条转换状态"""
+
+    def __init__(self, model: str, system_text: str, tool_instruction: str):
+        super().__init__(model)
+        self.system_text = system_text
+        self.tool_instruction = tool_instruction
+        self.user_content = ""
+        self.current_tool_results = []
+        self.pending_tool_results = []
+
+    def snapshot(self) -> "_GeminiConversion":
+        state = super().snapshot()
+        state.pending_tool_results = list(self.pending_tool_results)
+        return state
+
+    def _flush_tool_results(self):
+        """把待处理的 tool responses 作为一条 user 消息写入历史"""
+        if self.pending_tool_results:
+            self.history.append({
+                "userInputMessage": {
+                    "content": "Tool results provided.",
+                    "modelId": self.model_id,
+                    "origin": "AI_EDITOR",
+                    "userInputMessageContext": {
+                        "toolResults": _dedupe_tool_results(self.pending_tool_results)
+                    }
+                }
+            })
+            self.pending_tool_results = []
+
+    def step(self, content: dict, i: int, is_last: bool):
+        history = self.history
         role = content.get("role", "user")
         parts = content.get("parts", [])
-        is_last = (i == len(contents) - 1)
         
         # 提取文本和工具调用
         text_parts = []
@@ -815,70 +1149,34 @@ def convert_gemini_contents_to_kiro(
         
         if role == "user":
             # 处理待处理的 tool responses
-            if pending_tool_results:
-                seen_ids = set()
-                unique_results = []
-                for tr in pending_tool_results:
-                    if tr["toolUseId"] not in seen_ids:
-                        seen_ids.add(tr["toolUseId"])
-                        unique_results.append(tr)
-                
-                history.append({
-                    "userInputMessage": {
-                        "content": "Tool results provided.",
-                        "modelId": model,
-                        "origin": "AI_EDITOR",
-                        "userInputMessageContext": {
-                            "toolResults": unique_results
-                        }
-                    }
-                })
-                pending_tool_results = []
+            self._flush_tool_results()
             
             # 处理 functionResponse（用户消息中的工具响应）
             if tool_responses:
-                pending_tool_results.extend(tool_responses)
+                self.pending_tool_results.extend(tool_responses)
             
             # 合并 system prompt
-            if system_text and not history:
-                text = f"{system_text}{tool_instruction}\n\n{text}"
+            if self.system_text and not history:
+                text = f"{self.system_text}{self.tool_instruction}\n\n{text}"
             
             if is_last:
-                user_content = text
-                if pending_tool_results:
-                    current_tool_results = pending_tool_results
-                    pending_tool_results = []
+                self.user_content = text
+                if self.pending_tool_results:
+                    self.current_tool_results = self.pending_tool_results
+                    self.pending_tool_results = []
             else:
                 if text:
                     history.append({
                         "userInputMessage": {
                             "content": text,
-                            "modelId": model,
+                            "modelId": self.model_id,
                             "origin": "AI_EDITOR"
                         }
                     })
         
         elif role == "model":
             # 处理待处理的 tool responses
-            if pending_tool_results:
-                seen_ids = set()
-                unique_results = []
-                for tr in pending_tool_results:
-                    if tr["toolUseId"] not in seen_ids:
-                        seen_ids.add(tr["toolUseId"])
-                        unique_results.append(tr)
-                
-                history.append({
-                    "userInputMessage": {
-                        "content": "Tool results provided.",
-                        "modelId": model,
-                        "origin": "AI_EDITOR",
-                        "userInputMessageContext": {
-                            "toolResults": unique_results
-                        }
-                    }
-                })
-                pending_tool_results = []
+            self._flush_tool_results()
             
             assistant_text = text if text else "I understand."
             
@@ -892,10 +1190,48 @@ def convert_gemini_contents_to_kiro(
                 assistant_msg["assistantResponseMessage"]["toolUses"] = tool_calls
             
             history.append(assistant_msg)
+
+
+def convert_gemini_contents_to_kiro(
+    contents: List[dict], 
+    system_instruction: dict, 
+    model: str,
+    tools: List[dict] = None,
+    tool_config: dict = None
+) -> Tuple[str, List[dict], List[dict], List[dict]]:
+    """将 Gemini 消息格式转换为 Kiro 格式
+    
+    增强：
+    - 支持 functionCall 和 functionResponse
+    - 支持 tool_config
+    - 除最后一条外的消息按前缀缓存，每轮只转换新增的消息
+    
+    Returns:
+        (user_content, history, tool_results, kiro_tools)
+    """
+    # 处理 system instruction
+    system_text = ""
+    if system_instruction:
+        parts = system_instruction.get("parts", [])
+        system_text = " ".join(p.get("text", "") for p in parts if "text" in p)
+    
+    # 处理 tool_config（类似 tool_choice）
+    tool_instruction = ""
+    if tool_config:
+        mode = tool_config.get("functionCallingConfig", {}).get("mode", "")
+        if mode in ("ANY", "REQUIRED"):
+            tool_instruction = "\n\n[CRITICAL INSTRUCTION] You MUST use one of the provided tools to respond. Do NOT respond with plain text."
+    
+    state = run_conversion(
+        "gemini", [model, system_text, tool_instruction], contents,
+        _GeminiConversion(model, system_text, tool_instruction),
+    )
+    user_content = state.user_content
+    current_tool_results = state.current_tool_results
     
     # 处理末尾的 tool results
-    if pending_tool_results:
-        current_tool_results = pending_tool_results
+    if state.pending_tool_results:
+        current_tool_results = state.pending_tool_results
         if not user_content:
             user_content = "Tool results provided."
     
@@ -908,11 +1244,13 @@ def convert_gemini_contents_to_kiro(
             user_content = "Continue"
     
     # 修复历史交替
-    history = fix_history_alternation(history, model)
+    state.fold(len(state.history))
+    history = _close_history(state.fixed)
     
     # 移除最后一条（当前用户消息）
     if history and "userInputMessage" in history[-1]:
         history = history[:-1]
+    history = [copy_entry(h) for h in history]
     
     # 转换工具
     kiro_tools = convert_gemini_tools_to_kiro(tools) if tools else []
@@ -13,6 +13,7 @@ from .history_manager import (
     get_history_config, set_history_config, update_history_config,
     is_content_length_error
 )
+from .limit_predictor import limit_predictor, LimitPredictor, ModelLimit
 from .error_handler import (
     ErrorType, KiroError, classify_error, is_account_suspended,
     get_anthropic_error_response, format_error_log
@@ -30,6 +31,7 @@ __all__ = [
     "HistoryManager", "HistoryConfig", "TruncateStrategy",
     "get_history_config", "set_history_config", "update_history_config",
     "is_content_length_error",
+    "limit_predictor", "LimitPredictor", "ModelLimit",
     "ErrorType", "KiroError", "classify_error", "is_account_suspended",
     "get_anthropic_error_response", "format_error_log",
     "RateLimiter", "RateLimitConfig", "rate_limiter", "get_rate_limiter"
@@ -3,12 +3,13 @@ import json
 import time
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Dict
 
 from ..credential import (
     KiroCredentials, TokenRefresher, CredentialStatus,
-    generate_machine_id, quota_manager
+    generate_machine_id, get_hour_slot, quota_manager
 )
+from ..providers.kiro import KiroProvider
 
 
 @dataclass
@@ -22,9 +23,14 @@ class Account:
     error_count: int = 0
     last_used: Optional[float] = None
     status: CredentialStatus = CredentialStatus.ACTIVE
+    # 正在进行的上游流式请求数（客户端断开时立即释放）
+    in_flight: int = 0
     
     _credentials: Optional[KiroCredentials] = field(default=None, repr=False)
     _machine_id: Optional[str] = field(default=None, repr=False)
+    _machine_id_slot: int = field(default=-1, repr=False)
+    _header_template: Optional[Dict[str, str]] = field(default=None, repr=False)
+    _header_template_key: Optional[tuple] = field(default=None, repr=False)
     
     def is_available(self) -> bool:
         """检查账号是否可用"""
@@ -44,6 +50,7 @@ class Account:
             if self._credentials.client_id_hash and not self._credentials.client_id:
                 self._merge_client_credentials()
             
+            self.invalidate_headers()
             return self._credentials
         except Exception as e:
             print(f"[Account] 加载凭证失败 {self.id}: {e}")
@@ -87,8 +94,9 @@ class Account:
             return ""
     
     def get_machine_id(self) -> str:
-        """获取基于此账号的 Machine ID"""
-        if self._machine_id:
+        """获取基于此账号的 Machine ID（每小时重新生成一次）"""
+        hour_slot = get_hour_slot()
+        if self._machine_id and self._machine_id_slot == hour_slot:
             return self._machine_id
         
         creds = self.get_credentials()
@@ -96,9 +104,35 @@ class Account:
             self._machine_id = generate_machine_id(creds.profile_arn, creds.client_id)
         else:
             self._machine_id = generate_machine_id()
+        self._machine_id_slot = hour_slot
         
         return self._machine_id
     
+    def get_header_template(self, agent_mode: str = "vibe") -> Dict[str, str]:
+        """获取请求头模板（静态部分按账号缓存）
+        
+        版本、系统信息和 Machine ID 只在 Machine ID 跨小时变化
+        或 token 刷新后重建。
+        """
+        machine_id = self.get_machine_id()
+        key = (machine_id, agent_mode)
+        if self._header_template is None or self._header_template_key != key:
+            self._header_template = KiroProvider.build_header_template(machine_id, agent_mode)
+            self._header_template_key = key
+        return self._header_template
+    
+    def build_headers(self, token: str = None, agent_mode: str = "vibe") -> Dict[str, str]:
+        """构建此账号的 Kiro API 请求头（只填充 invocation id 和 Authorization）"""
+        return KiroProvider.stamp_headers(
+            self.get_header_template(agent_mode), token or self.get_token()
+        )
+    
+    def invalidate_headers(self):
+        """使缓存的请求头模板失效（凭证变化后调用）"""
+        self._machine_id = None
+        self._header_template = None
+        self._header_template_key = None
+    
     def is_token_expired(self) -> bool:
         """检查 token 是否过期"""
         creds = self.get_credentials()
@@ -121,6 +155,7 @@ class Account:
         if success:
             creds.save_to_file(self.token_path)
             self._credentials = creds
+            self.invalidate_headers()
             self.status = CredentialStatus.ACTIVE
             return True, "Token 刷新成功"
         else:
@@ -154,6 +189,7 @@ class Account:
             "status": self.status.value,
             "available": self.is_available(),
             "request_count": self.request_count,
+            "in_flight": self.in_flight,
             "error_count": self.error_count,
             "cooldown_remaining": cooldown_remaining,
             "token_expired": self.is_token_expired() if creds else None,
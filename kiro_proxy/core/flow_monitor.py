@@ -19,6 +19,7 @@ class FlowState(str, Enum):
     STREAMING = "streaming"  # 流式传输中
     COMPLETED = "completed"  # 完成
     ERROR = "error"          # 错误
+    CANCELLED = "cancelled"  # 客户端断开
 
 
 @dataclass
@@ -59,6 +60,16 @@ class FlowRequest:
     stream: bool = False
     max_tokens: int = 0
     temperature: float = 1.0
+    
+    # 发往上游的请求体（编码一次，重试复用）
+    upstream_body_bytes: int = 0
+    upstream_encode_ms: float = 0.0
+    
+    # 历史去重节省的字节数
+    history_dedup_bytes: int = 0
+    
+    # 发送的图片字节数
+    image_bytes: int = 0
 
 
 @dataclass
@@ -93,6 +104,7 @@ class FlowTiming:
     """时间信息"""
     created_at: float = 0
     first_byte_at: Optional[float] = None
+    first_tool_byte_at: Optional[float] = None
     completed_at: Optional[float] = None
     
     @property
@@ -102,6 +114,13 @@ class FlowTiming:
             return (self.first_byte_at - self.created_at) * 1000
         return None
     
+    @property
+    def first_tool_byte_ms(self) -> Optional[float]:
+        """Time to first tool_use byte"""
+        if self.first_tool_byte_at and self.created_at:
+            return (self.first_tool_byte_at - self.created_at) * 1000
+        return None
+    
     @property
     def duration_ms(self) -> Optional[float]:
         """Total duration"""
@@ -138,6 +157,9 @@ class LLMFlow:
     retry_count: int = 0
     parent_flow_id: Optional[str] = None
     
+    # 客户端断开后被取消的上游请求已运行的时间
+    wasted_upstream_seconds: float = 0.0
+    
     def to_dict(self) -> dict:
         """转换为字典"""
         d = {
@@ -149,8 +171,10 @@ class LLMFlow:
             "timing": {
                 "created_at": self.timing.created_at,
                 "first_byte_at": self.timing.first_byte_at,
+                "first_tool_byte_at": self.timing.first_tool_byte_at,
                 "completed_at": self.timing.completed_at,
                 "ttfb_ms": self.timing.ttfb_ms,
+                "first_tool_byte_ms": self.timing.first_tool_byte_ms,
                 "duration_ms": self.timing.duration_ms,
             },
             "tags": self.tags,
@@ -159,6 +183,9 @@ class LLMFlow:
             "retry_count": self.retry_count,
         }
         
+        if self.state == FlowState.CANCELLED:
+            d["wasted_upstream_seconds"] = round(self.wasted_upstream_seconds, 3)
+        
         if self.request:
             d["request"] = {
                 "method": self.request.method,
@@ -168,6 +195,10 @@ class LLMFlow:
                 "message_count": len(self.request.messages),
                 "has_tools": bool(self.request.tools),
                 "has_system": bool(self.request.system),
+                "upstream_body_bytes": self.request.upstream_body_bytes,
+                "upstream_encode_ms": round(self.request.upstream_encode_ms, 2),
+                "history_dedup_bytes": self.request.history_dedup_bytes,
+                "image_bytes": self.request.image_bytes,
             }
         
         if self.response:
@@ -219,6 +250,8 @@ class FlowStore:
         self.total_flows = 0
         self.total_tokens_in = 0
         self.total_tokens_out = 0
+        self.cancelled_flows = 0
+        self.wasted_upstream_seconds = 0.0
     
     def add(self, flow: LLMFlow):
         """添加 Flow"""
@@ -306,6 +339,7 @@ class FlowStore:
         """获取统计信息"""
         completed = [f for f in self.flows if f.state == FlowState.COMPLETED]
         errors = [f for f in self.flows if f.state == FlowState.ERROR]
+        cancelled = [f for f in self.flows if f.state == FlowState.CANCELLED]
         
         # 按模型统计
         model_stats = {}
@@ -324,6 +358,8 @@ class FlowStore:
         # 计算平均延迟
         durations = [f.timing.duration_ms for f in completed if f.timing.duration_ms]
         avg_duration = sum(durations) / len(durations) if durations else 0
+        tool_latencies = [f.timing.first_tool_byte_ms for f in completed if f.timing.first_tool_byte_ms]
+        avg_first_tool_byte = sum(tool_latencies) / len(tool_latencies) if tool_latencies else 0
         
         return {
             "total_flows": self.total_flows,
@@ -331,7 +367,11 @@ class FlowStore:
             "completed": len(completed),
             "errors": len(errors),
             "error_rate": f"{len(errors) / max(1, len(self.flows)) * 100:.1f}%",
+            "cancelled": len(cancelled),
+            "total_cancelled": self.cancelled_flows,
+            "wasted_upstream_seconds": round(self.wasted_upstream_seconds, 2),
             "avg_duration_ms": round(avg_duration, 2),
+            "avg_first_tool_byte_ms": round(avg_first_tool_byte, 2),
             "total_tokens_in": self.total_tokens_in,
             "total_tokens_out": self.total_tokens_out,
             "by_model": model_stats,
@@ -459,6 +499,25 @@ class FlowMonitor:
         self.store.add(flow)
         return flow_id
     
+    def record_upstream_body(self, flow_id: str, size: int, encode_ms: float):
+        """记录上游请求体的大小和编码耗时"""
+        flow = self.store.get(flow_id)
+        if flow and flow.request:
+            flow.request.upstream_body_bytes = size
+            flow.request.upstream_encode_ms = encode_ms
+    
+    def record_history_dedup(self, flow_id: str, saved_bytes: int):
+        """记录历史去重节省的字节数"""
+        flow = self.store.get(flow_id)
+        if flow and flow.request:
+            flow.request.history_dedup_bytes = saved_bytes
+    
+    def record_image_bytes(self, flow_id: str, image_bytes: int):
+        """记录发送的图片字节数"""
+        flow = self.store.get(flow_id)
+        if flow and flow.request:
+            flow.request.image_bytes = image_bytes
+    
     def start_streaming(self, flow_id: str):
         """标记开始流式传输"""
         flow = self.store.get(flow_id)
@@ -468,6 +527,12 @@ class FlowMonitor:
             if not flow.response:
                 flow.response = FlowResponse(status_code=200)
     
+    def mark_first_tool_byte(self, flow_id: str):
+        """记录首个工具调用片段的到达时间"""
+        flow = self.store.get(flow_id)
+        if flow and flow.timing.first_tool_byte_at is None:
+            flow.timing.first_tool_byte_at = time.time()
+    
     def add_chunk(self, flow_id: str, chunk: str):
         """添加流式响应块"""
         flow = self.store.get(flow_id)
@@ -523,6 +588,21 @@ class FlowMonitor:
             raw=raw[:1000],  # 限制长度
         )
     
+    def cancel_flow(self, flow_id: str, wasted_seconds: float = 0.0):
+        """标记 Flow 因客户端断开而取消（已完成或失败的 Flow 不受影响）"""
+        flow = self.store.get(flow_id)
+        if not flow:
+            return
+        
+        if wasted_seconds:
+            flow.wasted_upstream_seconds += wasted_seconds
+            self.store.wasted_upstream_seconds += wasted_seconds
+        
+        if flow.state in (FlowState.PENDING, FlowState.STREAMING):
+            flow.state = FlowState.CANCELLED
+            flow.timing.completed_at = time.time()
+            self.store.cancelled_flows += 1
+    
     def bookmark_flow(self, flow_id: str, bookmarked: bool = True):
         """书签 Flow"""
         flow = self.store.get(flow_id)
@@ -6,21 +6,90 @@
 3. 错误重试 - 捕获错误后截断重试
 4. 预估检测 - 发送前预估并截断
 """
-import json
+import asyncio
+import hashlib
 import httpx
 import time
+from bisect import bisect_left
 from typing import List, Dict, Any, Tuple, Optional, Callable
 from dataclasses import dataclass, field
 from collections import OrderedDict
 from enum import Enum
 
+from .. import jsonfast
+from .tokenizer import token_counter
+from .limit_predictor import limit_predictor, measure_request
+from .summary_store import summary_store, summary_key
+from .singleflight import SingleFlight
+
 
 @dataclass
 class SummaryCacheEntry:
     summary: str
     old_history_count: int
     old_history_chars: int
+    last_fingerprint: Tuple[int, int]  # 最后一条被覆盖消息的 (长度, 哈希)
+    updated_at: float
+    background: bool = False  # 由后台摘要预先生成
+
+
+@dataclass
+class RollingSummary:
+    """会话的滚动摘要：覆盖历史的前 covered_count 条消息"""
+    summary: str
+    covered_count: int
+    last_fingerprint: Tuple[int, int]  # 最后一条被覆盖消息的 (长度, 哈希)，用于确认仍是同一段历史
     updated_at: float
+    depth: int = 1                     # 连续增量合并的次数
+
+
+def _message_fingerprint(msg: dict) -> Tuple[int, int]:
+    text = jsonfast.dumps(msg)
+    return len(text), hash(text)
+
+
+class SummaryCallStats:
+    """摘要调用统计（耗时、输入字符数）"""
+
+    def __init__(self):
+        self.calls = 0
+        self.full_calls = 0
+        self.incremental_calls = 0
+        self.failures = 0
+        self.store_hits = 0
+        self.input_chars = 0
+        self.latency_ms = 0.0
+        self.max_input_chars = 0
+
+    def record(self, incremental: bool, input_chars: int, latency_ms: float, ok: bool):
+        self.calls += 1
+        if incremental:
+            self.incremental_calls += 1
+        else:
+            self.full_calls += 1
+        if not ok:
+            self.failures += 1
+        self.input_chars += input_chars
+        self.max_input_chars = max(self.max_input_chars, input_chars)
+        self.latency_ms += latency_ms
+
+    def get_stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "full_calls": self.full_calls,
+            "incremental_calls": self.incremental_calls,
+            "failures": self.failures,
+            "store_hits": self.store_hits,
+            "avg_input_chars": round(self.input_chars / self.calls) if self.calls else 0,
+            "max_input_chars": self.max_input_chars,
+            "avg_latency_ms": round(self.latency_ms / self.calls, 1) if self.calls else 0,
+        }
+
+
+summary_stats = SummaryCallStats()
+
+# 相同提示词的并发摘要调用只发一次
+summary_flights = SingleFlight()
 
 
 class SummaryCache:
@@ -29,6 +98,8 @@ class SummaryCache:
     def __init__(self, max_entries: int = 128):
         self._entries: "OrderedDict[str, SummaryCacheEntry]" = OrderedDict()
         self._max_entries = max_entries
+        self.background_hits = 0  # 前台请求命中后台预生成的摘要（省去一次同步摘要调用）
+        self._rolling: "OrderedDict[str, RollingSummary]" = OrderedDict()
 
     def get(
         self,
@@ -37,8 +108,10 @@ class SummaryCache:
         old_history_chars: int,
         min_delta_messages: int,
         min_delta_chars: int,
-        max_age_seconds: int
-    ) -> Optional[str]:
+        max_age_seconds: int,
+        foreground: bool = True
+    ) -> Optional[SummaryCacheEntry]:
+        """返回覆盖旧消息片段前缀、且未覆盖部分未超过阈值的摘要（调用方需确认前缀一致）"""
         entry = self._entries.get(key)
         if not entry:
             return None
@@ -48,6 +121,10 @@ class SummaryCache:
             self._entries.pop(key, None)
             return None
 
+        # 摘要覆盖的消息多于当前片段时，多出的部分已在保留的最近消息中，不能复用
+        if not 0 < entry.old_history_count <= old_history_count:
+            return None
+
         if old_history_count - entry.old_history_count >= min_delta_messages:
             return None
 
@@ -55,25 +132,507 @@ class SummaryCache:
             return None
 
         self._entries.move_to_end(key)
-        return entry.summary
+        if foreground and entry.background:
+            self.background_hits += 1
+        return entry
 
     def set(
         self,
         key: str,
         summary: str,
         old_history_count: int,
-        old_history_chars: int
+        old_history_chars: int,
+        last_fingerprint: Tuple[int, int],
+        background: bool = False
     ):
         self._entries[key] = SummaryCacheEntry(
             summary=summary,
             old_history_count=old_history_count,
             old_history_chars=old_history_chars,
-            updated_at=time.time()
+            last_fingerprint=last_fingerprint,
+            updated_at=time.time(),
+            background=background
         )
         self._entries.move_to_end(key)
         if len(self._entries) > self._max_entries:
             self._entries.popitem(last=False)
 
+    def get_rolling(self, session_key: str) -> Optional[RollingSummary]:
+        return self._rolling.get(session_key)
+
+    def set_rolling(self, session_key: str, rolling: RollingSummary):
+        self._rolling[session_key] = rolling
+        self._rolling.move_to_end(session_key)
+        if len(self._rolling) > self._max_entries:
+            self._rolling.popitem(last=False)
+
+
+def _sign_value(value, parts: list, refs: list):
+    cls = value.__class__
+    if cls is str:
+        parts.append(value)
+    elif cls is list:
+        parts.append(list)
+        parts.append(len(value))
+        parts.extend(map(id, value))
+        refs.extend(value)
+    elif cls is int or cls is float or cls is bool or value is None:
+        parts.append((cls, value))
+    else:
+        parts.append(id(value))
+        refs.append(value)
+
+
+def _entry_signature(msg: dict) -> Tuple[tuple, list]:
+    """历史条目的内容签名，返回 (签名, 签名引用的对象)
+
+    转换结果每次请求都经 copy_entry 复制消息层、context 层和 toolResults/toolUses 列表
+    （下游可能原地修改这几层），文本、工具结果、工具调用等内层对象在转换缓存中跨轮共享，且只会写时复制。
+    签名逐项展开复制的几层：字符串按值，其他标量带上类型（1 与 True 不同），内层对象按 id；
+    同一内容在不同请求中的副本得到相同的签名，原地修改过的外层也会得到不同的签名。
+    保存签名的缓存必须同时保存引用的对象，保证其中的 id 不会被复用。
+    """
+    parts = []
+    refs = []
+    for role, body in msg.items():
+        parts.append(role)
+        if body.__class__ is not dict:
+            _sign_value(body, parts, refs)
+            continue
+        for key, value in body.items():
+            parts.append(key)
+            if key == "userInputMessageContext" and value.__class__ is dict:
+                parts.append(dict)
+                parts.append(len(value))
+                for ctx_key, ctx_value in value.items():
+                    parts.append(ctx_key)
+                    _sign_value(ctx_value, parts, refs)
+            else:
+                _sign_value(value, parts, refs)
+    return tuple(parts), refs
+
+
+def _with_tool_results(msg: dict, results: list) -> dict:
+    """写时复制：返回 toolResults 替换为 results 的新条目"""
+    user = msg["userInputMessage"]
+    ctx = user["userInputMessageContext"]
+    return {
+        **msg,
+        "userInputMessage": {**user, "userInputMessageContext": {**ctx, "toolResults": results}},
+    }
+
+
+class MessageSizeCache:
+    """单条历史消息的 JSON 长度缓存（按内容签名）
+
+    转换缓存让同一会话的历史内容在多轮请求间共享，按签名查找即可跳过重复序列化。
+    条目引用消息的内层对象，按条目数和消息字节数双重限制，超出时淘汰最久未用的条目。
+    """
+
+    def __init__(self, max_entries: int = 50000, max_bytes: int = 64 * 1024 * 1024):
+        self._entries: "OrderedDict[tuple, Tuple[list, int]]" = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def size(self, msg: dict) -> int:
+        """消息序列化后的字符数"""
+        key, refs = _entry_signature(msg)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        size = len(jsonfast.dumps(msg))
+        self._entries[key] = (refs, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= evicted
+        return size
+
+    def prefix_sums(self, history: List[dict]) -> List[int]:
+        """前缀和：sums[i] 为前 i 条消息的字符数之和"""
+        sums = [0]
+        total = 0
+        for msg in history:
+            total += self.size(msg)
+            sums.append(total)
+        return sums
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / total * 100:.1f}%" if total else "0.0%",
+        }
+
+
+message_sizes = MessageSizeCache()
+
+
+class ToolResultCompactor:
+    """旧工具结果压缩（写时复制，按原条目的内容签名缓存压缩后的工具结果）
+
+    长 Agent 会话的历史大部分是 toolResults（读文件、命令输出），每轮都原样带上。
+    早于最近 N 个用户轮次的工具结果按工具名裁剪到字符预算内（保留首尾，中间插入省略标记），
+    只改写结果文本，toolUseId、status 和对应的 toolUses 保持不变，fix_history_alternation 的配对不受影响。
+    压缩后的工具结果按原条目签名缓存，后续轮次复用同一批对象，长度、token 缓存都能命中；
+    缓存按条目数和原工具结果的字符数双重限制。
+    """
+
+    def __init__(self, max_entries: int = 20000, max_bytes: int = 64 * 1024 * 1024):
+        self._entries: "OrderedDict[tuple, Tuple[list, tuple, Optional[list], int]]" = OrderedDict()
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.compacted_results = 0
+        self.chars_saved = 0
+        self.hits = 0
+
+    @staticmethod
+    def trim_text(text: str, budget: int) -> str:
+        """保留首尾，裁剪到 budget 字符左右"""
+        if len(text) <= budget:
+            return text
+        head = budget * 2 // 3
+        tail = budget - head
+        omitted = len(text) - head - tail
+        return f"{text[:head]}\n...[已省略 {omitted} 字符]...\n{text[len(text) - tail:]}"
+
+    def _compact_results(
+        self, results: list, names: Dict[str, str], budgets: Dict[str, int], default_budget: int
+    ) -> Tuple[Optional[list], int]:
+        """返回 (压缩后的 toolResults, 原结果文本字符数)；无需压缩时 toolResults 为 None"""
+        new_results = None
+        chars = 0
+        for i, result in enumerate(results):
+            content = result.get("content")
+            if not isinstance(content, list):
+                continue
+            budget = budgets.get(names.get(result.get("toolUseId"), ""), default_budget)
+            new_content = None
+            for j, item in enumerate(content):
+                if not isinstance(item, dict):
+                    continue
+                if "text" in item and isinstance(item["text"], str):
+                    text = item["text"]
+                elif "json" in item:
+                    text = jsonfast.dumps(item["json"])
+                else:
+                    continue
+                chars += len(text)
+                remaining = max(budget, 0)
+                budget -= len(text)
+                if len(text) <= remaining:
+                    continue
+                trimmed = self.trim_text(text, remaining)
+                self.chars_saved += len(text) - len(trimmed)
+                if new_content is None:
+                    new_content = list(content)
+                new_content[j] = {"text": trimmed}
+            if new_content is not None:
+                if new_results is None:
+                    new_results = list(results)
+                new_results[i] = {**result, "content": new_content}
+                self.compacted_results += 1
+        return new_results, chars
+
+    def compact(self, msg: dict, names: Dict[str, str], budgets: Dict[str, int], default_budget: int) -> dict:
+        """返回压缩后的条目（不需要压缩时返回原条目）"""
+        user = msg.get("userInputMessage")
+        if not isinstance(user, dict):
+            return msg
+        ctx = user.get("userInputMessageContext")
+        results = ctx.get("toolResults") if isinstance(ctx, dict) else None
+        if not results:
+            return msg
+
+        signature = (default_budget, tuple(sorted(budgets.items())))
+        key, refs = _entry_signature(msg)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == signature:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            new_results = entry[2]
+        else:
+            new_results, chars = self._compact_results(results, names, budgets, default_budget)
+            if entry is not None:
+                self._bytes -= entry[3]
+            self._entries[key] = (refs, signature, new_results, chars)
+            self._entries.move_to_end(key)
+            self._bytes += chars
+            while self._entries and (len(self._entries) > self._max_entries or self._bytes > self._max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[3]
+
+        # 每次返回新的外层条目（下游可能原地修改），压缩后的工具结果对象跨轮共享
+        return msg if new_results is None else _with_tool_results(msg, list(new_results))
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "compacted_results": self.compacted_results,
+            "chars_saved": self.chars_saved,
+            "hits": self.hits,
+        }
+
+
+tool_compactor = ToolResultCompactor()
+
+
+class _DedupSession:
+    """单个会话的去重状态：已扫描历史条目的签名及其中大块内容的哈希"""
+    __slots__ = ("messages", "refs", "sizes", "blobs", "outputs", "bytes")
+
+    def __init__(self):
+        self.messages: List[tuple] = []
+        self.refs: List[list] = []
+        self.sizes: List[int] = []
+        # 每条消息中的大块内容：[(结果序号, 内容序号, 哈希, 字节数, toolUseId)]
+        self.blobs: List[list] = []
+        # 消息序号 -> (被替换的位置, 替换后的 toolResults)
+        self.outputs: Dict[int, Tuple[tuple, list]] = {}
+        self.bytes = 0
+
+
+class BlobDeduper:
+    """历史中重复大块内容的去重（按内容哈希，保留最后一次出现）
+
+    Agent 经常多次读取同一个文件、重复执行同一条命令，相同的多 KB toolResults 文本
+    在转换后的历史中反复出现。较早的副本替换为一条简短的引用说明，最后一次出现
+    （包括当前消息的 toolResults）保持原样。
+    每个会话缓存已扫描条目的签名和哈希，后续轮次只对新增的消息计算哈希；
+    替换后的工具结果按会话缓存，重复内容没有变化时复用同一批对象。
+    会话按数量和所引用历史的字节数双重限制，超出时淘汰最久未用的会话。
+    """
+
+    def __init__(self, max_sessions: int = 256, max_bytes: int = 128 * 1024 * 1024):
+        self._sessions: "OrderedDict[str, _DedupSession]" = OrderedDict()
+        self._max_sessions = max_sessions
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self.requests = 0
+        self.replaced = 0
+        self.bytes_saved = 0
+        self.hashed_messages = 0
+        self.reused_messages = 0
+
+    @staticmethod
+    def _blob_hash(text: str) -> Tuple[str, int]:
+        data = text.encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).hexdigest(), len(data)
+
+    def _scan(self, msg: dict, min_chars: int) -> list:
+        user = msg.get("userInputMessage")
+        ctx = user.get("userInputMessageContext") if isinstance(user, dict) else None
+        results = ctx.get("toolResults") if isinstance(ctx, dict) else None
+        return self._scan_results(results, min_chars) if results else []
+
+    def _scan_results(self, results: list, min_chars: int) -> list:
+        blobs = []
+        for i, result in enumerate(results):
+            content = result.get("content") if isinstance(result, dict) else None
+            if not isinstance(content, list):
+                continue
+            for j, item in enumerate(content):
+                text = item.get("text") if isinstance(item, dict) else None
+                if isinstance(text, str) and len(text) >= min_chars:
+                    digest, size = self._blob_hash(text)
+                    blobs.append((i, j, digest, size, result.get("toolUseId", "")))
+        return blobs
+
+    def _session(self, session_key: Optional[str]) -> _DedupSession:
+        if not session_key:
+            return _DedupSession()
+        session = self._sessions.get(session_key)
+        if session is None:
+            session = self._sessions[session_key] = _DedupSession()
+            if len(self._sessions) > self._max_sessions:
+                _, evicted = self._sessions.popitem(last=False)
+                self._bytes -= evicted.bytes
+        self._sessions.move_to_end(session_key)
+        return session
+
+    def _evict(self, session_key: Optional[str], session: _DedupSession):
+        """超出字节上限时淘汰最久未用的会话（当前会话最后淘汰）"""
+        if not session_key or self._sessions.get(session_key) is not session:
+            return
+        while self._bytes > self._max_bytes and self._sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            self._bytes -= evicted.bytes
+
+    def dedup(
+        self,
+        history: List[dict],
+        session_key: Optional[str] = None,
+        tool_results: list = None,
+        min_chars: int = 1024
+    ) -> Tuple[List[dict], int]:
+        """返回 (去重后的历史, 节省的字节数)，不修改传入的 history"""
+        self.requests += 1
+        session = self._session(session_key)
+        tracked = bool(session_key)
+
+        # 复用签名仍然一致的前缀（同一会话的历史内容在多轮间共享，逐项比较很快）
+        signatures = [_entry_signature(msg) for msg in history]
+        keep = 0
+        limit = min(len(session.messages), len(history))
+        while keep < limit and session.messages[keep] == signatures[keep][0]:
+            keep += 1
+        if keep < len(session.messages):
+            dropped = sum(session.sizes[keep:])
+            session.bytes -= dropped
+            if tracked:
+                self._bytes -= dropped
+            del session.messages[keep:]
+            del session.refs[keep:]
+            del session.sizes[keep:]
+            del session.blobs[keep:]
+            for index in [i for i in session.outputs if i >= keep]:
+                del session.outputs[index]
+        self.reused_messages += keep
+        for index in range(keep, len(history)):
+            msg = history[index]
+            size = message_sizes.size(msg) if tracked else 0
+            session.messages.append(signatures[index][0])
+            session.refs.append(signatures[index][1])
+            session.sizes.append(size)
+            session.blobs.append(self._scan(msg, min_chars))
+            session.bytes += size
+            if tracked:
+                self._bytes += size
+            self.hashed_messages += 1
+
+        # 每个哈希最后一次出现的位置（当前消息的 toolResults 在历史之后）
+        latest: Dict[str, str] = {}
+        for blob in self._scan_results(tool_results, min_chars) if tool_results else []:
+            latest[blob[2]] = blob[4]
+        result = None
+        saved = 0
+        for index in range(len(history) - 1, -1, -1):
+            blobs = session.blobs[index]
+            if not blobs:
+                continue
+            replace = []
+            for i, j, digest, size, tool_use_id in reversed(blobs):
+                later = latest.get(digest)
+                if later is None:
+                    latest[digest] = tool_use_id
+                else:
+                    replace.append((i, j, digest, size, later))
+            if not replace:
+                session.outputs.pop(index, None)
+                continue
+            replace.reverse()
+            positions = tuple(replace)
+            cached = session.outputs.get(index)
+            if cached is not None and cached[0] == positions:
+                new_results = cached[1]
+            else:
+                new_results = self._replace(history[index], replace)
+                session.outputs[index] = (positions, new_results)
+                self.replaced += len(replace)
+            if result is None:
+                result = list(history)
+            # 每次返回新的外层条目（下游可能原地修改），替换后的工具结果对象跨轮共享
+            result[index] = _with_tool_results(history[index], list(new_results))
+            saved += sum(size - len(self._note(size, later).encode("utf-8")) for _, _, _, size, later in replace)
+
+        self._evict(session_key, session)
+        self.bytes_saved += saved
+        return (history if result is None else result), saved
+
+    @staticmethod
+    def _note(size: int, later_tool_use_id: str) -> str:
+        return f"[内容与后面的工具结果 {later_tool_use_id} 完全相同，已省略 {size} 字节]"
+
+    def _replace(self, msg: dict, replace: list) -> list:
+        """写时复制：返回把指定位置的文本替换为引用说明后的 toolResults"""
+        results = list(msg["userInputMessage"]["userInputMessageContext"]["toolResults"])
+        for i, j, _, size, later in replace:
+            result = results[i]
+            content = list(result["content"])
+            content[j] = {"text": self._note(size, later)}
+            results[i] = {**result, "content": content}
+        return results
+
+    def clear(self):
+        self._sessions.clear()
+        self._bytes = 0
+
+    def get_stats(self) -> dict:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "requests": self.requests,
+            "replaced_blobs": self.replaced,
+            "bytes_saved": self.bytes_saved,
+            "hashed_messages": self.hashed_messages,
+            "reused_messages": self.reused_messages,
+        }
+
+
+blob_deduper = BlobDeduper()
+
+
+def image_payload_bytes(image: dict) -> int:
+    """图片解码后的字节数（按 base64 长度估算）"""
+    data = (image.get("source") or {}).get("bytes") or ""
+    return len(data) * 3 // 4
+
+
+class ImageStats:
+    """每次请求发送的图片统计"""
+
+    def __init__(self):
+        self.requests = 0
+        self.images_sent = 0
+        self.bytes_sent = 0
+        self.max_request_bytes = 0
+        self.over_budget = 0
+        self.stripped = 0
+
+    def record(self, count: int, size: int, over_budget: int = 0):
+        self.requests += 1
+        self.images_sent += count
+        self.bytes_sent += size
+        self.max_request_bytes = max(self.max_request_bytes, size)
+        self.over_budget += over_budget
+
+    def get_stats(self) -> dict:
+        return {
+            "requests_with_images": self.requests,
+            "images_sent": self.images_sent,
+            "bytes_sent": self.bytes_sent,
+            "avg_request_bytes": round(self.bytes_sent / self.requests) if self.requests else 0,
+            "max_request_bytes": self.max_request_bytes,
+            "dropped_over_budget": self.over_budget,
+            "stripped_old_turns": self.stripped,
+        }
+
+
+image_stats = ImageStats()
+
 
 class TruncateStrategy(str, Enum):
     """截断策略"""
@@ -106,12 +665,37 @@ class HistoryConfig:
     # 预估配置
     estimate_threshold: int = 180000  # 预估阈值（字符数）
     chars_per_token: float = 3.0      # 每 token 约等于多少字符
+    estimate_threshold_tokens: int = 0  # 预估阈值（tokens），0 表示按 estimate_threshold / chars_per_token 换算
+
+    # 学习上限（按模型记录超限请求大小，发送前预先截断）
+    learned_limit_enabled: bool = True    # 是否按学到的上限预先截断
+    learned_limit_margin: float = 0.9     # 截断目标 = 学到的上限 * margin
 
     # 摘要缓存（保守策略）
     summary_cache_enabled: bool = True          # 是否启用摘要缓存
     summary_cache_min_delta_messages: int = 3   # 旧历史新增 N 条后刷新摘要
     summary_cache_min_delta_chars: int = 4000   # 旧历史新增字符数阈值
     summary_cache_max_age_seconds: int = 180    # 摘要最大复用时间
+    summary_store_enabled: bool = True          # 按内容持久化摘要（跨会话、跨重启复用）
+    summary_rolling_enabled: bool = True        # 滚动摘要：只把新移出的消息与上次摘要合并
+    summary_rolling_max_depth: int = 8          # 连续增量合并 N 次后重新完整摘要一次
+    summary_wait_timeout: float = 90            # 等待摘要（含其他请求进行中的同一摘要）的最长时间
+    summary_prefetch_enabled: bool = True       # 接近阈值时在后台预先生成下一轮的摘要
+    summary_prefetch_ratio: float = 0.8         # 达到阈值的该比例时开始预生成
+
+    # 重复内容去重（在工具结果压缩之前执行）
+    dedup_enabled: bool = True                  # 是否把重复出现的大块工具结果替换为引用
+    dedup_min_chars: int = 1024                 # 参与去重的最小文本长度
+
+    # 旧工具结果压缩（在截断、摘要之前执行）
+    tool_compact_enabled: bool = True           # 是否压缩旧的工具结果
+    tool_compact_keep_turns: int = 8            # 最近 N 个用户轮次的工具结果保持原样
+    tool_compact_default_budget: int = 8000     # 每个旧工具结果保留的字符数
+    tool_compact_budgets: Dict[str, int] = field(default_factory=dict)  # 按工具名覆盖，如 {"Read": 4000}
+
+    # 图片
+    image_max_bytes: int = 5 * 1024 * 1024      # 单次请求的图片总字节数上限（解码后），0 表示不限制
+    image_keep_turns: int = 2                   # 只发送最近 N 个用户轮次的图片（Responses 会话），0 表示不限制
 
     # 是否添加截断警告
     add_warning_header: bool = True
@@ -128,10 +712,27 @@ class HistoryConfig:
             "max_retries": self.max_retries,
             "estimate_threshold": self.estimate_threshold,
             "chars_per_token": self.chars_per_token,
+            "estimate_threshold_tokens": self.estimate_threshold_tokens,
+            "learned_limit_enabled": self.learned_limit_enabled,
+            "learned_limit_margin": self.learned_limit_margin,
             "summary_cache_enabled": self.summary_cache_enabled,
             "summary_cache_min_delta_messages": self.summary_cache_min_delta_messages,
             "summary_cache_min_delta_chars": self.summary_cache_min_delta_chars,
             "summary_cache_max_age_seconds": self.summary_cache_max_age_seconds,
+            "summary_store_enabled": self.summary_store_enabled,
+            "summary_rolling_enabled": self.summary_rolling_enabled,
+            "summary_rolling_max_depth": self.summary_rolling_max_depth,
+            "summary_wait_timeout": self.summary_wait_timeout,
+            "summary_prefetch_enabled": self.summary_prefetch_enabled,
+            "summary_prefetch_ratio": self.summary_prefetch_ratio,
+            "dedup_enabled": self.dedup_enabled,
+            "dedup_min_chars": self.dedup_min_chars,
+            "tool_compact_enabled": self.tool_compact_enabled,
+            "tool_compact_keep_turns": self.tool_compact_keep_turns,
+            "tool_compact_default_budget": self.tool_compact_default_budget,
+            "tool_compact_budgets": dict(self.tool_compact_budgets),
+            "image_max_bytes": self.image_max_bytes,
+            "image_keep_turns": self.image_keep_turns,
             "add_warning_header": self.add_warning_header,
         }
     
@@ -149,10 +750,27 @@ class HistoryConfig:
             max_retries=data.get("max_retries", 2),
             estimate_threshold=data.get("estimate_threshold", 180000),
             chars_per_token=data.get("chars_per_token", 3.0),
+            estimate_threshold_tokens=data.get("estimate_threshold_tokens", 0),
+            learned_limit_enabled=data.get("learned_limit_enabled", True),
+            learned_limit_margin=data.get("learned_limit_margin", 0.9),
             summary_cache_enabled=data.get("summary_cache_enabled", True),
             summary_cache_min_delta_messages=data.get("summary_cache_min_delta_messages", 3),
             summary_cache_min_delta_chars=data.get("summary_cache_min_delta_chars", 4000),
             summary_cache_max_age_seconds=data.get("summary_cache_max_age_seconds", 180),
+            summary_store_enabled=data.get("summary_store_enabled", True),
+            summary_rolling_enabled=data.get("summary_rolling_enabled", True),
+            summary_rolling_max_depth=data.get("summary_rolling_max_depth", 8),
+            summary_wait_timeout=data.get("summary_wait_timeout", 90),
+            summary_prefetch_enabled=data.get("summary_prefetch_enabled", True),
+            summary_prefetch_ratio=data.get("summary_prefetch_ratio", 0.8),
+            dedup_enabled=data.get("dedup_enabled", True),
+            dedup_min_chars=data.get("dedup_min_chars", 1024),
+            tool_compact_enabled=data.get("tool_compact_enabled", True),
+            tool_compact_keep_turns=data.get("tool_compact_keep_turns", 8),
+            tool_compact_default_budget=data.get("tool_compact_default_budget", 8000),
+            tool_compact_budgets=dict(data.get("tool_compact_budgets") or {}),
+            image_max_bytes=data.get("image_max_bytes", 5 * 1024 * 1024),
+            image_keep_turns=data.get("image_keep_turns", 2),
             add_warning_header=data.get("add_warning_header", True),
         )
 
@@ -168,6 +786,10 @@ class HistoryManager:
         self._truncated = False
         self._truncate_info = ""
         self.cache_key = cache_key
+        self._sizes: Optional[Tuple[List[dict], int, List[int]]] = None
+        self.source_history: Optional[List[dict]] = None  # 预处理前的完整历史（后台摘要按它预测下一轮）
+        self.dedup_saved_bytes = 0  # 本次请求去重节省的字节数
+        self.image_bytes = 0        # 本次请求发送的图片字节数
     
     @property
     def was_truncated(self) -> bool:
@@ -183,6 +805,7 @@ class HistoryManager:
         """重置状态"""
         self._truncated = False
         self._truncate_info = ""
+        self.dedup_saved_bytes = 0
 
     def set_cache_key(self, cache_key: Optional[str]):
         """设置摘要缓存 key"""
@@ -192,26 +815,257 @@ class HistoryManager:
         if not self.cache_key:
             return None
         return f"{self.cache_key}:{target_count}"
+
+    def get_session_summary(
+        self,
+        old_history: List[dict],
+        target_count: int,
+        foreground: bool = True,
+        max_uncovered: Optional[int] = None
+    ) -> Optional[Tuple[str, List[dict]]]:
+        """查找本会话旧消息片段（保留最近 target_count 条之前的部分）的可复用摘要
+
+        摘要覆盖 old_history 的前缀（条数和最后一条的指纹一致）、且之后新增的消息未超过阈值时复用。
+        返回 (摘要, 未被摘要覆盖的旧消息)，调用方把后者放回最近消息之前，不会丢失内容；
+        max_uncovered 为调用方还能容纳的消息条数，超出时不复用（由 generate_summary 增量合并）。
+        """
+        cache_key = self._summary_cache_key(target_count)
+        if not cache_key or not self.config.summary_cache_enabled:
+            return None
+        entry = _summary_cache.get(
+            cache_key,
+            len(old_history),
+            self.history_chars(old_history),
+            self.config.summary_cache_min_delta_messages,
+            self.config.summary_cache_min_delta_chars,
+            self.config.summary_cache_max_age_seconds,
+            foreground=foreground
+        )
+        if entry is None:
+            return None
+        covered = entry.old_history_count
+        if _message_fingerprint(old_history[covered - 1]) != entry.last_fingerprint:
+            return None
+        # 未覆盖部分以 assistant 开头时带上前一条 user 消息，保持交替（_build_summary_history 会跳过开头的 assistant）
+        start = covered
+        if start < len(old_history) and "assistantResponseMessage" in old_history[start]:
+            start -= 1
+        if max_uncovered is not None and len(old_history) - start > max_uncovered:
+            return None
+        return entry.summary, old_history[start:]
+
+    def set_session_summary(self, old_history: List[dict], target_count: int, summary: str, background: bool = False):
+        """缓存本会话旧消息片段的摘要"""
+        cache_key = self._summary_cache_key(target_count)
+        if not cache_key or not self.config.summary_cache_enabled:
+            return
+        _summary_cache.set(
+            cache_key, summary, len(old_history), self.history_chars(old_history),
+            _message_fingerprint(old_history[-1]), background=background
+        )
+
+    def summary_prefetch_plan(self, history: List[dict], user_content: str = "") -> Optional[Tuple[int, List[dict]]]:
+        """预测下一轮需要的摘要，返回 (target_count, 下一轮要摘要的旧消息片段)
+
+        下一轮历史约为本轮历史 + 本轮用户消息和回复两条，
+        被摘要的旧消息 next[:-target_count] 全部落在本轮历史内；判定顺序与 pre_process_async 一致。
+        """
+        if not self.config.summary_prefetch_enabled or not self.cache_key or not self.config.summary_cache_enabled:
+            return None
+        if not history:
+            return None
+        ratio = self.config.summary_prefetch_ratio
+        next_count = len(history) + 2
+        strategies = self.config.strategies
+
+        target_count = None
+        if (
+            TruncateStrategy.ERROR_RETRY in strategies
+            and self.estimate_request_tokens(history, user_content) > self.token_threshold * ratio
+        ):
+            target_count = self.config.retry_max_messages
+        elif (
+            TruncateStrategy.SMART_SUMMARY in strategies
+            and self.history_chars(history) > self.config.summary_threshold * ratio
+        ):
+            target_count = self.config.summary_keep_recent
+        elif TruncateStrategy.AUTO_TRUNCATE in strategies and self.config.max_messages > 2 and (
+            next_count > self.config.max_messages
+            or self.history_chars(history) > self.config.max_chars * ratio
+        ):
+            target_count = min(next_count - 1, self.config.max_messages - 2)
+
+        if not target_count or next_count - target_count <= 0 or next_count - target_count > len(history):
+            return None
+        return target_count, history[:next_count - target_count]
     
     def estimate_tokens(self, text: str) -> int:
-        """估算 token 数量"""
-        return int(len(text) / self.config.chars_per_token)
+        """估算 token 数量（近似 BPE 分词，长文本按内容缓存）"""
+        return token_counter.count(text)
+
+    def estimate_request_tokens(self, history: List[dict], user_content: str = "") -> int:
+        """估算历史 + 当前消息的 token 数（每条历史的计数按内容缓存，重复轮次只计新增消息）"""
+        return token_counter.count_history(history) + token_counter.count(user_content or "")
+
+    @property
+    def token_threshold(self) -> int:
+        """预估阈值（tokens）"""
+        if self.config.estimate_threshold_tokens > 0:
+            return self.config.estimate_threshold_tokens
+        return int(self.config.estimate_threshold / self.config.chars_per_token)
+
+    def truncate_by_tokens(self, history: List[dict], max_tokens: int) -> List[dict]:
+        """按 token 数截断（从后往前保留）"""
+        sums = [0]
+        for msg in history:
+            sums.append(sums[-1] + token_counter.count_entry(msg))
+        total_tokens = sums[-1]
+        if total_tokens <= max_tokens:
+            return history
+
+        start = self._suffix_start(sums, max_tokens)
+        current_tokens = total_tokens - sums[start]
+        result = history[start:]
+        if len(result) < len(history):
+            self._truncated = True
+            self._truncate_info = f"按 token 数截断: {len(history)} -> {len(result)} 条消息 ({total_tokens} -> {current_tokens} tokens)"
+        return result
     
+    def fit_learned_limit(
+        self,
+        history: List[dict],
+        user_content: str,
+        model: str,
+        tools: list = None,
+        images: list = None,
+        tool_results: list = None
+    ) -> List[dict]:
+        """按该模型学到的上限预先截断，避免必然超限的上游往返
+
+        只在模型有过超限记录时生效；当前消息、工具定义和图片无法截断，从历史预算中扣除。
+        """
+        if not self.config.learned_limit_enabled or not history:
+            return history
+        limit = limit_predictor.predict_limit(model)
+        if not limit:
+            return history
+
+        budget = int(limit * self.config.learned_limit_margin)
+        size = measure_request(history, user_content, tools, images, tool_results)
+        if size.tokens <= budget:
+            return history
+
+        fixed_tokens = size.tokens - token_counter.count_history(history)
+        result = self.truncate_by_tokens(history, max(0, budget - fixed_tokens))
+        if len(result) < len(history):
+            self._truncate_info = (
+                f"按学习上限截断 ({model} 上限 {limit} tokens): {len(history)} -> {len(result)} 条消息 "
+                f"({size.tokens} -> {fixed_tokens + token_counter.count_history(result)} tokens)"
+            )
+        return result
+
+    def _prefix_sums(self, history: List[dict]) -> List[int]:
+        """历史消息字符数前缀和；同一列表（长度未变）重复查询直接复用"""
+        cached = self._sizes
+        if cached is not None and cached[0] is history and cached[1] == len(history):
+            return cached[2]
+        sums = message_sizes.prefix_sums(history)
+        self._sizes = (history, len(history), sums)
+        return sums
+
+    def history_chars(self, history: List[dict], end: Optional[int] = None) -> int:
+        """history[:end] 序列化后的字符数，等于 len(json.dumps(history[:end]))（紧凑格式）"""
+        sums = self._prefix_sums(history)
+        count = len(history) if end is None else len(range(len(history))[:end])
+        return sums[count] + max(count - 1, 0) + 2
+
+    @staticmethod
+    def _suffix_start(sums: List[int], budget: int) -> int:
+        """二分查找最长的、总和不超过 budget 的后缀起点（至少保留最后一条）"""
+        start = bisect_left(sums, sums[-1] - budget)
+        return min(start, len(sums) - 2)
+
     def estimate_history_size(self, history: List[dict]) -> Tuple[int, int]:
         """估算历史消息大小
         
         Returns:
             (message_count, char_count)
         """
-        char_count = len(json.dumps(history, ensure_ascii=False))
-        return len(history), char_count
+        return len(history), self.history_chars(history)
 
     def estimate_request_chars(self, history: List[dict], user_content: str = "") -> Tuple[int, int, int]:
         """估算请求字符数 (history_chars, user_chars, total_chars)"""
-        history_chars = len(json.dumps(history, ensure_ascii=False))
+        history_chars = self.history_chars(history)
         user_chars = len(user_content or "")
         return history_chars, user_chars, history_chars + user_chars
     
+    def dedup_blobs(self, history: List[dict], tool_results: list = None) -> List[dict]:
+        """把历史中重复出现的大块工具结果替换为引用（保留最后一次出现，不修改传入的 history）"""
+        if not self.config.dedup_enabled or not history:
+            return history
+        result, saved = blob_deduper.dedup(history, self.cache_key, tool_results, self.config.dedup_min_chars)
+        self.dedup_saved_bytes = saved
+        return result
+
+    def limit_images(self, images: Optional[list], user_content: str) -> Tuple[Optional[list], str]:
+        """按 image_max_bytes 限制本次请求的图片，优先保留靠后的图片
+
+        返回 (images, user_content)，超出预算的图片在 user_content 末尾留一条说明。
+        """
+        self.image_bytes = 0
+        if not images:
+            return images, user_content
+        budget = self.config.image_max_bytes
+        kept = []
+        total = 0
+        for image in reversed(images):
+            size = image_payload_bytes(image)
+            if budget > 0 and total + size > budget:
+                continue
+            kept.append(image)
+            total += size
+        kept.reverse()
+        dropped = len(images) - len(kept)
+        if dropped:
+            print(f"[HistoryManager] 图片超出预算 {budget} 字节，省略 {dropped} 张")
+            user_content = f"{user_content}\n\n[已省略 {dropped} 张图片：超出单次请求的图片大小上限]"
+        self.image_bytes = total
+        image_stats.record(len(kept), total, dropped)
+        return kept, user_content
+
+    def compact_tool_results(self, history: List[dict]) -> List[dict]:
+        """压缩最近 tool_compact_keep_turns 个用户轮次之前的工具结果（不修改传入的 history）"""
+        if not self.config.tool_compact_enabled or not history:
+            return history
+        keep = max(self.config.tool_compact_keep_turns, 0)
+        cut = len(history)
+        for i in range(len(history) - 1, -1, -1):
+            if keep == 0:
+                break
+            if "userInputMessage" in history[i]:
+                keep -= 1
+                cut = i
+        if keep > 0:
+            return history
+
+        names: Dict[str, str] = {}
+        result = None
+        for i in range(cut):
+            msg = history[i]
+            assistant = msg.get("assistantResponseMessage")
+            if isinstance(assistant, dict):
+                for tool_use in assistant.get("toolUses") or []:
+                    names[tool_use.get("toolUseId")] = tool_use.get("name", "")
+                continue
+            compacted = tool_compactor.compact(
+                msg, names, self.config.tool_compact_budgets, self.config.tool_compact_default_budget
+            )
+            if compacted is not msg:
+                if result is None:
+                    result = list(history)
+                result[i] = compacted
+        return history if result is None else result
+
     def truncate_by_count(self, history: List[dict], max_count: int) -> List[dict]:
         """按消息数量截断"""
         if len(history) <= max_count:
@@ -224,22 +1078,16 @@ class HistoryManager:
         return truncated
     
     def truncate_by_chars(self, history: List[dict], max_chars: int) -> List[dict]:
-        """按字符数截断"""
-        total_chars = len(json.dumps(history, ensure_ascii=False))
+        """按字符数截断（从后往前保留，前缀和上二分查找）"""
+        total_chars = self.history_chars(history)
         if total_chars <= max_chars:
             return history
         
         original_count = len(history)
-        # 从后往前保留
-        result = []
-        current_chars = 0
-        
-        for msg in reversed(history):
-            msg_chars = len(json.dumps(msg, ensure_ascii=False))
-            if current_chars + msg_chars > max_chars and result:
-                break
-            result.insert(0, msg)
-            current_chars += msg_chars
+        sums = self._prefix_sums(history)
+        start = self._suffix_start(sums, max_chars)
+        result = history[start:]
+        current_chars = sums[-1] - sums[start]
         
         if len(result) < original_count:
             self._truncated = True
@@ -458,12 +1306,30 @@ class HistoryManager:
         if not history:
             return None
         
-        formatted = self._format_history_for_summary(history)
+        # 本会话已有覆盖 history 前缀的滚动摘要时，只摘要新移出的消息
+        previous = self._rolling_summary_for(history)
+        new_messages = history[previous.covered_count:] if previous else history
+        
+        formatted = self._format_history_for_summary(new_messages)
         # 限制输入长度
         if len(formatted) > 10000:
             formatted = formatted[:10000] + "\n...(truncated)"
         
-        prompt = f"""请简洁地总结以下对话历史的关键信息，包括：
+        if previous:
+            prompt = f"""以下是早期对话的摘要，以及其后新增的对话历史。请合并两者，输出更新后的完整摘要，包括：
+1. 用户的主要目标和需求
+2. 已完成的重要操作
+3. 当前的工作状态和上下文
+
+已有摘要：
+{previous.summary}
+
+新增对话历史：
+{formatted}
+
+请用中文输出摘要，控制在 {self.config.summary_max_length} 字符以内："""
+        else:
+            prompt = f"""请简洁地总结以下对话历史的关键信息，包括：
 1. 用户的主要目标和需求
 2. 已完成的重要操作
 3. 当前的工作状态和上下文
@@ -473,14 +1339,64 @@ class HistoryManager:
 
 请用中文输出摘要，控制在 {self.config.summary_max_length} 字符以内："""
         
-        try:
-            summary = await api_caller(prompt)
-            if summary and len(summary) > self.config.summary_max_length:
-                summary = summary[:self.config.summary_max_length] + "..."
-            return summary
-        except Exception as e:
-            print(f"[HistoryManager] 生成摘要失败: {e}")
+        # 相同的消息片段得到相同的提示词，直接复用已持久化的摘要
+        key = summary_key(prompt)
+        if self.config.summary_store_enabled:
+            cached = await asyncio.to_thread(summary_store.get, key)
+            if cached:
+                summary_stats.store_hits += 1
+                print(f"[HistoryManager] 摘要缓存命中: {len(history)} 条消息")
+                self._remember_rolling(history, cached, previous)
+                return cached
+        
+        async def call_summary() -> Optional[str]:
+            start = time.time()
+            summary = None
+            try:
+                summary = await api_caller(prompt)
+                if summary and len(summary) > self.config.summary_max_length:
+                    summary = summary[:self.config.summary_max_length] + "..."
+                if summary and self.config.summary_store_enabled:
+                    await asyncio.to_thread(summary_store.set, key, summary)
+                return summary
+            except Exception as e:
+                print(f"[HistoryManager] 生成摘要失败: {e}")
+                return None
+            finally:
+                summary_stats.record(previous is not None, len(prompt), (time.time() - start) * 1000, bool(summary))
+        
+        # 其他请求正在生成同一摘要时等待其结果，不重复调用
+        if summary_flights.in_flight(key):
+            print(f"[HistoryManager] 等待进行中的相同摘要: {len(history)} 条消息")
+        summary = await summary_flights.do(key, call_summary, self.config.summary_wait_timeout)
+        if summary:
+            self._remember_rolling(history, summary, previous)
+        return summary
+
+    def _rolling_summary_for(self, history: List[dict]) -> Optional[RollingSummary]:
+        """本会话覆盖 history 真前缀的滚动摘要（超过最大合并次数时返回 None，重新完整摘要）"""
+        if not self.config.summary_rolling_enabled or not self.cache_key:
             return None
+        rolling = _summary_cache.get_rolling(self.cache_key)
+        if rolling is None or rolling.depth >= self.config.summary_rolling_max_depth:
+            return None
+        covered = rolling.covered_count
+        if not 0 < covered < len(history):
+            return None
+        if _message_fingerprint(history[covered - 1]) != rolling.last_fingerprint:
+            return None
+        return rolling
+
+    def _remember_rolling(self, history: List[dict], summary: str, previous: Optional[RollingSummary]):
+        if not self.config.summary_rolling_enabled or not self.cache_key:
+            return
+        _summary_cache.set_rolling(self.cache_key, RollingSummary(
+            summary=summary,
+            covered_count=len(history),
+            last_fingerprint=_message_fingerprint(history[-1]),
+            updated_at=time.time(),
+            depth=previous.depth + 1 if previous else 1,
+        ))
     
     async def compress_with_summary(
         self, 
@@ -496,7 +1412,7 @@ class HistoryManager:
         Returns:
             压缩后的历史消息
         """
-        total_chars = len(json.dumps(history, ensure_ascii=False))
+        total_chars = self.history_chars(history)
         if total_chars <= self.config.summary_threshold:
             return history
         
@@ -508,8 +1424,19 @@ class HistoryManager:
         old_history = history[:-keep_recent]
         recent_history = history[-keep_recent:]
         
-        # 生成摘要
-        summary = await self.generate_summary(old_history, api_caller)
+        # 生成摘要（优先复用本会话缓存的摘要，未覆盖的旧消息放回最近消息之前）
+        # 之后还会按 max_messages 截断，放回的消息不能把摘要挤出去
+        room = None
+        if TruncateStrategy.AUTO_TRUNCATE in self.config.strategies:
+            room = max(self.config.max_messages - keep_recent - 2, 0)
+        cached = self.get_session_summary(old_history, keep_recent, max_uncovered=room)
+        if cached:
+            summary, uncovered = cached
+            recent_history = uncovered + recent_history
+        else:
+            summary = await self.generate_summary(old_history, api_caller)
+            if summary:
+                self.set_session_summary(old_history, keep_recent, summary)
         
         if not summary:
             # 摘要失败，回退到简单截断
@@ -545,9 +1472,15 @@ class HistoryManager:
         old_history = history[:-keep_recent]
         recent_history = history[-keep_recent:]
 
-        summary = await self.generate_summary(old_history, api_caller)
-        if not summary:
-            return history
+        # 结果正好 max_messages 条，只复用完整覆盖旧消息的摘要
+        cached = self.get_session_summary(old_history, keep_recent, max_uncovered=0)
+        if cached:
+            summary = cached[0]
+        else:
+            summary = await self.generate_summary(old_history, api_caller)
+            if not summary:
+                return history
+            self.set_session_summary(old_history, keep_recent, summary)
 
         result = self._build_summary_history(summary, recent_history, "自动截断前摘要结构")
 
@@ -592,21 +1525,10 @@ class HistoryManager:
         if api_caller:
             old_history = history[:-target_count]
             recent_history = history[-target_count:]
-            cache_key = self._summary_cache_key(target_count)
-            old_count = len(old_history)
-            old_chars = len(json.dumps(old_history, ensure_ascii=False))
-            cached = None
-            if cache_key and self.config.summary_cache_enabled:
-                cached = _summary_cache.get(
-                    cache_key,
-                    old_count,
-                    old_chars,
-                    self.config.summary_cache_min_delta_messages,
-                    self.config.summary_cache_min_delta_chars,
-                    self.config.summary_cache_max_age_seconds
-                )
+            cached = self.get_session_summary(old_history, target_count)
             if cached:
-                result = self._build_summary_history(cached, recent_history, "错误重试摘要缓存结构")
+                summary, uncovered = cached
+                result = self._build_summary_history(summary, uncovered + recent_history, "错误重试摘要缓存结构")
                 self._truncated = True
                 self._truncate_info = f"错误重试摘要(缓存) (第 {retry_count + 1} 次): {len(history)} -> {len(result)} 条消息"
                 return result, True
@@ -616,8 +1538,7 @@ class HistoryManager:
                 result = self._build_summary_history(summary, recent_history, "错误重试摘要结构")
                 self._truncated = True
                 self._truncate_info = f"错误重试摘要 (第 {retry_count + 1} 次): {len(history)} -> {len(result)} 条消息 (摘要 {len(summary)} 字符)"
-                if cache_key and self.config.summary_cache_enabled:
-                    _summary_cache.set(cache_key, summary, old_count, old_chars)
+                self.set_session_summary(old_history, target_count, summary)
                 return result, True
 
         # 摘要失败或无 api_caller，回退到按数量截断
@@ -634,8 +1555,7 @@ class HistoryManager:
         if TruncateStrategy.PRE_ESTIMATE not in self.config.strategies:
             return False
         
-        total_chars = len(json.dumps(history, ensure_ascii=False)) + len(user_content)
-        return total_chars > self.config.estimate_threshold
+        return self.estimate_request_tokens(history, user_content) > self.token_threshold
     
     def should_summarize(self, history: List[dict]) -> bool:
         """检查是否需要摘要（智能摘要或自动截断前摘要）"""
@@ -647,15 +1567,14 @@ class HistoryManager:
             return False
         if not history:
             return False
-        _, _, total_chars = self.estimate_request_chars(history, user_content)
-        return total_chars > self.config.estimate_threshold
+        return self.estimate_request_tokens(history, user_content) > self.token_threshold
 
     def should_smart_summarize(self, history: List[dict]) -> bool:
         """检查是否需要智能摘要"""
         if TruncateStrategy.SMART_SUMMARY not in self.config.strategies:
             return False
 
-        total_chars = len(json.dumps(history, ensure_ascii=False))
+        total_chars = self.history_chars(history)
         return total_chars > self.config.summary_threshold and len(history) > self.config.summary_keep_recent
 
     def should_auto_truncate_summarize(self, history: List[dict]) -> bool:
@@ -666,15 +1585,18 @@ class HistoryManager:
         if len(history) <= 1:
             return False
 
-        total_chars = len(json.dumps(history, ensure_ascii=False))
+        total_chars = self.history_chars(history)
         return len(history) > self.config.max_messages or total_chars > self.config.max_chars
     
-    def pre_process(self, history: List[dict], user_content: str = "") -> List[dict]:
+    def pre_process(self, history: List[dict], user_content: str = "", tool_results: list = None) -> List[dict]:
         """预处理历史消息（发送前，同步版本）
         
         根据配置的策略进行预处理（不包括智能摘要）
         """
         self.reset()
+        history = self.dedup_blobs(history, tool_results)
+        history = self.compact_tool_results(history)
+        self.source_history = history
         
         if not history:
             return history
@@ -690,11 +1612,9 @@ class HistoryManager:
         
         # 策略 4: 预估检测
         if TruncateStrategy.PRE_ESTIMATE in self.config.strategies:
-            total_chars = len(json.dumps(result, ensure_ascii=False)) + len(user_content)
-            if total_chars > self.config.estimate_threshold:
-                # 计算需要保留的消息数
-                target_chars = int(self.config.estimate_threshold * 0.8)  # 留 20% 余量
-                result = self.truncate_by_chars(result, target_chars)
+            if self.estimate_request_tokens(result, user_content) > self.token_threshold:
+                # 留 20% 余量
+                result = self.truncate_by_tokens(result, int(self.token_threshold * 0.8))
         
         return result
     
@@ -702,7 +1622,8 @@ class HistoryManager:
         self, 
         history: List[dict], 
         user_content: str = "",
-        api_caller: Callable = None
+        api_caller: Callable = None,
+        tool_results: list = None
     ) -> List[dict]:
         """预处理历史消息（发送前，异步版本，支持智能摘要）
         
@@ -710,8 +1631,12 @@ class HistoryManager:
             history: 历史消息
             user_content: 当前用户消息
             api_caller: API 调用函数，用于生成摘要
+            tool_results: 当前消息的工具结果（去重时视为最后一次出现）
         """
         self.reset()
+        history = self.dedup_blobs(history, tool_results)
+        history = self.compact_tool_results(history)
+        self.source_history = history
         
         if not history:
             return history
@@ -726,21 +1651,10 @@ class HistoryManager:
                 if len(result) > target_count:
                     old_history = result[:-target_count]
                     recent_history = result[-target_count:]
-                    cache_key = self._summary_cache_key(target_count)
-                    old_count = len(old_history)
-                    old_chars = len(json.dumps(old_history, ensure_ascii=False))
-                    cached = None
-                    if cache_key and self.config.summary_cache_enabled:
-                        cached = _summary_cache.get(
-                            cache_key,
-                            old_count,
-                            old_chars,
-                            self.config.summary_cache_min_delta_messages,
-                            self.config.summary_cache_min_delta_chars,
-                            self.config.summary_cache_max_age_seconds
-                        )
+                    cached = self.get_session_summary(old_history, target_count)
                     if cached:
-                        result = self._build_summary_history(cached, recent_history, "错误重试预摘要缓存结构")
+                        summary, uncovered = cached
+                        result = self._build_summary_history(summary, uncovered + recent_history, "错误重试预摘要缓存结构")
                         self._truncated = True
                         self._truncate_info = f"错误重试预摘要(缓存): {len(history)} -> {len(result)} 条消息"
                         pre_summarized = True
@@ -751,8 +1665,7 @@ class HistoryManager:
                             self._truncated = True
                             self._truncate_info = f"错误重试预摘要: {len(history)} -> {len(result)} 条消息 (摘要 {len(summary)} 字符)"
                             pre_summarized = True
-                            if cache_key and self.config.summary_cache_enabled:
-                                _summary_cache.set(cache_key, summary, old_count, old_chars)
+                            self.set_session_summary(old_history, target_count, summary)
         
         # 策略 2: 智能摘要（优先级最高）
         summary_applied = False
@@ -778,10 +1691,8 @@ class HistoryManager:
         
         # 策略 4: 预估检测
         if TruncateStrategy.PRE_ESTIMATE in self.config.strategies:
-            total_chars = len(json.dumps(result, ensure_ascii=False)) + len(user_content)
-            if total_chars > self.config.estimate_threshold:
-                target_chars = int(self.config.estimate_threshold * 0.8)
-                result = self.truncate_by_chars(result, target_chars)
+            if self.estimate_request_tokens(result, user_content) > self.token_threshold:
+                result = self.truncate_by_tokens(result, int(self.token_threshold * 0.8))
         
         return result
     
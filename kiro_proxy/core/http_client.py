@@ -0,0 +1,227 @@
+"""上游 HTTP 客户端 - 共享连接池
+
+所有访问 Kiro API、Token 刷新端点和 getUsageLimits 的请求都复用同一个
+httpx.AsyncClient，避免每次请求都重新进行 TCP + TLS 握手：
+- keep-alive 连接池（上限可配置）
+- HTTP/2 多路复用（需要安装 h2，未安装时自动回退 HTTP/1.1）
+- 由应用 lifespan 负责创建和关闭
+"""
+import asyncio
+from dataclasses import dataclass, asdict, fields
+from typing import Optional, List
+
+import httpx
+
+from .persistence import load_config, save_config, coerce_config_value
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+@dataclass
+class UpstreamConfig:
+    """上游连接池配置"""
+    # 最大连接数（含使用中和空闲）
+    max_connections: int = 200
+
+    # 最大保持的空闲 keep-alive 连接数
+    max_keepalive_connections: int = 50
+
+    # 空闲连接保活时间（秒）
+    keepalive_expiry: float = 60.0
+
+    # 是否启用 HTTP/2（需要 h2）
+    http2: bool = True
+
+    # 建立连接超时（秒）
+    connect_timeout: float = 10.0
+
+    # 默认读超时（秒），各调用点可单独覆盖
+    read_timeout: float = 120.0
+
+    # 更新配置后旧连接池的关闭宽限期（秒），等待进行中的流结束
+    retire_grace_seconds: float = 300.0
+
+    @classmethod
+    def coerce(cls, key: str, value):
+        """按字段类型转换并校验单个配置值，非法时抛出 ValueError"""
+        return coerce_config_value(cls, key, value, _POSITIVE_FIELDS)
+
+    @classmethod
+    def validate(cls, data: dict) -> dict:
+        """校验一组配置更新，返回转换后的值（忽略未知字段）"""
+        names = {f.name for f in fields(cls)}
+        return {key: cls.coerce(key, value) for key, value in (data or {}).items() if key in names}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UpstreamConfig":
+        config = cls()
+        for key, value in (data or {}).items():
+            if not hasattr(config, key):
+                continue
+            try:
+                setattr(config, key, cls.coerce(key, value))
+            except ValueError as e:
+                print(f"[Upstream] 忽略无效的配置: {e}")
+        return config
+
+
+# 必须大于 0 的字段（其余数值字段允许为 0）
+_POSITIVE_FIELDS = {"max_connections", "connect_timeout", "read_timeout"}
+
+
+class UpstreamClient:
+    """共享上游客户端
+
+    客户端与创建它的事件循环绑定；如果在其他事件循环中使用（例如 CLI 多次
+    asyncio.run），会自动为当前循环创建新的客户端。
+    """
+
+    def __init__(self, config: UpstreamConfig = None):
+        self.config = config or UpstreamConfig.from_dict(load_config().get("upstream", {}))
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._retired: List[httpx.AsyncClient] = []
+        self._clients_created = 0
+
+    @property
+    def http2_enabled(self) -> bool:
+        return self.config.http2 and HTTP2_AVAILABLE
+
+    def _create_client(self) -> httpx.AsyncClient:
+        """按当前配置创建客户端"""
+        self._clients_created += 1
+        return httpx.AsyncClient(
+            verify=False,
+            http2=self.http2_enabled,
+            limits=httpx.Limits(
+                max_connections=self.config.max_connections,
+                max_keepalive_connections=self.config.max_keepalive_connections,
+                keepalive_expiry=self.config.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.config.read_timeout, connect=self.config.connect_timeout),
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """获取当前事件循环可用的共享客户端"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        if self._client is None or self._client.is_closed or (loop is not None and loop is not self._loop):
+            # 切换事件循环时旧客户端同样退役，宽限期后关闭
+            self._retire(self._client)
+            self._client = self._create_client()
+            self._loop = loop
+        return self._client
+
+    async def start(self):
+        """启动（在应用 lifespan 中调用）"""
+        client = self.client
+        if self.config.http2 and not HTTP2_AVAILABLE:
+            print("[Upstream] 未安装 h2，HTTP/2 已回退为 HTTP/1.1 (pip install 'httpx[http2]')")
+        print(f"[Upstream] 连接池已启动: http2={self.http2_enabled}, "
+              f"max_connections={self.config.max_connections}, "
+              f"max_keepalive={self.config.max_keepalive_connections}")
+        return client
+
+    async def stop(self):
+        """关闭所有连接"""
+        clients = self._retired + ([self._client] if self._client else [])
+        self._retired = []
+        self._client = None
+        self._loop = None
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                print(f"[Upstream] 关闭连接池失败: {e}")
+        print("[Upstream] 连接池已关闭")
+
+    def update_config(self, **kwargs):
+        """更新配置并持久化，新请求使用新连接池，旧连接池在宽限期后关闭
+
+        值按字段类型转换，任一值非法时抛出 ValueError，配置保持不变。
+        """
+        for key, value in UpstreamConfig.validate(kwargs).items():
+            setattr(self.config, key, value)
+
+        config = load_config()
+        config["upstream"] = asdict(self.config)
+        save_config(config)
+
+        old = self._client
+        self._client = None
+        self._retire(old)
+
+    def _retire(self, client: Optional[httpx.AsyncClient]):
+        """旧客户端进入退役列表，宽限期后关闭（没有运行中的事件循环时由 stop 关闭）"""
+        if client is None or client.is_closed:
+            return
+        self._retired.append(client)
+        try:
+            asyncio.get_running_loop().create_task(self._close_later(client))
+        except RuntimeError:
+            pass
+
+    async def _close_later(self, client: httpx.AsyncClient):
+        await asyncio.sleep(self.config.retire_grace_seconds)
+        if client in self._retired:
+            self._retired.remove(client)
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"[Upstream] 关闭旧连接池失败: {e}")
+
+    def get_pool_stats(self) -> dict:
+        """连接池统计（open / idle / active / waiting）"""
+        stats = {
+            "http2": self.http2_enabled,
+            "max_connections": self.config.max_connections,
+            "max_keepalive_connections": self.config.max_keepalive_connections,
+            "keepalive_expiry": self.config.keepalive_expiry,
+            "open": 0,
+            "idle": 0,
+            "active": 0,
+            "waiting": 0,
+            "retired_pools": len(self._retired),
+            "clients_created": self._clients_created,
+        }
+
+        client = self._client
+        if client is None or client.is_closed:
+            return stats
+
+        # httpx 没有公开连接池状态，这里读取 httpcore 连接池（版本不兼容时返回 0）
+        pool = getattr(getattr(client, "_transport", None), "_pool", None)
+        if pool is None:
+            return stats
+
+        try:
+            for conn in pool.connections:
+                if conn.is_closed():
+                    continue
+                stats["open"] += 1
+                if conn.is_idle():
+                    stats["idle"] += 1
+                else:
+                    stats["active"] += 1
+            stats["waiting"] = sum(1 for req in getattr(pool, "_requests", []) if req.is_queued())
+        except Exception:
+            pass
+
+        return stats
+
+
+# 全局实例
+upstream = UpstreamClient()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的上游 httpx 客户端"""
+    return upstream.client
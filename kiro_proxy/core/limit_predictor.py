@@ -0,0 +1,218 @@
+"""上下文长度上限学习 - 按模型预测请求是否会超限
+
+原来只能等 Kiro 返回 CONTENT_LENGTH_EXCEEDS_THRESHOLD 才知道请求太大，
+再截断重试，最多浪费 max_retries 次上游调用。
+
+这里记录每个模型成功和失败请求的大小（tokens、字符数、工具数、图片字节），
+维护上限区间 [最大成功, 最小失败)，按区间中点预测上限，会超限的请求在发送前先截断。
+请求大小 = 历史 tokens + 当前消息 tokens + 工具定义 tokens + 图片 tokens。
+
+学到的上限持久化到 config.json 的 "history_limits"，
+并通过 /api/settings/history 的 learned_limits 字段查看和重置。
+"""
+import time
+from collections import deque
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List, Optional
+
+from .persistence import load_config, save_config
+from .tokenizer import token_counter, IMAGE_TOKENS
+
+# 成功记录写盘的最小间隔（秒）；上限区间变化时立即写盘
+_SAVE_INTERVAL = 30.0
+
+# 每个模型保留的最近样本数（仅用于查看）
+_RECENT_SAMPLES = 20
+
+
+@dataclass
+class RequestSize:
+    """一次请求的大小"""
+    tokens: int = 0
+    chars: int = 0
+    tool_count: int = 0
+    image_bytes: int = 0
+
+
+@dataclass
+class ModelLimit:
+    """单个模型的上限区间"""
+    max_ok_tokens: int = 0                 # 成功请求的最大 tokens
+    min_fail_tokens: Optional[int] = None  # 超限请求的最小 tokens
+    ok_count: int = 0
+    fail_count: int = 0
+    updated_at: float = 0
+    recent: deque = field(default_factory=lambda: deque(maxlen=_RECENT_SAMPLES))
+
+    @property
+    def limit_tokens(self) -> Optional[int]:
+        """预测上限（还没有超限记录时不预测）
+
+        真实上限在 [max_ok, min_fail) 之间，取中点：
+        按中点截断的请求成功会抬高下界，失败会降低上界，区间每次减半。
+        """
+        if self.min_fail_tokens is None:
+            return None
+        if 0 < self.max_ok_tokens < self.min_fail_tokens:
+            return (self.max_ok_tokens + self.min_fail_tokens) // 2
+        return self.min_fail_tokens
+
+    def to_dict(self) -> dict:
+        return {
+            "max_ok_tokens": self.max_ok_tokens,
+            "min_fail_tokens": self.min_fail_tokens,
+            "limit_tokens": self.limit_tokens,
+            "ok_count": self.ok_count,
+            "fail_count": self.fail_count,
+            "updated_at": self.updated_at,
+            "recent": list(self.recent),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ModelLimit":
+        limit = cls(
+            max_ok_tokens=data.get("max_ok_tokens", 0),
+            min_fail_tokens=data.get("min_fail_tokens"),
+            ok_count=data.get("ok_count", 0),
+            fail_count=data.get("fail_count", 0),
+            updated_at=data.get("updated_at", 0),
+        )
+        limit.recent.extend(data.get("recent", []))
+        return limit
+
+
+def measure_request(
+    history: List[dict],
+    user_content: str = "",
+    tools: list = None,
+    images: list = None,
+    tool_results: list = None
+) -> RequestSize:
+    """估算请求大小（历史和工具定义的计数都有缓存）"""
+    size = RequestSize()
+    size.tokens = token_counter.count_history(history) + token_counter.count(user_content or "")
+    for result in tool_results or []:
+        for item in result.get("content") or []:
+            if "text" in item:
+                size.tokens += token_counter.count(item["text"])
+            elif "json" in item:
+                size.tokens += token_counter.count_value(item["json"])
+    if tools:
+        size.tool_count = len(tools)
+        size.tokens += _tools_tokens(tools)
+    for image in images or []:
+        data = (image.get("source") or {}).get("bytes") or ""
+        size.image_bytes += len(data) * 3 // 4
+        size.tokens += IMAGE_TOKENS
+    return size
+
+
+def measure_kiro_request(kiro_request: dict) -> RequestSize:
+    """从 Kiro 请求体估算大小；已编码的请求体同时记录字符数"""
+    state = kiro_request.get("conversationState") or {}
+    message = (state.get("currentMessage") or {}).get("userInputMessage") or {}
+    context = message.get("userInputMessageContext") or {}
+    size = measure_request(
+        state.get("history") or [],
+        message.get("content", ""),
+        context.get("tools"),
+        message.get("images"),
+        context.get("toolResults"),
+    )
+    encoded = getattr(kiro_request, "encoded", None)
+    if encoded is not None:
+        size.chars = len(encoded)
+    return size
+
+
+def _tools_tokens(tools: list) -> int:
+    """工具定义的 tokens；converters.KiroTools 带预编码 JSON，直接按其内容计数（有缓存）"""
+    encoded = getattr(tools, "encoded", None)
+    if encoded is not None:
+        return token_counter.count(encoded.decode())
+    return token_counter.count_value(tools)
+
+
+class LimitPredictor:
+    """按模型学习上下文长度上限"""
+
+    def __init__(self):
+        self._limits: Optional[Dict[str, ModelLimit]] = None
+        self._dirty = False
+        self._last_save = 0.0
+
+    @property
+    def limits(self) -> Dict[str, ModelLimit]:
+        if self._limits is None:
+            data = load_config().get("history_limits", {})
+            self._limits = {model: ModelLimit.from_dict(item) for model, item in data.items()}
+        return self._limits
+
+    def _get(self, model: str) -> ModelLimit:
+        limit = self.limits.get(model)
+        if limit is None:
+            limit = self.limits[model] = ModelLimit()
+        return limit
+
+    def predict_limit(self, model: str) -> Optional[int]:
+        """模型的预测上限（tokens），没有超限记录时返回 None"""
+        limit = self.limits.get(model)
+        return limit.limit_tokens if limit else None
+
+    def record(self, model: str, size: RequestSize, ok: bool):
+        """记录一次请求结果（ok=False 表示内容长度超限）"""
+        limit = self._get(model)
+        bracket = (limit.max_ok_tokens, limit.min_fail_tokens)
+        if ok:
+            limit.ok_count += 1
+            limit.max_ok_tokens = max(limit.max_ok_tokens, size.tokens)
+            if limit.min_fail_tokens is not None and size.tokens >= limit.min_fail_tokens:
+                # 更大的请求成功了，之前的失败不是单纯因为长度（估算偏差或上游调整），放弃旧的下界
+                limit.min_fail_tokens = None
+        else:
+            limit.fail_count += 1
+            if limit.min_fail_tokens is None or size.tokens < limit.min_fail_tokens:
+                limit.min_fail_tokens = size.tokens
+            if limit.max_ok_tokens >= size.tokens:
+                limit.max_ok_tokens = int(size.tokens * 0.9)
+            print(f"[LimitPredictor] {model} 超限: {size.tokens} tokens, 预测上限 {limit.limit_tokens}")
+        limit.updated_at = time.time()
+        limit.recent.append({"ok": ok, "at": int(limit.updated_at), **asdict(size)})
+
+        self._dirty = True
+        if (limit.max_ok_tokens, limit.min_fail_tokens) != bracket and not ok:
+            self.save()
+        elif time.time() - self._last_save >= _SAVE_INTERVAL:
+            self.save()
+
+    def record_request(self, kiro_request: dict, ok: bool):
+        """按 Kiro 请求体记录结果"""
+        message = ((kiro_request.get("conversationState") or {}).get("currentMessage") or {}).get("userInputMessage") or {}
+        model = message.get("modelId")
+        if model:
+            self.record(model, measure_kiro_request(kiro_request), ok)
+
+    def reset(self, model: str = None):
+        """清除学到的上限（不指定模型时全部清除）"""
+        if model:
+            self.limits.pop(model, None)
+        else:
+            self.limits.clear()
+        self._dirty = True
+        self.save()
+
+    def save(self):
+        if not self._dirty:
+            return
+        data = load_config()
+        data["history_limits"] = {model: limit.to_dict() for model, limit in self.limits.items()}
+        save_config(data)
+        self._dirty = False
+        self._last_save = time.time()
+
+    def to_dict(self) -> dict:
+        return {model: limit.to_dict() for model, limit in self.limits.items()}
+
+
+# 全局实例
+limit_predictor = LimitPredictor()
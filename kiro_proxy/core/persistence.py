@@ -1,5 +1,7 @@
 """配置持久化"""
 import json
+import math
+from dataclasses import fields
 from pathlib import Path
 from typing import List, Dict, Any
 
@@ -56,6 +58,42 @@ def save_config(config: Dict[str, Any]) -> bool:
         return False
 
 
+_BOOL_STRINGS = {"true": True, "1": True, "yes": True, "on": True, "false": False, "0": False, "no": False, "off": False}
+
+
+def coerce_config_value(config_cls, key: str, value, positive_fields=()):
+    """按配置 dataclass 的字段类型转换并校验单个值，非法时抛出 ValueError
+
+    布尔字段接受 true/false/1/0/yes/no/on/off 字符串；数值字段必须是非负有限数，
+    int 字段必须是整数，positive_fields 中的字段必须大于 0。
+    """
+    field_type = next(f.type for f in fields(config_cls) if f.name == key)
+    if field_type is bool:
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in _BOOL_STRINGS:
+            return _BOOL_STRINGS[value.strip().lower()]
+        raise ValueError(f"{key} 必须是布尔值: {value!r}")
+
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f"{key} 必须是数字: {value!r}")
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{key} 必须是数字: {value!r}") from None
+    if not math.isfinite(number):
+        raise ValueError(f"{key} 必须是有限数值: {value!r}")
+    if field_type is int:
+        if not number.is_integer():
+            raise ValueError(f"{key} 必须是整数: {value!r}")
+        number = int(number)
+    if number < 0:
+        raise ValueError(f"{key} 不能为负数: {value!r}")
+    if key in positive_fields and number <= 0:
+        raise ValueError(f"{key} 必须大于 0: {value!r}")
+    return number
+
+
 def export_config() -> Dict[str, Any]:
     """导出配置（用于备份）"""
     return load_config()
@@ -0,0 +1,72 @@
+"""Single-flight - 相同键的并发调用合并为一次
+
+并行子 Agent、客户端重试常在同一时刻为同一会话发起多个请求，
+各自判定需要摘要并各自调用上游，在账号池最繁忙时重复消耗配额。
+
+第一个调用者（leader）创建任务，之后到达的调用者等待同一个任务：
+- 任务独立于任何单个调用者运行，某个客户端断开不会取消其他人正在等待的调用
+- 所有等待者都取消后才取消任务
+- 超时的等待者返回 None，任务继续运行（结果仍会写入缓存）
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """按键合并进行中的异步调用"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._calls
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        """执行 factory()，相同 key 正在进行时等待其结果；超时返回 None"""
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(factory()))
+            self._calls[key] = call
+            self.leaders += 1
+
+            def _done(_task, key=key, call=call):
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.task.add_done_callback(_done)
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(call.task), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return None
+        except asyncio.CancelledError:
+            if call.waiters == 1 and not call.task.done():
+                call.task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            call.waiters -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced_waits": self.coalesced,
+            "timeouts": self.timeouts,
+            "cancelled": self.cancelled,
+        }
@@ -0,0 +1,312 @@
+"""SSE 编码 - 预编码模板 + 增量合并
+
+流式响应的每个文本增量原本都要拼一个大 f-string 并 json.dumps 整个字典，
+而且 Kiro 的一个增量往往只有一两个 token，每个增量都是一次 ASGI send。
+
+- 各协议的固定部分在流开始时编码为 bytes，每个增量只转义文本本身
+- DeltaCoalescer 把 N 毫秒内或 M 字节以内到达的增量合并为一个事件
+- 提前前导：请求准备（token 刷新、摘要）和等待上游首字节期间先发送
+  message_start 等前导事件，并定期发送 keep-alive，避免客户端空闲超时
+"""
+import asyncio
+import time
+from dataclasses import dataclass, asdict, fields
+from json.encoder import encode_basestring_ascii as _quote
+from typing import AsyncIterator, Optional
+
+from .persistence import load_config, save_config, coerce_config_value
+from .. import jsonfast
+
+
+@dataclass
+class SSEConfig:
+    """SSE 输出配置"""
+    # 合并窗口（毫秒），0 表示只合并同一网络块内的增量
+    coalesce_window_ms: float = 15.0
+
+    # 单个合并事件的最大文本字节数，达到即发送
+    coalesce_max_bytes: int = 4096
+
+    # 收到请求后立即返回流并发送前导事件，准备阶段的错误以流内错误事件返回
+    early_preamble: bool = True
+
+    # 没有输出时发送 keep-alive 的间隔（秒），0 表示不发送
+    keepalive_interval_s: float = 10.0
+
+    @classmethod
+    def coerce(cls, key: str, value):
+        """按字段类型转换并校验单个配置值，非法时抛出 ValueError"""
+        return coerce_config_value(cls, key, value, _POSITIVE_FIELDS)
+
+    @classmethod
+    def validate(cls, data: dict) -> dict:
+        """校验一组配置更新，返回转换后的值（忽略未知字段）"""
+        names = {f.name for f in fields(cls)}
+        return {key: cls.coerce(key, value) for key, value in (data or {}).items() if key in names}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SSEConfig":
+        config = cls()
+        for key, value in (data or {}).items():
+            if not hasattr(config, key):
+                continue
+            try:
+                setattr(config, key, cls.coerce(key, value))
+            except ValueError as e:
+                print(f"[SSE] 忽略无效的配置: {e}")
+        return config
+
+
+# 必须大于 0 的字段（其余数值字段允许为 0）
+_POSITIVE_FIELDS = {"coalesce_max_bytes"}
+
+
+_config: Optional[SSEConfig] = None
+
+
+def get_sse_config() -> SSEConfig:
+    """获取 SSE 配置"""
+    global _config
+    if _config is None:
+        _config = SSEConfig.from_dict(load_config().get("sse", {}))
+    return _config
+
+
+def update_sse_config(**kwargs) -> SSEConfig:
+    """更新 SSE 配置并持久化
+
+    值按字段类型转换，任一值非法时抛出 ValueError，配置保持不变。
+    """
+    config = get_sse_config()
+    for key, value in SSEConfig.validate(kwargs).items():
+        setattr(config, key, value)
+    data = load_config()
+    data["sse"] = asdict(config)
+    save_config(data)
+    return config
+
+
+def encode_event(event: str, data: dict) -> bytes:
+    """通用 SSE 事件（低频事件使用）"""
+    return b"event: " + event.encode() + b"\ndata: " + jsonfast.dumpb(data) + b"\n\n"
+
+
+def encode_data(data: dict) -> bytes:
+    """无事件名的 SSE 数据行（OpenAI / Gemini）"""
+    return b"data: " + jsonfast.dumpb(data) + b"\n\n"
+
+
+DONE = b"data: [DONE]\n\n"
+
+# SSE 注释行，客户端会忽略（OpenAI / Responses 的 keep-alive）
+KEEPALIVE_COMMENT = b": keep-alive\n\n"
+
+
+# ==================== 增量合并 ====================
+
+class DeltaCoalescer:
+    """文本增量合并器
+
+    add() 在缓冲达到字节上限或窗口到期时返回合并后的文本，否则返回 None；
+    切换内容块或流结束前调用 flush() 取出剩余文本。
+    """
+
+    def __init__(self, window_ms: float = None, max_bytes: int = None):
+        config = get_sse_config()
+        self.window = (config.coalesce_window_ms if window_ms is None else window_ms) / 1000
+        self.max_bytes = config.coalesce_max_bytes if max_bytes is None else max_bytes
+        self._parts = []
+        self._size = 0
+        self._first_at = 0.0
+        self.deltas_in = 0
+        self.events_out = 0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._parts)
+
+    def add(self, text: str, now: float = None) -> Optional[str]:
+        if not text:
+            return None
+        self.deltas_in += 1
+        if now is None:
+            now = time.monotonic()
+        if not self._parts:
+            self._first_at = now
+        self._parts.append(text)
+        # 按 UTF-8 字节计数（isascii 是 O(1) 标志检查，纯 ASCII 不需要编码）
+        self._size += len(text) if text.isascii() else len(text.encode("utf-8"))
+        if self._size >= self.max_bytes or now - self._first_at >= self.window:
+            return self.flush()
+        return None
+
+    def flush(self) -> str:
+        if not self._parts:
+            return ""
+        text = self._parts[0] if len(self._parts) == 1 else "".join(self._parts)
+        self._parts = []
+        self._size = 0
+        self.events_out += 1
+        return text
+
+    def time_left(self, now: float = None) -> Optional[float]:
+        """距离窗口到期的秒数；没有待发送内容时返回 None"""
+        if not self._parts:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return max(0.0, self._first_at + self.window - now)
+
+
+async def iter_coalesced(source: AsyncIterator[bytes], coalescer: DeltaCoalescer) -> AsyncIterator[Optional[bytes]]:
+    """迭代上游字节流；合并窗口到期而上游还没有新数据时产出 None，提示调用方 flush
+
+    读取放在独立的 Task 中等待，超时不会取消正在进行的读取。
+    """
+    if coalescer.window <= 0:
+        async for chunk in source:
+            yield chunk
+        return
+
+    iterator = source.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            timeout = coalescer.time_left()
+            if timeout is not None and not next_chunk.done():
+                done, _ = await asyncio.wait((next_chunk,), timeout=timeout)
+                if not done:
+                    yield None
+                    continue
+            try:
+                chunk = await next_chunk
+            except StopAsyncIteration:
+                return
+            next_chunk = None
+            yield chunk
+    finally:
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+
+
+# ==================== 各协议模板 ====================
+
+class AnthropicSSE:
+    """Anthropic Messages 流式事件"""
+
+    _TEXT_DELTA = b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,"delta":{"type":"text_delta","text":%s}}\n\n'
+    _INPUT_DELTA = b'event: content_block_delta\ndata: {"type":"content_block_delta","index":%d,"delta":{"type":"input_json_delta","partial_json":%s}}\n\n'
+    _TEXT_START = b'event: content_block_start\ndata: {"type":"content_block_start","index":%d,"content_block":{"type":"text","text":""}}\n\n'
+    _TOOL_START = b'event: content_block_start\ndata: {"type":"content_block_start","index":%d,"content_block":{"type":"tool_use","id":%s,"name":%s,"input":{}}}\n\n'
+    _BLOCK_STOP = b'event: content_block_stop\ndata: {"type":"content_block_stop","index":%d}\n\n'
+    PING = b'event: ping\ndata: {"type":"ping"}\n\n'
+    MESSAGE_STOP = b'event: message_stop\ndata: {"type":"message_stop"}\n\n'
+
+    @staticmethod
+    def message_start(msg_id: str, model: str, input_tokens: int = 0) -> bytes:
+        return encode_event("message_start", {
+            "type": "message_start",
+            "message": {
+                "id": msg_id, "type": "message", "role": "assistant", "content": [],
+                "model": model, "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+            },
+        })
+
+    @classmethod
+    def text_delta(cls, index: int, text: str) -> bytes:
+        return cls._TEXT_DELTA % (index, _quote(text).encode())
+
+    @classmethod
+    def input_json_delta(cls, index: int, partial_json: str) -> bytes:
+        return cls._INPUT_DELTA % (index, _quote(partial_json).encode())
+
+    @classmethod
+    def text_block_start(cls, index: int) -> bytes:
+        return cls._TEXT_START % index
+
+    @classmethod
+    def tool_block_start(cls, index: int, tool_id: str, name: str) -> bytes:
+        return cls._TOOL_START % (index, _quote(tool_id).encode(), _quote(name).encode())
+
+    @classmethod
+    def block_stop(cls, index: int) -> bytes:
+        return cls._BLOCK_STOP % index
+
+    @staticmethod
+    def message_delta(stop_reason: str, output_tokens: int) -> bytes:
+        return encode_event("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+            "usage": {"output_tokens": output_tokens},
+        })
+
+    @staticmethod
+    def error(error_type: str, message: str) -> bytes:
+        return encode_event("error", {"type": "error", "error": {"type": error_type, "message": message}})
+
+
+class OpenAIChunkSSE:
+    """OpenAI chat.completion.chunk 流式事件（每个流一个实例）"""
+
+    def __init__(self, chunk_id: str, created: int, model: str, include_usage: bool = False):
+        head = {"id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        self._head = jsonfast.dumpb(head)[:-1]
+        self._tail = b',"usage":null}\n\n' if include_usage else b"}\n\n"
+        self._content_prefix = b'data: ' + self._head + b', "choices": [{"index": 0, "delta": {"content": '
+        self._content_suffix = b'}, "finish_reason": null}]' + self._tail
+
+    def chunk(self, delta: dict, finish_reason: str = None) -> bytes:
+        choices = jsonfast.dumpb([{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+        return b'data: ' + self._head + b', "choices": ' + choices + self._tail
+
+    def content(self, text: str) -> bytes:
+        return self._content_prefix + _quote(text).encode() + self._content_suffix
+
+    def usage(self, usage: dict) -> bytes:
+        return b'data: ' + self._head + b', "choices": [], "usage": ' + jsonfast.dumpb(usage) + b"}\n\n"
+
+
+class ResponsesSSE:
+    """OpenAI Responses API 流式事件（每个流一个实例）"""
+
+    def __init__(self, item_id: str):
+        self._text_prefix = (
+            b'event: response.output_text.delta\ndata: {"type": "response.output_text.delta", "item_id": '
+            + _quote(item_id).encode()
+            + b', "output_index": 0, "content_index": 0, "delta": '
+        )
+
+    def text_delta(self, text: str) -> bytes:
+        return self._text_prefix + _quote(text).encode() + b"}\n\n"
+
+
+class GeminiSSE:
+    """Gemini streamGenerateContent 流式输出（alt=sse 或 JSON 数组）"""
+
+    _TEXT_PREFIX = b'{"candidates": [{"content": {"parts": [{"text": '
+    _TEXT_SUFFIX = b'}], "role": "model"}, "index": 0}]}'
+
+    def __init__(self, sse: bool = True):
+        self.sse = sse
+        self._first = True
+
+    def _frame(self, payload: bytes) -> bytes:
+        if self.sse:
+            return b"data: " + payload + b"\r\n\r\n"
+        prefix = b"[" if self._first else b",\r\n"
+        self._first = False
+        return prefix + payload
+
+    def text(self, text: str) -> bytes:
+        return self._frame(self._TEXT_PREFIX + _quote(text).encode() + self._TEXT_SUFFIX)
+
+    def data(self, data: dict) -> bytes:
+        return self._frame(jsonfast.dumpb(data))
+
+    def end(self) -> bytes:
+        if self.sse:
+            return b""
+        return b"[]" if self._first else b"]"
@@ -96,7 +96,7 @@ class ProxyState:
         if not available:
             return None
         
-        account = min(available, key=lambda a: a.request_count)
+        account = min(available, key=lambda a: (a.in_flight, a.request_count))
         
         if session_id:
             self.session_locks[session_id] = account.id
@@ -109,7 +109,7 @@ class ProxyState:
         available = [a for a in self.accounts if a.is_available() and a.id != exclude_id]
         if not available:
             return None
-        return min(available, key=lambda a: a.request_count)
+        return min(available, key=lambda a: (a.in_flight, a.request_count))
     
     def mark_rate_limited(self, account_id: str, duration_seconds: int = 60):
         """标记账号限流"""
@@ -0,0 +1,164 @@
+"""流式响应生命周期 - 客户端断开时及时取消上游
+
+客户端（Claude Code / Codex 按 Esc、超时）断开后，如果没有人检查断开状态，
+上游的 client.stream 会继续拉取数据，白白占用账号和配额。
+
+- guard_stream: 生成器放在读取任务中运行，通过有界队列交给响应写出方
+  （写出慢时读取方阻塞，形成背压）；检测到断开或写出方被取消时取消读取任务，
+  取消会传递到上游响应并关闭连接；生成器长时间没有输出时写出 keep-alive
+- open_upstream_stream: 打开上游流并占用账号的并发槽位，退出或取消时立即释放，
+  被取消时记录浪费的上游时间
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from ..config import KIRO_API_URL
+from ..kiro_api import encode_kiro_request
+from .flow_monitor import flow_monitor
+from .http_client import get_http_client
+from .sse import get_sse_config
+
+
+class StreamStats:
+    """流式响应统计"""
+
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.upstream_cancelled = 0
+        self.wasted_upstream_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "active": self.active,
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "upstream_cancelled": self.upstream_cancelled,
+            "wasted_upstream_seconds": round(self.wasted_upstream_seconds, 2),
+        }
+
+
+# 全局实例
+stream_stats = StreamStats()
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+@asynccontextmanager
+async def open_upstream_stream(account, json: dict, headers: dict, timeout: float = 300, flow_id: str = None):
+    """打开 Kiro 上游流式请求，期间占用账号并发槽位"""
+    client = get_http_client()
+    body = encode_kiro_request(json)
+    if flow_id:
+        flow_monitor.record_upstream_body(flow_id, len(body), getattr(json, "encode_ms", 0.0))
+    account.in_flight += 1
+    started = time.monotonic()
+    try:
+        async with client.stream("POST", KIRO_API_URL, content=body, headers=headers, timeout=timeout) as response:
+            yield response
+    except (asyncio.CancelledError, GeneratorExit):
+        # 任务被取消，或处理器生成器被 aclose() 关闭（GeneratorExit 从 yield 处抛入）
+        wasted = time.monotonic() - started
+        stream_stats.upstream_cancelled += 1
+        stream_stats.wasted_upstream_seconds += wasted
+        if flow_id:
+            flow_monitor.cancel_flow(flow_id, wasted_seconds=wasted)
+        print(f"[Stream] 客户端已断开，取消上游请求: account={account.id}, 已运行 {wasted:.1f}s")
+        raise
+    finally:
+        account.in_flight -= 1
+
+
+async def guard_stream(
+    request,
+    source: AsyncIterator,
+    flow_id: Optional[str] = None,
+    queue_size: int = 64,
+    keepalive: Optional[bytes] = None,
+) -> AsyncIterator:
+    """包装流式生成器：有界队列背压 + 断开检测 + 取消传递
+
+    请求体此时已被处理器读完，之后 receive() 只会返回 http.disconnect，
+    等待它即可立即得知断开（uvicorn 在断开后静默丢弃 send，不会抛错）。
+
+    keepalive 只在已有输出之后发送，不会出现在协议要求的首个事件之前。
+    """
+    interval = get_sse_config().keepalive_interval_s if keepalive else 0
+    queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+
+    async def read():
+        try:
+            async for item in source:
+                await queue.put(item)
+            await queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            await queue.put(_Failure(e))
+
+    async def watch():
+        if request is None:
+            await asyncio.Event().wait()
+        while True:
+            message = await request.receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    reader = asyncio.create_task(read())
+    watcher = asyncio.create_task(watch())
+    getter = None
+    started = False
+    finished = False
+    stream_stats.active += 1
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(queue.get())
+            timeout = interval if started and interval > 0 else None
+            await asyncio.wait((getter, watcher), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if watcher.done():
+                # 客户端已断开
+                break
+            if not getter.done():
+                yield keepalive
+                continue
+            item = getter.result()
+            getter = None
+            if item is _END:
+                finished = True
+                break
+            if isinstance(item, _Failure):
+                raise item.exc
+            started = True
+            yield item
+    finally:
+        stream_stats.active -= 1
+        for task in (getter, watcher, reader):
+            if task is not None and not task.done():
+                task.cancel()
+        try:
+            await asyncio.gather(reader, return_exceptions=True)
+        except asyncio.CancelledError:
+            pass
+        # 读取任务阻塞在 queue.put 时被取消，取消不会传入生成器，需要显式关闭
+        # 以退出上游 async with，释放连接和账号槽位
+        aclose = getattr(source, "aclose", None)
+        if aclose is not None:
+            try:
+                await aclose()
+            except Exception as e:
+                print(f"[Stream] 关闭流式生成器失败: {e}")
+        if finished:
+            stream_stats.completed += 1
+        else:
+            stream_stats.cancelled += 1
+            if flow_id:
+                flow_monitor.cancel_flow(flow_id)
@@ -0,0 +1,167 @@
+"""后台摘要 - 把摘要调用移出请求关键路径
+
+需要摘要时，pre_process_async 会在发送真实请求前同步等待一次摘要调用（最长 60 秒）。
+这里在响应成功后预测下一轮需要摘要的旧消息片段（HistoryManager.summary_prefetch_plan），
+交给有界的后台 worker 池生成，并写入会话摘要缓存和持久化摘要缓存，下一轮直接命中。
+
+后台任务优先级低于交互请求：
+- 同一会话只保留最新的一个待处理任务，队列满时丢弃
+- 账号有进行中的请求时等待（通常在客户端执行工具的间隙运行），超时放弃
+- 运行期间占用账号并发槽位，交互请求会优先分配到空闲账号
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+from .history_manager import HistoryManager, _summary_cache
+
+
+class _Job:
+    __slots__ = ("manager", "old_history", "target_count", "account", "api_caller", "created_at")
+
+    def __init__(self, manager: HistoryManager, old_history: List[dict], target_count: int, account, api_caller: Callable):
+        self.manager = manager
+        self.old_history = old_history
+        self.target_count = target_count
+        self.account = account
+        self.api_caller = api_caller
+        self.created_at = time.time()
+
+
+class BackgroundSummarizer:
+    """后台摘要 worker 池"""
+
+    def __init__(self, workers: int = 2, max_pending: int = 64, max_wait: float = 120, poll_interval: float = 0.25):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self._pending: "OrderedDict[str, _Job]" = OrderedDict()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running_keys: Dict[str, float] = {}
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.expired = 0
+
+    async def start(self):
+        """启动 worker"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"[Summarizer] 后台摘要已启动: {self.workers} 个 worker")
+
+    async def stop(self):
+        """停止 worker，丢弃未处理的任务"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._pending.clear()
+
+    def schedule(self, manager: HistoryManager, history: List[dict], user_content: str, account, api_caller: Callable) -> bool:
+        """响应成功后调用：接近摘要阈值时为下一轮预生成摘要，返回是否已入队"""
+        plan = manager.summary_prefetch_plan(history, user_content)
+        if plan is None:
+            return False
+        target_count, old_history = plan
+        key = manager._summary_cache_key(target_count)
+        if key in self._running_keys:
+            return False
+        # 下一轮的旧消息已有可复用的摘要
+        if manager.get_session_summary(old_history, target_count, foreground=False):
+            self.skipped += 1
+            return False
+
+        if not self._tasks:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                return False
+            asyncio.ensure_future(self.start())
+
+        if key in self._pending:
+            self._pending.pop(key)
+        elif len(self._pending) >= self.max_pending:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        job_manager = HistoryManager(manager.config, cache_key=manager.cache_key)
+        self._pending[key] = _Job(job_manager, old_history, target_count, account, api_caller)
+        self.scheduled += 1
+        if self._wakeup:
+            self._wakeup.set()
+        return True
+
+    async def _worker(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, job = self._pending.popitem(last=False)
+            self._running_keys[key] = time.time()
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                print(f"[Summarizer] 后台摘要失败: {e}")
+            finally:
+                self._running_keys.pop(key, None)
+
+    async def _run(self, job: _Job):
+        # 等待账号空闲，让出给交互请求
+        account = job.account
+        while account is not None and account.in_flight > 0:
+            if time.time() - job.created_at > self.max_wait:
+                self.expired += 1
+                return
+            await asyncio.sleep(self.poll_interval)
+
+        manager = job.manager
+        old_history = job.old_history
+        if manager.get_session_summary(old_history, job.target_count, foreground=False):
+            self.skipped += 1
+            return
+
+        if account is not None:
+            account.in_flight += 1
+        try:
+            summary = await manager.generate_summary(old_history, job.api_caller)
+        finally:
+            if account is not None:
+                account.in_flight -= 1
+        if not summary:
+            self.failed += 1
+            return
+        manager.set_session_summary(old_history, job.target_count, summary, background=True)
+        self.completed += 1
+        print(f"[Summarizer] 已预生成摘要: {len(old_history)} 条消息 -> {len(summary)} 字符")
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "pending": len(self._pending),
+            "running": len(self._running_keys),
+            "scheduled": self.scheduled,
+            "completed": self.completed,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "skipped": self.skipped,
+            "expired": self.expired,
+            "foreground_waits_avoided": _summary_cache.background_hits,
+        }
+
+
+# 全局实例
+background_summarizer = BackgroundSummarizer()
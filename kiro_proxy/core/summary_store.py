@@ -0,0 +1,178 @@
+"""摘要持久化缓存 - 按内容寻址，跨会话、跨重启共享
+
+每次生成摘要都是一次额外的上游请求。内存中的 SummaryCache 按会话 ID 复用，
+重启即丢失，分叉对话、并行子 Agent 的相同早期历史也无法共享。
+
+这里以摘要提示词（由被摘要的消息片段和长度限制决定）的哈希为键，
+存入 ~/.kiro-proxy/summaries.db（SQLite WAL 模式，多个 worker 进程可同时读写），
+按最近使用时间淘汰，总大小和条目数都有上限。
+条目数和总字节数在内存中增量维护（打开时统计一次），超过上限时才重新统计
+（同时纳入其他进程的写入）并淘汰，写入路径上没有全表扫描。
+读写都是阻塞的 SQLite 调用，异步代码中应通过 asyncio.to_thread 调用。
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from .persistence import CONFIG_DIR, ensure_config_dir
+
+SUMMARY_DB = CONFIG_DIR / "summaries.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    key TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_summaries_last_used ON summaries(last_used);
+"""
+
+
+def summary_key(prompt: str) -> str:
+    """摘要提示词的内容哈希"""
+    return hashlib.blake2b(prompt.encode("utf-8"), digest_size=20).hexdigest()
+
+
+class SummaryStore:
+    """SQLite 摘要缓存（LRU，按字节数和条目数淘汰）"""
+
+    def __init__(self, path=None, max_bytes: int = 32 * 1024 * 1024, max_entries: int = 20000):
+        self.path = path or SUMMARY_DB
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._disabled = False
+        self._count = 0
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        if self._conn is not None or self._disabled:
+            return self._conn
+        try:
+            if self.path == SUMMARY_DB:
+                ensure_config_dir()
+            conn = sqlite3.connect(str(self.path), timeout=5, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._count, self._bytes = self._totals(conn)
+            self._conn = conn
+        except sqlite3.Error as e:
+            print(f"[SummaryStore] 打开摘要缓存失败，已禁用: {e}")
+            self._disabled = True
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        """读取摘要，命中时刷新最近使用时间"""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                conn.execute(
+                    "UPDATE summaries SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                    (time.time(), key)
+                )
+                self.hits += 1
+                return row[0]
+            except sqlite3.Error as e:
+                print(f"[SummaryStore] 读取失败: {e}")
+                return None
+
+    def set(self, key: str, summary: str):
+        """写入摘要并按容量淘汰最久未使用的条目"""
+        if not summary:
+            return
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            now = time.time()
+            size = len(summary.encode("utf-8"))
+            try:
+                row = conn.execute("SELECT size FROM summaries WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO summaries (key, summary, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, summary, size, now, now)
+                )
+                if row is None:
+                    self._count += 1
+                    self._bytes += size
+                else:
+                    self._bytes += size - row[0]
+                self.writes += 1
+                if self._count > self.max_entries or self._bytes > self.max_bytes:
+                    self._evict(conn)
+            except sqlite3.Error as e:
+                print(f"[SummaryStore] 写入失败: {e}")
+
+    @staticmethod
+    def _totals(conn: sqlite3.Connection):
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries").fetchone()
+
+    def _evict(self, conn: sqlite3.Connection):
+        # 重新统计一次，纳入其他进程的写入和淘汰
+        count, total = self._totals(conn)
+        self._count, self._bytes = count, total
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        # 按最近使用时间从旧到新删除，直到两项都回到上限的 90% 以内
+        target_count = int(self.max_entries * 0.9)
+        target_bytes = int(self.max_bytes * 0.9)
+        removed = []
+        for key, size in conn.execute("SELECT key, size FROM summaries ORDER BY last_used"):
+            if count <= target_count and total <= target_bytes:
+                break
+            removed.append((key,))
+            count -= 1
+            total -= size
+        conn.executemany("DELETE FROM summaries WHERE key = ?", removed)
+        self._count, self._bytes = count, total
+        self.evictions += len(removed)
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            if conn is not None:
+                conn.execute("DELETE FROM summaries")
+                self._count = self._bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._connect()
+            entries, size = self._count, self._bytes
+        total = self.hits + self.misses
+        return {
+            "enabled": not self._disabled,
+            "entries": entries,
+            "bytes": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": f"{self.hits / total * 100:.1f}%" if total else "0.0%",
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+
+# 全局实例
+summary_store = SummaryStore()
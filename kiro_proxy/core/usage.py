@@ -7,6 +7,8 @@ import httpx
 from dataclasses import dataclass
 from typing import Optional, Tuple
 
+from .http_client import get_http_client
+
 
 # API 端点
 USAGE_LIMITS_URL = "https://q.us-east-1.amazonaws.com/getUsageLimits"
@@ -58,7 +60,6 @@ def build_usage_headers(
         "x-amz-user-agent": f"aws-sdk-js/1.0.0 KiroIDE-{kiro_version}-{machine_id}",
         "amz-sdk-invocation-id": str(uuid.uuid4()),
         "amz-sdk-request": "attempt=1; max=1",
-        "Connection": "close",
     }
 
 
@@ -146,16 +147,15 @@ async def get_usage_limits(
     headers = build_usage_headers(access_token, machine_id, kiro_version)
     
     try:
-        async with httpx.AsyncClient(timeout=10, verify=False) as client:
-            response = await client.get(url, headers=headers)
-            
-            if response.status_code != 200:
-                return False, {"error": f"API 请求失败: {response.status_code} - {response.text[:200]}"}
-            
-            data = response.json()
-            usage_info = calculate_balance(data)
-            return True, usage_info
-            
+        response = await get_http_client().get(url, headers=headers, timeout=10)
+        
+        if response.status_code != 200:
+            return False, {"error": f"API 请求失败: {response.status_code} - {response.text[:200]}"}
+        
+        data = response.json()
+        usage_info = calculate_balance(data)
+        return True, usage_info
+        
     except httpx.TimeoutException:
         return False, {"error": "请求超时"}
     except Exception as e:
@@ -1,5 +1,5 @@
 """凭证管理模块"""
-from .fingerprint import generate_machine_id, get_kiro_version, get_system_info
+from .fingerprint import generate_machine_id, get_kiro_version, get_system_info, get_hour_slot
 from .quota import QuotaManager, QuotaRecord, quota_manager
 from .refresher import TokenRefresher
 from .types import KiroCredentials, CredentialStatus
@@ -8,6 +8,7 @@ __all__ = [
     "generate_machine_id",
     "get_kiro_version", 
     "get_system_info",
+    "get_hour_slot",
     "QuotaManager",
     "QuotaRecord",
     "quota_manager",
@@ -3,12 +3,14 @@ import hashlib
 import platform
 import subprocess
 import time
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
 
+@lru_cache(maxsize=1)
 def get_raw_machine_id() -> Optional[str]:
-    """获取系统原始 Machine ID"""
+    """获取系统原始 Machine ID（进程内只读取一次）"""
     system = platform.system()
     
     try:
@@ -41,6 +43,19 @@ def get_raw_machine_id() -> Optional[str]:
     return None
 
 
+def get_hour_slot() -> int:
+    """Machine ID 的时间因子（按小时变化）"""
+    return int(time.time()) // 3600
+
+
+@lru_cache(maxsize=256)
+def _hash_machine_id(unique_key: str, hour_slot: int) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(unique_key.encode())
+    hasher.update(hour_slot.to_bytes(8, 'little'))
+    return hasher.hexdigest()
+
+
 def generate_machine_id(
     profile_arn: Optional[str] = None, 
     client_id: Optional[str] = None
@@ -59,17 +74,12 @@ def generate_machine_id(
     else:
         unique_key = get_raw_machine_id() or "KIRO_DEFAULT_MACHINE"
     
-    hour_slot = int(time.time()) // 3600
-    
-    hasher = hashlib.sha256()
-    hasher.update(unique_key.encode())
-    hasher.update(hour_slot.to_bytes(8, 'little'))
-    
-    return hasher.hexdigest()
+    return _hash_machine_id(unique_key, get_hour_slot())
 
 
+@lru_cache(maxsize=1)
 def get_kiro_version() -> str:
-    """获取 Kiro IDE 版本号"""
+    """获取 Kiro IDE 版本号（进程内只检测一次）"""
     if platform.system() == "Darwin":
         kiro_paths = [
             "/Applications/Kiro.app/Contents/Info.plist",
@@ -90,8 +100,9 @@ def get_kiro_version() -> str:
     return "0.1.25"
 
 
+@lru_cache(maxsize=1)
 def get_system_info() -> tuple:
-    """获取系统运行时信息 (os_name, node_version)"""
+    """获取系统运行时信息 (os_name, node_version)，进程内只检测一次"""
     system = platform.system()
     
     if system == "Darwin":
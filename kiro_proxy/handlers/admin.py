@@ -2,7 +2,6 @@
 import json
 import uuid
 import time
-import httpx
 from pathlib import Path
 from datetime import datetime
 from dataclasses import asdict
@@ -10,6 +9,13 @@ from fastapi import Request, HTTPException, Query
 
 from ..config import TOKEN_PATH, MODELS_URL
 from ..core import state, Account, stats_manager, get_browsers_info, open_url, flow_monitor, get_account_usage
+from ..core.http_client import upstream, get_http_client
+from ..core.stream_guard import stream_stats
+from ..converters import conversion_cache, tool_spec_cache
+from ..core.tokenizer import token_counter
+from ..core.history_manager import message_sizes, summary_stats, summary_flights, tool_compactor, blob_deduper, image_stats
+from ..core.summary_store import summary_store
+from ..core.summarizer import background_summarizer
 from ..credential import quota_manager, generate_machine_id, get_kiro_version, CredentialStatus
 from ..auth import start_device_flow, poll_device_flow, cancel_device_flow, get_login_state, save_credentials_to_file
 from ..auth import start_social_auth, exchange_social_auth_token, cancel_social_auth, get_social_auth_state
@@ -26,7 +32,20 @@ async def get_status():
         "has_accounts": has_accounts,
         "has_available_accounts": has_available,
         "port": state.current_port,
-        "stats": stats
+        "stats": stats,
+        "upstream_pool": upstream.get_pool_stats(),
+        "streams": stream_stats.to_dict(),
+        "conversion_cache": conversion_cache.get_stats(),
+        "tool_spec_cache": tool_spec_cache.get_stats(),
+        "token_counter": token_counter.get_stats(),
+        "message_sizes": message_sizes.get_stats(),
+        "summary_store": summary_store.get_stats(),
+        "background_summarizer": background_summarizer.get_stats(),
+        "summary_calls": summary_stats.get_stats(),
+        "summary_singleflight": summary_flights.get_stats(),
+        "tool_compaction": tool_compactor.get_stats(),
+        "blob_dedup": blob_deduper.get_stats(),
+        "images": image_stats.get_stats(),
     }
 
 
@@ -185,15 +204,14 @@ async def speedtest():
             "x-amz-user-agent": f"aws-sdk-js/1.0.0 KiroIDE-{kiro_version}-{machine_id}",
             "Authorization": f"Bearer {token}",
         }
-        async with httpx.AsyncClient(verify=False, timeout=10) as client:
-            resp = await client.get(MODELS_URL, headers=headers, params={"origin": "AI_EDITOR"})
-            latency = (time.time() - start) * 1000
-            return {
-                "ok": resp.status_code == 200,
-                "latency_ms": round(latency, 2),
-                "status": resp.status_code,
-                "account_id": account.id
-            }
+        resp = await get_http_client().get(MODELS_URL, headers=headers, params={"origin": "AI_EDITOR"}, timeout=10)
+        latency = (time.time() - start) * 1000
+        return {
+            "ok": resp.status_code == 200,
+            "latency_ms": round(latency, 2),
+            "status": resp.status_code,
+            "account_id": account.id
+        }
     except Exception as e:
         return {"ok": False, "error": str(e), "latency_ms": (time.time() - start) * 1000}
 
@@ -417,46 +435,46 @@ async def run_health_check():
                 "content-type": "application/json"
             }
             
-            async with httpx.AsyncClient(verify=False, timeout=10) as client:
-                resp = await client.get(
-                    MODELS_URL,
-                    headers=headers,
-                    params={"origin": "AI_EDITOR"}
-                )
+            resp = await get_http_client().get(
+                MODELS_URL,
+                headers=headers,
+                params={"origin": "AI_EDITOR"},
+                timeout=10
+            )
+            
+            if resp.status_code == 200:
+                if acc.status == CredentialStatus.UNHEALTHY:
+                    acc.status = CredentialStatus.ACTIVE
+                results.append({
+                    "id": acc.id,
+                    "name": acc.name,
+                    "status": "healthy",
+                    "healthy": True,
+                    "latency_ms": resp.elapsed.total_seconds() * 1000
+                })
+            elif resp.status_code == 401:
+                acc.status = CredentialStatus.UNHEALTHY
+                results.append({
+                    "id": acc.id,
+                    "name": acc.name,
+                    "status": "auth_failed",
+                    "healthy": False
+                })
+            elif resp.status_code == 429:
+                results.append({
+                    "id": acc.id,
+                    "name": acc.name,
+                    "status": "rate_limited",
+                    "healthy": True  # 限流不代表不健康
+                })
+            else:
+                results.append({
+                    "id": acc.id,
+                    "name": acc.name,
+                    "status": f"error_{resp.status_code}",
+                    "healthy": False
+                })
                 
-                if resp.status_code == 200:
-                    if acc.status == CredentialStatus.UNHEALTHY:
-                        acc.status = CredentialStatus.ACTIVE
-                    results.append({
-                        "id": acc.id,
-                        "name": acc.name,
-                        "status": "healthy",
-                        "healthy": True,
-                        "latency_ms": resp.elapsed.total_seconds() * 1000
-                    })
-                elif resp.status_code == 401:
-                    acc.status = CredentialStatus.UNHEALTHY
-                    results.append({
-                        "id": acc.id,
-                        "name": acc.name,
-                        "status": "auth_failed",
-                        "healthy": False
-                    })
-                elif resp.status_code == 429:
-                    results.append({
-                        "id": acc.id,
-                        "name": acc.name,
-                        "status": "rate_limited",
-                        "healthy": True  # 限流不代表不健康
-                    })
-                else:
-                    results.append({
-                        "id": acc.id,
-                        "name": acc.name,
-                        "status": f"error_{resp.status_code}",
-                        "healthy": False
-                    })
-                    
         except Exception as e:
             results.append({
                 "id": acc.id,
@@ -1,5 +1,4 @@
 """Anthropic 协议处理 - /v1/messages"""
-import json
 import uuid
 import time
 import asyncio
@@ -7,14 +6,22 @@ import httpx
 from fastapi import Request, HTTPException
 from fastapi.responses import StreamingResponse
 
+from .. import jsonfast
 from ..config import KIRO_API_URL, map_model_name
 from ..core import state, RetryableRequest, is_retryable_error, stats_manager, flow_monitor, TokenUsage
 from ..core.state import RequestLog
 from ..core.history_manager import HistoryManager, get_history_config, is_content_length_error, TruncateStrategy
 from ..core.error_handler import classify_error, ErrorType, format_error_log
 from ..core.rate_limiter import get_rate_limiter
+from ..core.tokenizer import token_counter
+from ..core.limit_predictor import limit_predictor
+from ..core.summarizer import background_summarizer
+from ..core.http_client import get_http_client
+from ..core.stream_guard import open_upstream_stream, guard_stream
+from ..core.sse import AnthropicSSE, DeltaCoalescer, iter_coalesced, get_sse_config
 from ..credential import quota_manager
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream_full, parse_event_stream, is_quota_exceeded_error
+from ..providers.event_stream import EventStreamDecoder, ResponseAccumulator, TextDelta, ToolUseDelta
+from ..kiro_api import build_kiro_request, parse_event_stream_full, parse_event_stream, is_quota_exceeded_error, encode_kiro_request
 from ..converters import (
     generate_session_id,
     convert_anthropic_tools_to_kiro,
@@ -24,35 +31,14 @@ from ..converters import (
 )
 
 
-def _extract_text_from_content(content) -> str:
-    if content is None:
-        return ""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            parts.append(_extract_text_from_content(item))
-        return "".join(parts)
-    if isinstance(content, dict):
-        if "text" in content and isinstance(content.get("text"), str):
-            return content["text"]
-        if "content" in content:
-            return _extract_text_from_content(content.get("content"))
-    return ""
-
-
-def _estimate_tokens(text: str) -> int:
-    if not text:
-        return 0
-    return (len(text) + 3) // 4
-
-
-def _count_tokens_from_messages(messages, system: str = "") -> int:
-    total = _estimate_tokens(system) if system else 0
-    for msg in messages or []:
-        total += _estimate_tokens(_extract_text_from_content(msg.get("content")))
-    return total
+# HTTP 状态码 -> Anthropic 流内 error 事件类型
+_ERROR_TYPE_BY_STATUS = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    403: "permission_error",
+    429: "rate_limit_error",
+    503: "overloaded_error",
+}
 
 
 def _handle_kiro_error(status_code: int, error_text: str, account):
@@ -90,33 +76,46 @@ def _handle_kiro_error(status_code: int, error_text: str, account):
 
 async def handle_count_tokens(request: Request):
     '''Handle /v1/messages/count_tokens requests.'''
-    body = await request.json()
+    body = jsonfast.loads(await request.body())
     messages = body.get("messages", [])
     system = body.get("system", "")
     if not messages and not system:
         raise HTTPException(400, "messages required")
-    return {"input_tokens": _count_tokens_from_messages(messages, system)}
+    return {"input_tokens": token_counter.count_messages(messages, system, body.get("tools"))}
 
 
 async def _call_kiro_for_summary(prompt: str, account, headers: dict) -> str:
     """调用 Kiro API 生成摘要（内部使用）"""
     kiro_request = build_kiro_request(prompt, "claude-haiku-4.5", [])  # 用快速模型生成摘要
     try:
-        async with httpx.AsyncClient(verify=False, timeout=60) as client:
-            resp = await client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-            if resp.status_code == 200:
-                return parse_event_stream(resp.content)
+        client = get_http_client()
+        resp = await client.post(KIRO_API_URL, content=encode_kiro_request(kiro_request), headers=headers, timeout=60)
+        if resp.status_code == 200:
+            return parse_event_stream(resp.content)
     except Exception as e:
         print(f"[Summary] API 调用失败: {e}")
     return ""
 
 
+def _schedule_background_summary(history_manager, history, user_content, account, headers):
+    """响应成功后在后台为下一轮预生成摘要
+
+    下一轮的历史由本轮预处理前的完整历史加上本轮消息和回复组成。
+    """
+    if not history_manager:
+        return
+    history = history_manager.source_history or history
+    async def api_caller(prompt: str) -> str:
+        return await _call_kiro_for_summary(prompt, account, headers)
+    background_summarizer.schedule(history_manager, history, user_content, account, api_caller)
+
+
 async def handle_messages(request: Request):
     """处理 /v1/messages 请求"""
     start_time = time.time()
     log_id = uuid.uuid4().hex[:8]
     
-    body = await request.json()
+    body = jsonfast.loads(await request.body())
     model = map_model_name(body.get("model", "claude-sonnet-4"))
     messages = body.get("messages", [])
     system = body.get("system", "")
@@ -146,6 +145,28 @@ async def handle_messages(request: Request):
         account_name=account.name,
     )
     
+    # 提前返回流：准备阶段（token 刷新、摘要）期间先发送 message_start 和 ping
+    if stream and get_sse_config().early_preamble:
+        return StreamingResponse(
+            guard_stream(request, _early_stream(account, model, log_id, start_time, session_id, flow_id, messages, system, tools), flow_id=flow_id, keepalive=AnthropicSSE.PING),
+            media_type="text/event-stream",
+        )
+    
+    kiro_request, headers, history, user_content, kiro_tools, images, tool_results, history_manager = \
+        await _prepare_request(account, model, session_id, flow_id, messages, system, tools)
+    
+    if stream:
+        return await _handle_stream(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager, request=request)
+    else:
+        return await _handle_non_stream(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager)
+
+
+async def _prepare_request(account, model, session_id, flow_id, messages, system, tools):
+    """准备 Kiro 请求：token 刷新、限速、消息转换和历史预处理
+
+    返回 (kiro_request, headers, history, user_content, kiro_tools, images, tool_results, history_manager)，
+    无法获取 token 时抛出 HTTPException。
+    """
     # 检查 token 是否即将过期，尝试刷新
     if account.is_token_expiring_soon(5):
         print(f"[Anthropic] Token 即将过期，尝试刷新: {account.id}")
@@ -159,13 +180,7 @@ async def handle_messages(request: Request):
         raise HTTPException(500, f"Failed to get token for account {account.name}")
     
     # 使用账号的动态 Machine ID（提前构建，供摘要使用）
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
+    headers = account.build_headers(token)
     
     # 限速检查
     rate_limiter = get_rate_limiter()
@@ -184,16 +199,11 @@ async def handle_messages(request: Request):
     async def api_caller(prompt: str) -> str:
         return await _call_kiro_for_summary(prompt, account, headers)
     if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
-        history = await history_manager.pre_process_async(history, user_content, api_caller)
+        history = await history_manager.pre_process_async(history, user_content, api_caller, tool_results)
     else:
-        history = history_manager.pre_process(history, user_content)
-    
-    # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
-    from ..converters import fix_history_alternation
-    history = fix_history_alternation(history)
-    
-    if history_manager.was_truncated:
-        print(f"[Anthropic] {history_manager.truncate_info}")
+        history = history_manager.pre_process(history, user_content, tool_results)
+    if history_manager.dedup_saved_bytes:
+        flow_monitor.record_history_dedup(flow_id, history_manager.dedup_saved_bytes)
     
     # 提取最后一条消息中的图片
     images = []
@@ -201,243 +211,335 @@ async def handle_messages(request: Request):
         last_msg = messages[-1]
         if last_msg.get("role") == "user":
             _, images = extract_images_from_content(last_msg.get("content", ""))
+    images, user_content = history_manager.limit_images(images, user_content)
+    if history_manager.image_bytes:
+        flow_monitor.record_image_bytes(flow_id, history_manager.image_bytes)
     
-    # 构建 Kiro 请求
     kiro_tools = convert_anthropic_tools_to_kiro(tools) if tools else None
+    
+    # 按该模型学到的上限预先截断
+    history = history_manager.fit_learned_limit(history, user_content, model, kiro_tools, images, tool_results)
+    
+    # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
+    from ..converters import fix_history_alternation
+    history = fix_history_alternation(history)
+    
+    if history_manager.was_truncated:
+        print(f"[Anthropic] {history_manager.truncate_info}")
+    
+    # 构建 Kiro 请求
     kiro_request = build_kiro_request(user_content, model, history, kiro_tools, images, tool_results)
     
-    if stream:
-        return await _handle_stream(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager)
-    else:
-        return await _handle_non_stream(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager)
+    return kiro_request, headers, history, user_content, kiro_tools, images, tool_results, history_manager
+
+
+async def _early_stream(account, model, log_id, start_time, session_id, flow_id, messages, system, tools):
+    """先发送前导事件再准备请求，准备阶段的错误以流内 error 事件返回"""
+    yield AnthropicSSE.message_start(f"msg_{log_id}", model) + AnthropicSSE.PING
+    
+    try:
+        kiro_request, headers, history, user_content, kiro_tools, images, tool_results, history_manager = \
+            await _prepare_request(account, model, session_id, flow_id, messages, system, tools)
+    except Exception as e:
+        if isinstance(e, HTTPException):
+            # _prepare_request 抛出前已记录 Flow 失败
+            status, error_msg = e.status_code, str(e.detail)
+        else:
+            status, error_msg = 500, str(e)
+            flow_monitor.fail_flow(flow_id, "api_error", error_msg, status)
+        error_type = _ERROR_TYPE_BY_STATUS.get(status, "api_error")
+        print(f"[Anthropic] 请求准备失败: {error_msg}")
+        yield AnthropicSSE.error(error_type, error_msg)
+        duration = (time.time() - start_time) * 1000
+        state.add_log(RequestLog(
+            id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
+            model=model, account_id=account.id, status=status, duration_ms=duration, error=error_msg
+        ))
+        stats_manager.record_request(account_id=account.id, model=model, success=False, latency_ms=duration)
+        return
+    
+    stream = _stream_events(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager, preamble_sent=True)
+    async for chunk in stream:
+        yield chunk
 
 
-async def _handle_stream(kiro_request, headers, account, model, log_id, start_time, session_id=None, flow_id=None, history=None, user_content="", kiro_tools=None, images=None, tool_results=None, history_manager=None):
+async def _handle_stream(kiro_request, headers, account, model, log_id, start_time, session_id=None, flow_id=None, history=None, user_content="", kiro_tools=None, images=None, tool_results=None, history_manager=None, request=None):
     """Handle streaming responses with auto-retry on quota exceeded and network errors."""
+    stream = _stream_events(kiro_request, headers, account, model, log_id, start_time, session_id, flow_id, history, user_content, kiro_tools, images, tool_results, history_manager)
+    return StreamingResponse(guard_stream(request, stream, flow_id=flow_id, keepalive=AnthropicSSE.PING), media_type="text/event-stream")
+
+
+def _stream_events(kiro_request, headers, account, model, log_id, start_time, session_id=None, flow_id=None, history=None, user_content="", kiro_tools=None, images=None, tool_results=None, history_manager=None, preamble_sent=False):
+    """流式事件生成器；preamble_sent 为 True 时 message_start 已由 _early_stream 发送
+
+    只在开始输出响应内容之前重试或切换账号；之后上游中断时发送一个流内 error 事件后结束。
+    """
     
     async def generate():
-        nonlocal kiro_request, history
+        nonlocal kiro_request, history, headers
         current_account = account
         retry_count = 0
         max_retries = 2
+        # 前导事件只发送一次；已向客户端输出响应内容后不再重试（重试会重复已发送的内容）
+        message_started = preamble_sent
+        block_started = False
+        output_started = False
         full_content = ""
         
         while retry_count <= max_retries:
             try:
-                async with httpx.AsyncClient(verify=False, timeout=300) as client:
-                    async with client.stream("POST", KIRO_API_URL, json=kiro_request, headers=headers) as response:
+                async with open_upstream_stream(current_account, kiro_request, headers, flow_id=flow_id) as response:
+                    
+                    # 处理配额超限
+                    if response.status_code == 429 or is_quota_exceeded_error(response.status_code, ""):
+                        current_account.mark_quota_exceeded("Rate limited (stream)")
+                        
+                        # 尝试切换账号
+                        next_account = state.get_next_available_account(current_account.id)
+                        if next_account and retry_count < max_retries:
+                            print(f"[Stream] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                            current_account = next_account
+                            token = current_account.get_token()
+                            headers = current_account.build_headers(token)
+                            retry_count += 1
+                            continue
+                        
+                        if flow_id:
+                            flow_monitor.fail_flow(flow_id, "rate_limit_error", "All accounts rate limited", 429)
+                        yield AnthropicSSE.error("rate_limit_error", "All accounts rate limited")
+                        duration = (time.time() - start_time) * 1000
+                        state.add_log(RequestLog(
+                            id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
+                            model=model, account_id=current_account.id if current_account else None,
+                            status=429, duration_ms=duration, error="All accounts rate limited"
+                        ))
+                        stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
+                        return
+
+                    # 处理可重试的服务端错误
+                    if is_retryable_error(response.status_code):
+                        if retry_count < max_retries:
+                            print(f"[Stream] 服务端错误 {response.status_code}，重试 {retry_count + 1}/{max_retries}")
+                            retry_count += 1
+                            import asyncio
+                            await asyncio.sleep(0.5 * (2 ** retry_count))
+                            continue
+                        if flow_id:
+                            flow_monitor.fail_flow(flow_id, "api_error", "Server error after retries", response.status_code)
+                        yield AnthropicSSE.error("api_error", "Server error after retries")
+                        duration = (time.time() - start_time) * 1000
+                        state.add_log(RequestLog(
+                            id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
+                            model=model, account_id=current_account.id if current_account else None,
+                            status=response.status_code, duration_ms=duration, error="Server error after retries"
+                        ))
+                        stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
+                        return
+
+                    if response.status_code != 200:
+                        error_text = await response.aread()
+                        error_str = error_text.decode()
+                        print(f"=== Kiro API Error ===")
+                        print(f"Status: {response.status_code}")
+                        print(f"Response: {error_str[:500]}")
+                        print(f"Request model: {model}")
+                        print(f"History len: {len(history) if history else 0}")
+                        print(f"Tool results: {len(tool_results) if tool_results else 0}")
+                        # 对于 400 错误，打印更多请求细节
+                        if response.status_code == 400:
+                            print(f"Kiro request keys: {list(kiro_request.keys())}")
+                            if 'conversationState' in kiro_request:
+                                cs = kiro_request['conversationState']
+                                print(f"  conversationState keys: {list(cs.keys())}")
+                                if 'currentMessage' in cs:
+                                    cm = cs['currentMessage']
+                                    print(f"  currentMessage keys: {list(cm.keys())}")
+                                    if 'userInputMessage' in cm:
+                                        uim = cm['userInputMessage']
+                                        print(f"  userInputMessage keys: {list(uim.keys())}")
+                                        content = uim.get('content', '')
+                                        print(f"  content (first 200 chars): {str(content)[:200]}")
+                                if 'history' in cs:
+                                    hist = cs['history']
+                                    print(f"  history count: {len(hist) if hist else 0}")
+                                    if hist:
+                                        for i, h in enumerate(hist[:3]):
+                                            print(f"    history[{i}] keys: {list(h.keys()) if isinstance(h, dict) else type(h)}")
+                        print(f"======================")
+                        
+                        # 使用统一的错误处理
+                        http_status, error_type, error_msg, error_obj = _handle_kiro_error(
+                            response.status_code, error_str, current_account
+                        )
                         
-                        # 处理配额超限
-                        if response.status_code == 429 or is_quota_exceeded_error(response.status_code, ""):
-                            current_account.mark_quota_exceeded("Rate limited (stream)")
-                            
-                            # 尝试切换账号
+                        # 账号封禁 - 尝试切换账号
+                        if error_obj.should_switch_account:
                             next_account = state.get_next_available_account(current_account.id)
                             if next_account and retry_count < max_retries:
-                                print(f"[Stream] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                                print(f"[Stream] 切换账号: {current_account.id} -> {next_account.id}")
                                 current_account = next_account
-                                token = current_account.get_token()
-                                headers["Authorization"] = f"Bearer {token}"
+                                headers = current_account.build_headers()
                                 retry_count += 1
                                 continue
-                            
-                            if flow_id:
-                                flow_monitor.fail_flow(flow_id, "rate_limit_error", "All accounts rate limited", 429)
-                            yield f'event: error\ndata: {{"type":"error","error":{{"type":"rate_limit_error","message":"All accounts rate limited"}}}}\n\n'
-                            duration = (time.time() - start_time) * 1000
-                            state.add_log(RequestLog(
-                                id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
-                                model=model, account_id=current_account.id if current_account else None,
-                                status=429, duration_ms=duration, error="All accounts rate limited"
-                            ))
-                            stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
-                            return
-
-                        # 处理可重试的服务端错误
-                        if is_retryable_error(response.status_code):
-                            if retry_count < max_retries:
-                                print(f"[Stream] 服务端错误 {response.status_code}，重试 {retry_count + 1}/{max_retries}")
+                        
+                        # 检查是否为内容长度超限错误，尝试截断重试
+                        if error_obj.type == ErrorType.CONTENT_TOO_LONG:
+                            limit_predictor.record_request(kiro_request, ok=False)
+                            history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
+                                history, user_content
+                            )
+                            print(f"[Stream] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
+                            async def api_caller(prompt: str) -> str:
+                                return await _call_kiro_for_summary(prompt, current_account, headers)
+                            truncated_history, should_retry = await history_manager.handle_length_error_async(
+                                history, retry_count, api_caller
+                            )
+                            if should_retry:
+                                print(f"[Stream] 内容长度超限，{history_manager.truncate_info}")
+                                history = truncated_history
+                                # 重新构建请求
+                                kiro_request = build_kiro_request(user_content, model, history, kiro_tools, images, tool_results)
                                 retry_count += 1
-                                import asyncio
-                                await asyncio.sleep(0.5 * (2 ** retry_count))
                                 continue
-                            if flow_id:
-                                flow_monitor.fail_flow(flow_id, "api_error", "Server error after retries", response.status_code)
-                            yield f'event: error\ndata: {{"type":"error","error":{{"type":"api_error","message":"Server error after retries"}}}}\n\n'
-                            duration = (time.time() - start_time) * 1000
-                            state.add_log(RequestLog(
-                                id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
-                                model=model, account_id=current_account.id if current_account else None,
-                                status=response.status_code, duration_ms=duration, error="Server error after retries"
-                            ))
-                            stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
-                            return
-
-                        if response.status_code != 200:
-                            error_text = await response.aread()
-                            error_str = error_text.decode()
-                            print(f"=== Kiro API Error ===")
-                            print(f"Status: {response.status_code}")
-                            print(f"Response: {error_str[:500]}")
-                            print(f"Request model: {model}")
-                            print(f"History len: {len(history) if history else 0}")
-                            print(f"Tool results: {len(tool_results) if tool_results else 0}")
-                            # 对于 400 错误，打印更多请求细节
-                            if response.status_code == 400:
-                                print(f"Kiro request keys: {list(kiro_request.keys())}")
-                                if 'conversationState' in kiro_request:
-                                    cs = kiro_request['conversationState']
-                                    print(f"  conversationState keys: {list(cs.keys())}")
-                                    if 'currentMessage' in cs:
-                                        cm = cs['currentMessage']
-                                        print(f"  currentMessage keys: {list(cm.keys())}")
-                                        if 'userInputMessage' in cm:
-                                            uim = cm['userInputMessage']
-                                            print(f"  userInputMessage keys: {list(uim.keys())}")
-                                            content = uim.get('content', '')
-                                            print(f"  content (first 200 chars): {str(content)[:200]}")
-                                    if 'history' in cs:
-                                        hist = cs['history']
-                                        print(f"  history count: {len(hist) if hist else 0}")
-                                        if hist:
-                                            for i, h in enumerate(hist[:3]):
-                                                print(f"    history[{i}] keys: {list(h.keys()) if isinstance(h, dict) else type(h)}")
-                            print(f"======================")
-                            
-                            # 使用统一的错误处理
-                            http_status, error_type, error_msg, error_obj = _handle_kiro_error(
-                                response.status_code, error_str, current_account
-                            )
-                            
-                            # 账号封禁 - 尝试切换账号
-                            if error_obj.should_switch_account:
-                                next_account = state.get_next_available_account(current_account.id)
-                                if next_account and retry_count < max_retries:
-                                    print(f"[Stream] 切换账号: {current_account.id} -> {next_account.id}")
-                                    current_account = next_account
-                                    headers["Authorization"] = f"Bearer {current_account.get_token()}"
-                                    retry_count += 1
-                                    continue
-                            
-                            # 检查是否为内容长度超限错误，尝试截断重试
-                            if error_obj.type == ErrorType.CONTENT_TOO_LONG:
-                                history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
-                                    history, user_content
-                                )
-                                print(f"[Stream] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
-                                async def api_caller(prompt: str) -> str:
-                                    return await _call_kiro_for_summary(prompt, current_account, headers)
-                                truncated_history, should_retry = await history_manager.handle_length_error_async(
-                                    history, retry_count, api_caller
-                                )
-                                if should_retry:
-                                    print(f"[Stream] 内容长度超限，{history_manager.truncate_info}")
-                                    history = truncated_history
-                                    # 重新构建请求
-                                    kiro_request = build_kiro_request(user_content, model, history, kiro_tools, images, tool_results)
-                                    retry_count += 1
-                                    continue
-                            
-                            if flow_id:
-                                flow_monitor.fail_flow(flow_id, error_type, error_msg, response.status_code, error_str)
-                            yield f'event: error\ndata: {{"type":"error","error":{{"type":"{error_type}","message":"{error_msg}"}}}}\n\n'
-                            duration = (time.time() - start_time) * 1000
-                            state.add_log(RequestLog(
-                                id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
-                                model=model, account_id=current_account.id if current_account else None,
-                                status=response.status_code, duration_ms=duration, error=error_msg
-                            ))
-                            stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
-                            return
-
-                        # 标记开始流式传输
-                        if flow_id:
-                            flow_monitor.start_streaming(flow_id)
-
-                        # 正常处理响应
-                        msg_id = f"msg_{log_id}"
-                        yield f'event: message_start\ndata: {{"type":"message_start","message":{{"id":"{msg_id}","type":"message","role":"assistant","content":[],"model":"{model}","stop_reason":null,"stop_sequence":null,"usage":{{"input_tokens":0,"output_tokens":0}}}}}}\n\n'
-                        yield f'event: content_block_start\ndata: {{"type":"content_block_start","index":0,"content_block":{{"type":"text","text":""}}}}\n\n'
-                        yield f'event: ping\ndata: {{"type":"ping"}}\n\n'
-
-                        full_response = b""
-
-                        async for chunk in response.aiter_bytes():
-                            full_response += chunk
-
-                            try:
-                                pos = 0
-                                while pos < len(chunk):
-                                    if pos + 12 > len(chunk):
-                                        break
-                                    total_len = int.from_bytes(chunk[pos:pos+4], 'big')
-                                    if total_len == 0 or total_len > len(chunk) - pos:
-                                        break
-                                    headers_len = int.from_bytes(chunk[pos+4:pos+8], 'big')
-                                    payload_start = pos + 12 + headers_len
-                                    payload_end = pos + total_len - 4
-
-                                    if payload_start < payload_end:
-                                        try:
-                                            payload = json.loads(chunk[payload_start:payload_end].decode('utf-8'))
-                                            content = None
-                                            if 'assistantResponseEvent' in payload:
-                                                content = payload['assistantResponseEvent'].get('content')
-                                            elif 'content' in payload:
-                                                content = payload['content']
-                                            if content:
-                                                full_content += content
-                                                if flow_id:
-                                                    flow_monitor.add_chunk(flow_id, content)
-                                                yield f'event: content_block_delta\ndata: {{"type":"content_block_delta","index":0,"delta":{{"type":"text_delta","text":{json.dumps(content)}}}}}\n\n'
-                                        except Exception:
-                                            pass
-                                    pos += total_len
-                            except Exception:
-                                pass
-
-                        result = parse_event_stream_full(full_response)
-
-                        yield f'event: content_block_stop\ndata: {{"type":"content_block_stop","index":0}}\n\n'
-
-                        if result["tool_uses"]:
-                            for i, tool_use in enumerate(result["tool_uses"], 1):
-                                yield f'event: content_block_start\ndata: {{"type":"content_block_start","index":{i},"content_block":{{"type":"tool_use","id":"{tool_use["id"]}","name":"{tool_use["name"]}","input":{{}}}}}}\n\n'
-                                yield f'event: content_block_delta\ndata: {{"type":"content_block_delta","index":{i},"delta":{{"type":"input_json_delta","partial_json":{json.dumps(json.dumps(tool_use["input"]))}}}}}\n\n'
-                                yield f'event: content_block_stop\ndata: {{"type":"content_block_stop","index":{i}}}\n\n'
-
-                        stop_reason = result["stop_reason"]
-                        yield f'event: message_delta\ndata: {{"type":"message_delta","delta":{{"stop_reason":"{stop_reason}","stop_sequence":null}},"usage":{{"output_tokens":100}}}}\n\n'
-                        yield f'event: message_stop\ndata: {{"type":"message_stop"}}\n\n'
-
-                        # 完成 Flow
+                        
                         if flow_id:
-                            flow_monitor.complete_flow(
-                                flow_id,
-                                status_code=200,
-                                content=full_content,
-                                tool_calls=result.get("tool_uses", []),
-                                stop_reason=stop_reason,
-                                usage=TokenUsage(
-                                    input_tokens=result.get("input_tokens", 0),
-                                    output_tokens=result.get("output_tokens", 0),
-                                ),
-                            )
-
-                        current_account.request_count += 1
-                        current_account.last_used = time.time()
-                        get_rate_limiter().record_request(current_account.id)
+                            flow_monitor.fail_flow(flow_id, error_type, error_msg, response.status_code, error_str)
+                        yield AnthropicSSE.error(error_type, error_msg)
                         duration = (time.time() - start_time) * 1000
                         state.add_log(RequestLog(
                             id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
                             model=model, account_id=current_account.id if current_account else None,
-                            status=200, duration_ms=duration, error=None
+                            status=response.status_code, duration_ms=duration, error=error_msg
                         ))
-                        stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=True, latency_ms=duration)
+                        stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
                         return
 
+                    limit_predictor.record_request(kiro_request, ok=True)
+                    _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+
+                    # 标记开始流式传输
+                    if flow_id:
+                        flow_monitor.start_streaming(flow_id)
+
+                    # 正常处理响应
+                    if not message_started:
+                        yield AnthropicSSE.message_start(f"msg_{log_id}", model)
+                        message_started = True
+                    if not block_started:
+                        yield AnthropicSSE.text_block_start(0)
+                        yield AnthropicSSE.PING
+                        block_started = True
+
+                    # 单遍解析：边解码边汇总文本和工具调用，不缓存原始响应
+                    decoder = EventStreamDecoder()
+                    accumulator = ResponseAccumulator()
+                    coalescer = DeltaCoalescer()
+
+                    # 内容块按到达顺序交替（文本 / 工具调用），index 依次递增
+                    # open_block: "text" 表示文本块打开，其余为打开中的 toolUseId
+                    block_index = 0
+                    open_block = "text"
+                    closed_tools = set()
+
+                    def flush_delta() -> bytes:
+                        """发送当前块中合并未发的增量"""
+                        pending = coalescer.flush()
+                        if not pending:
+                            return b""
+                        if open_block == "text":
+                            return AnthropicSSE.text_delta(block_index, pending)
+                        return AnthropicSSE.input_json_delta(block_index, pending)
+
+                    async for chunk in iter_coalesced(response.aiter_bytes(), coalescer):
+                        if chunk is None:
+                            output_started = True
+                            yield flush_delta()
+                            continue
+
+                        out = []
+                        for event in decoder.feed(chunk):
+                            accumulator.add(event)
+
+                            if isinstance(event, TextDelta):
+                                if open_block != "text":
+                                    out.append(flush_delta())
+                                    if open_block is not None:
+                                        out.append(AnthropicSSE.block_stop(block_index))
+                                    block_index += 1
+                                    open_block = "text"
+                                    out.append(AnthropicSSE.text_block_start(block_index))
+                                if flow_id:
+                                    flow_monitor.add_chunk(flow_id, event.text)
+                                merged = coalescer.add(event.text)
+                                if merged:
+                                    out.append(AnthropicSSE.text_delta(block_index, merged))
+
+                            elif isinstance(event, ToolUseDelta):
+                                tool_id = event.tool_use_id
+                                if not tool_id or tool_id in closed_tools:
+                                    continue
+                                if open_block != tool_id:
+                                    out.append(flush_delta())
+                                    if open_block is not None:
+                                        out.append(AnthropicSSE.block_stop(block_index))
+                                    block_index += 1
+                                    open_block = tool_id
+                                    if flow_id:
+                                        flow_monitor.mark_first_tool_byte(flow_id)
+                                    out.append(AnthropicSSE.tool_block_start(block_index, tool_id, event.name))
+                                merged = coalescer.add(event.input)
+                                if merged:
+                                    out.append(AnthropicSSE.input_json_delta(block_index, merged))
+                                if event.stop:
+                                    out.append(flush_delta())
+                                    out.append(AnthropicSSE.block_stop(block_index))
+                                    closed_tools.add(tool_id)
+                                    open_block = None
+
+                        # 同一网络块解出的事件合并为一次发送
+                        data = b"".join(out)
+                        if data:
+                            output_started = True
+                            yield data
+
+                    tail = flush_delta()
+                    if open_block is not None:
+                        tail += AnthropicSSE.block_stop(block_index)
+
+                    result = accumulator.to_result()
+                    full_content = accumulator.text
+
+                    stop_reason = result["stop_reason"]
+                    yield tail + AnthropicSSE.message_delta(stop_reason, 100) + AnthropicSSE.MESSAGE_STOP
+
+                    # 完成 Flow
+                    if flow_id:
+                        flow_monitor.complete_flow(
+                            flow_id,
+                            status_code=200,
+                            content=full_content,
+                            tool_calls=result.get("tool_uses", []),
+                            stop_reason=stop_reason,
+                            usage=TokenUsage(
+                                input_tokens=result.get("input_tokens", 0),
+                                output_tokens=result.get("output_tokens", 0),
+                            ),
+                        )
+
+                    current_account.request_count += 1
+                    current_account.last_used = time.time()
+                    get_rate_limiter().record_request(current_account.id)
+                    duration = (time.time() - start_time) * 1000
+                    state.add_log(RequestLog(
+                        id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
+                        model=model, account_id=current_account.id if current_account else None,
+                        status=200, duration_ms=duration, error=None
+                    ))
+                    stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=True, latency_ms=duration)
+                    return
+
             except httpx.TimeoutException:
-                if retry_count < max_retries:
+                if retry_count < max_retries and not output_started:
                     print(f"[Stream] 请求超时，重试 {retry_count + 1}/{max_retries}")
                     retry_count += 1
                     import asyncio
@@ -445,7 +547,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                     continue
                 if flow_id:
                     flow_monitor.fail_flow(flow_id, "timeout_error", "Request timeout after retries", 408)
-                yield f'event: error\ndata: {{"type":"error","error":{{"type":"api_error","message":"Request timeout after retries"}}}}\n\n'
+                yield AnthropicSSE.error("api_error", "Request timeout after retries")
                 duration = (time.time() - start_time) * 1000
                 state.add_log(RequestLog(
                     id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
@@ -455,7 +557,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                 stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
                 return
             except httpx.ConnectError:
-                if retry_count < max_retries:
+                if retry_count < max_retries and not output_started:
                     print(f"[Stream] 连接错误，重试 {retry_count + 1}/{max_retries}")
                     retry_count += 1
                     import asyncio
@@ -463,7 +565,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                     continue
                 if flow_id:
                     flow_monitor.fail_flow(flow_id, "connection_error", "Connection error after retries", 502)
-                yield f'event: error\ndata: {{"type":"error","error":{{"type":"api_error","message":"Connection error after retries"}}}}\n\n'
+                yield AnthropicSSE.error("api_error", "Connection error after retries")
                 duration = (time.time() - start_time) * 1000
                 state.add_log(RequestLog(
                     id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
@@ -474,7 +576,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                 return
             except Exception as e:
                 # 检查是否为可重试的网络错误
-                if is_retryable_error(None, e) and retry_count < max_retries:
+                if is_retryable_error(None, e) and retry_count < max_retries and not output_started:
                     print(f"[Stream] 网络错误，重试 {retry_count + 1}/{max_retries}: {type(e).__name__}")
                     retry_count += 1
                     import asyncio
@@ -482,7 +584,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                     continue
                 if flow_id:
                     flow_monitor.fail_flow(flow_id, "api_error", str(e), 500)
-                yield f'event: error\ndata: {{"type":"error","error":{{"type":"api_error","message":"{str(e)}"}}}}\n\n'
+                yield AnthropicSSE.error("api_error", str(e))
                 duration = (time.time() - start_time) * 1000
                 state.add_log(RequestLog(
                     id=log_id, timestamp=time.time(), method="POST", path="/v1/messages",
@@ -492,7 +594,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                 stats_manager.record_request(account_id=current_account.id if current_account else "unknown", model=model, success=False, latency_ms=duration)
                 return
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return generate()
 
 
 async def _handle_non_stream(kiro_request, headers, account, model, log_id, start_time, session_id=None, flow_id=None, history=None, user_content="", kiro_tools=None, images=None, tool_results=None, history_manager=None):
@@ -507,100 +609,105 @@ async def _handle_non_stream(kiro_request, headers, account, model, log_id, star
     for retry in range(max_retries + 1):
         should_log = False
         try:
-            async with httpx.AsyncClient(verify=False, timeout=300) as client:
-                response = await client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-                status_code = response.status_code
-
-                # 处理配额超限
-                if response.status_code == 429 or is_quota_exceeded_error(response.status_code, response.text):
-                    current_account.mark_quota_exceeded("Rate limited")
-                    
-                    # 尝试切换账号
+            client = get_http_client()
+            body = encode_kiro_request(kiro_request)
+            flow_monitor.record_upstream_body(flow_id, len(body), kiro_request.encode_ms)
+            response = await client.post(KIRO_API_URL, content=body, headers=headers, timeout=300)
+            status_code = response.status_code
+
+            # 处理配额超限
+            if response.status_code == 429 or is_quota_exceeded_error(response.status_code, response.text):
+                current_account.mark_quota_exceeded("Rate limited")
+                
+                # 尝试切换账号
+                next_account = state.get_next_available_account(current_account.id)
+                if next_account and retry < max_retries:
+                    print(f"[NonStream] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                    current_account = next_account
+                    token = current_account.get_token()
+                    headers = current_account.build_headers(token)
+                    continue
+                
+                if flow_id:
+                    flow_monitor.fail_flow(flow_id, "rate_limit_error", "All accounts rate limited", 429)
+                raise HTTPException(429, "All accounts rate limited")
+
+            # 处理可重试的服务端错误
+            if is_retryable_error(response.status_code):
+                if retry < max_retries:
+                    print(f"[NonStream] 服务端错误 {response.status_code}，重试 {retry + 1}/{max_retries}")
+                    await retry_ctx.wait()
+                    continue
+                if flow_id:
+                    flow_monitor.fail_flow(flow_id, "api_error", f"Server error after {max_retries} retries", response.status_code)
+                raise HTTPException(response.status_code, f"Server error after {max_retries} retries")
+
+            if response.status_code != 200:
+                error_msg = response.text
+                print(f"[NonStream] Kiro API Error {response.status_code}: {error_msg[:500]}")
+                
+                # 使用统一的错误处理
+                status, error_type, error_message, error_obj = _handle_kiro_error(
+                    response.status_code, error_msg, current_account
+                )
+                
+                # 账号封禁或配额超限 - 尝试切换账号
+                if error_obj.should_switch_account:
                     next_account = state.get_next_available_account(current_account.id)
                     if next_account and retry < max_retries:
-                        print(f"[NonStream] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                        print(f"[NonStream] 切换账号: {current_account.id} -> {next_account.id}")
                         current_account = next_account
-                        token = current_account.get_token()
-                        creds = current_account.get_credentials()
-                        headers["Authorization"] = f"Bearer {token}"
-                        continue
-                    
-                    if flow_id:
-                        flow_monitor.fail_flow(flow_id, "rate_limit_error", "All accounts rate limited", 429)
-                    raise HTTPException(429, "All accounts rate limited")
-
-                # 处理可重试的服务端错误
-                if is_retryable_error(response.status_code):
-                    if retry < max_retries:
-                        print(f"[NonStream] 服务端错误 {response.status_code}，重试 {retry + 1}/{max_retries}")
-                        await retry_ctx.wait()
+                        headers = current_account.build_headers()
                         continue
-                    if flow_id:
-                        flow_monitor.fail_flow(flow_id, "api_error", f"Server error after {max_retries} retries", response.status_code)
-                    raise HTTPException(response.status_code, f"Server error after {max_retries} retries")
-
-                if response.status_code != 200:
-                    error_msg = response.text
-                    print(f"[NonStream] Kiro API Error {response.status_code}: {error_msg[:500]}")
-                    
-                    # 使用统一的错误处理
-                    status, error_type, error_message, error_obj = _handle_kiro_error(
-                        response.status_code, error_msg, current_account
+                
+                # 检查是否为内容长度超限错误，尝试截断重试
+                if error_obj.type == ErrorType.CONTENT_TOO_LONG:
+                    limit_predictor.record_request(kiro_request, ok=False)
+                if error_obj.type == ErrorType.CONTENT_TOO_LONG and history_manager:
+                    history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
+                        history, user_content
                     )
-                    
-                    # 账号封禁或配额超限 - 尝试切换账号
-                    if error_obj.should_switch_account:
-                        next_account = state.get_next_available_account(current_account.id)
-                        if next_account and retry < max_retries:
-                            print(f"[NonStream] 切换账号: {current_account.id} -> {next_account.id}")
-                            current_account = next_account
-                            headers["Authorization"] = f"Bearer {current_account.get_token()}"
-                            continue
-                    
-                    # 检查是否为内容长度超限错误，尝试截断重试
-                    if error_obj.type == ErrorType.CONTENT_TOO_LONG and history_manager:
-                        history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
-                            history, user_content
-                        )
-                        print(f"[NonStream] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
-                        async def api_caller(prompt: str) -> str:
-                            return await _call_kiro_for_summary(prompt, current_account, headers)
-                        truncated_history, should_retry = await history_manager.handle_length_error_async(
-                            history, retry, api_caller
-                        )
-                        if should_retry:
-                            print(f"[NonStream] 内容长度超限，{history_manager.truncate_info}")
-                            history = truncated_history
-                            kiro_request = build_kiro_request(user_content, model, history, kiro_tools, images, tool_results)
-                            continue
-                        else:
-                            print(f"[NonStream] 内容长度超限但未重试: retry={retry}/{max_retries}")
-                    
-                    if flow_id:
-                        flow_monitor.fail_flow(flow_id, error_type, error_message, status, error_msg)
-                    raise HTTPException(status, error_message)
+                    print(f"[NonStream] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
+                    async def api_caller(prompt: str) -> str:
+                        return await _call_kiro_for_summary(prompt, current_account, headers)
+                    truncated_history, should_retry = await history_manager.handle_length_error_async(
+                        history, retry, api_caller
+                    )
+                    if should_retry:
+                        print(f"[NonStream] 内容长度超限，{history_manager.truncate_info}")
+                        history = truncated_history
+                        kiro_request = build_kiro_request(user_content, model, history, kiro_tools, images, tool_results)
+                        continue
+                    else:
+                        print(f"[NonStream] 内容长度超限但未重试: retry={retry}/{max_retries}")
+                
+                if flow_id:
+                    flow_monitor.fail_flow(flow_id, error_type, error_message, status, error_msg)
+                raise HTTPException(status, error_message)
 
-                result = parse_event_stream_full(response.content)
-                current_account.request_count += 1
-                current_account.last_used = time.time()
-                get_rate_limiter().record_request(current_account.id)
+            limit_predictor.record_request(kiro_request, ok=True)
+            _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+            result = parse_event_stream_full(response.content)
+            current_account.request_count += 1
+            current_account.last_used = time.time()
+            get_rate_limiter().record_request(current_account.id)
 
-                # 完成 Flow
-                if flow_id:
-                    flow_monitor.complete_flow(
-                        flow_id,
-                        status_code=200,
-                        content=result.get("text", ""),
-                        tool_calls=result.get("tool_uses", []),
-                        stop_reason=result.get("stop_reason", ""),
-                        usage=TokenUsage(
-                            input_tokens=result.get("input_tokens", 0),
-                            output_tokens=result.get("output_tokens", 0),
-                        ),
-                    )
+            # 完成 Flow
+            if flow_id:
+                flow_monitor.complete_flow(
+                    flow_id,
+                    status_code=200,
+                    content=result.get("text", ""),
+                    tool_calls=result.get("tool_uses", []),
+                    stop_reason=result.get("stop_reason", ""),
+                    usage=TokenUsage(
+                        input_tokens=result.get("input_tokens", 0),
+                        output_tokens=result.get("output_tokens", 0),
+                    ),
+                )
 
-                should_log = True
-                return convert_kiro_response_to_anthropic(result, model, f"msg_{log_id}")
+            should_log = True
+            return convert_kiro_response_to_anthropic(result, model, f"msg_{log_id}")
 
         except HTTPException:
             should_log = True
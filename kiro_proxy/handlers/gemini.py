@@ -1,28 +1,62 @@
-"""Gemini 协议处理 - /v1/models/{model}:generateContent"""
-import json
+"""Gemini 协议处理 - /v1/models/{model}:generateContent, :streamGenerateContent"""
 import uuid
 import time
 import hashlib
 import asyncio
 import httpx
 from fastapi import Request, HTTPException
+from fastapi.responses import StreamingResponse
 
+from .. import jsonfast
 from ..config import KIRO_API_URL, map_model_name
-from ..core import state, is_retryable_error
+from ..core import state, is_retryable_error, stats_manager
 from ..core.state import RequestLog
 from ..core.history_manager import HistoryManager, get_history_config, is_content_length_error
 from ..core.error_handler import classify_error, ErrorType, format_error_log
 from ..core.rate_limiter import get_rate_limiter
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error
+from ..core.limit_predictor import limit_predictor, measure_kiro_request
+from ..core.tokenizer import token_counter, count_tokens
+from ..core.summarizer import background_summarizer
+from ..core.http_client import get_http_client
+from ..core.stream_guard import open_upstream_stream, guard_stream
+from ..core.sse import GeminiSSE, DeltaCoalescer, iter_coalesced
+from ..providers.event_stream import EventStreamDecoder, ResponseAccumulator, TextDelta
+from ..kiro_api import build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error, encode_kiro_request
 from ..converters import convert_gemini_contents_to_kiro, convert_kiro_response_to_gemini, convert_gemini_tools_to_kiro
 
 
-async def handle_generate_content(model_name: str, request: Request):
-    """处理 Gemini generateContent 请求"""
+async def _call_kiro_for_summary(prompt: str, headers: dict) -> str:
+    """调用 Kiro API 生成摘要"""
+    req = build_kiro_request(prompt, "claude-haiku-4.5", [])
+    try:
+        client = get_http_client()
+        resp = await client.post(KIRO_API_URL, content=encode_kiro_request(req), headers=headers, timeout=60)
+        if resp.status_code == 200:
+            return parse_event_stream(resp.content)
+    except Exception as e:
+        print(f"[Summary] API 调用失败: {e}")
+    return ""
+
+
+def _schedule_background_summary(history_manager, history, user_content, account, headers):
+    """响应成功后在后台为下一轮预生成摘要
+
+    下一轮的历史由本轮预处理前的完整历史加上本轮消息和回复组成。
+    """
+    if not history_manager:
+        return
+    history = history_manager.source_history or history
+    async def api_caller(prompt: str) -> str:
+        return await _call_kiro_for_summary(prompt, headers)
+    background_summarizer.schedule(history_manager, history, user_content, account, api_caller)
+
+
+async def handle_generate_content(model_name: str, request: Request, stream: bool = False):
+    """处理 Gemini generateContent / streamGenerateContent 请求"""
     start_time = time.time()
     log_id = uuid.uuid4().hex[:8]
     
-    body = await request.json()
+    body = jsonfast.loads(await request.body())
     contents = body.get("contents", [])
     system_instruction = body.get("systemInstruction", {})
     tools = body.get("tools", [])
@@ -31,7 +65,7 @@ async def handle_generate_content(model_name: str, request: Request):
     model_raw = model_name.replace("models/", "")
     model = map_model_name(model_raw)
     
-    session_id = hashlib.sha256(json.dumps(contents[:3], sort_keys=True).encode()).hexdigest()[:16]
+    session_id = hashlib.sha256(jsonfast.dumpb(contents[:3], sort_keys=True)).hexdigest()[:16]
     account = state.get_available_account(session_id)
     
     if not account:
@@ -49,13 +83,7 @@ async def handle_generate_content(model_name: str, request: Request):
         raise HTTPException(500, f"Failed to get token for account {account.name}")
     
     # 构建 headers（提前构建，供摘要使用）
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
+    headers = account.build_headers(token)
     
     # 限速检查
     rate_limiter = get_rate_limiter()
@@ -73,21 +101,16 @@ async def handle_generate_content(model_name: str, request: Request):
     history_manager = HistoryManager(get_history_config(), cache_key=session_id)
     
     async def call_summary(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            async with httpx.AsyncClient(verify=False, timeout=60) as client:
-                resp = await client.post(KIRO_API_URL, json=req, headers=headers)
-                if resp.status_code == 200:
-                    return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Summary] API 调用失败: {e}")
-        return ""
+        return await _call_kiro_for_summary(prompt, headers)
 
     # 检查是否需要智能摘要或错误重试预摘要
     if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
-        history = await history_manager.pre_process_async(history, user_content, call_summary)
+        history = await history_manager.pre_process_async(history, user_content, call_summary, tool_results)
     else:
-        history = history_manager.pre_process(history, user_content)
+        history = history_manager.pre_process(history, user_content, tool_results)
+    
+    # 按该模型学到的上限预先截断
+    history = history_manager.fit_learned_limit(history, user_content, model, kiro_tools, None, tool_results)
     
     # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
     from ..converters import fix_history_alternation
@@ -96,17 +119,6 @@ async def handle_generate_content(model_name: str, request: Request):
     if history_manager.was_truncated:
         print(f"[Gemini] {history_manager.truncate_info}")
 
-    async def call_summary(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            async with httpx.AsyncClient(verify=False, timeout=60) as client:
-                resp = await client.post(KIRO_API_URL, json=req, headers=headers)
-                if resp.status_code == 200:
-                    return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Summary] API 调用失败: {e}")
-        return ""
-    
     # 构建 Kiro 请求
     kiro_request = build_kiro_request(
         user_content, model, history,
@@ -114,6 +126,15 @@ async def handle_generate_content(model_name: str, request: Request):
         tool_results=tool_results if tool_results else None
     )
     
+    if stream:
+        return _handle_stream(
+            kiro_request, headers, account, model, model_name, log_id, start_time,
+            sse=request.query_params.get("alt") == "sse",
+            history=history, user_content=user_content,
+            kiro_tools=kiro_tools, tool_results=tool_results,
+            history_manager=history_manager, request=request,
+        )
+    
     error_msg = None
     status_code = 200
     content = ""
@@ -123,94 +144,91 @@ async def handle_generate_content(model_name: str, request: Request):
     try:
       for retry in range(max_retries + 1):
         try:
-            async with httpx.AsyncClient(verify=False, timeout=120) as client:
-                resp = await client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-                status_code = resp.status_code
+            client = get_http_client()
+            resp = await client.post(KIRO_API_URL, content=encode_kiro_request(kiro_request), headers=headers, timeout=120)
+            status_code = resp.status_code
+            
+            # 处理配额超限
+            if resp.status_code == 429 or is_quota_exceeded_error(resp.status_code, resp.text):
+                current_account.mark_quota_exceeded("Rate limited")
+                next_account = state.get_next_available_account(current_account.id)
+                if next_account and retry < max_retries:
+                    print(f"[Gemini] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                    current_account = next_account
+                    token = current_account.get_token()
+                    headers = current_account.build_headers(token)
+                    continue
+                raise HTTPException(429, "All accounts rate limited")
+            
+            # 处理可重试的服务端错误
+            if is_retryable_error(resp.status_code):
+                if retry < max_retries:
+                    print(f"[Gemini] 服务端错误 {resp.status_code}，重试 {retry + 1}/{max_retries}")
+                    import asyncio
+                    await asyncio.sleep(0.5 * (2 ** retry))
+                    continue
+                raise HTTPException(resp.status_code, f"Server error after {max_retries} retries")
+            
+            if resp.status_code != 200:
+                error_msg = resp.text
+                
+                # 使用统一的错误处理
+                error = classify_error(resp.status_code, error_msg)
+                print(format_error_log(error, current_account.id))
+                
+                # 账号封禁 - 禁用账号
+                if error.should_disable_account:
+                    current_account.enabled = False
+                    from ..credential import CredentialStatus
+                    current_account.status = CredentialStatus.SUSPENDED
+                    print(f"[Gemini] 账号 {current_account.id} 已被禁用 (封禁)")
                 
-                # 处理配额超限
-                if resp.status_code == 429 or is_quota_exceeded_error(resp.status_code, resp.text):
-                    current_account.mark_quota_exceeded("Rate limited")
+                # 配额超限 - 标记冷却
+                if error.type == ErrorType.RATE_LIMITED:
+                    current_account.mark_quota_exceeded(error_msg[:100])
+                
+                # 尝试切换账号
+                if error.should_switch_account:
                     next_account = state.get_next_available_account(current_account.id)
                     if next_account and retry < max_retries:
-                        print(f"[Gemini] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                        print(f"[Gemini] 切换账号: {current_account.id} -> {next_account.id}")
                         current_account = next_account
-                        token = current_account.get_token()
-                        creds = current_account.get_credentials()
-                        headers = build_headers(
-                            token,
-                            machine_id=current_account.get_machine_id(),
-                            profile_arn=creds.profile_arn if creds else None,
-                            client_id=creds.client_id if creds else None
-                        )
-                        continue
-                    raise HTTPException(429, "All accounts rate limited")
-                
-                # 处理可重试的服务端错误
-                if is_retryable_error(resp.status_code):
-                    if retry < max_retries:
-                        print(f"[Gemini] 服务端错误 {resp.status_code}，重试 {retry + 1}/{max_retries}")
-                        import asyncio
-                        await asyncio.sleep(0.5 * (2 ** retry))
+                        headers = current_account.build_headers()
                         continue
-                    raise HTTPException(resp.status_code, f"Server error after {max_retries} retries")
                 
-                if resp.status_code != 200:
-                    error_msg = resp.text
-                    
-                    # 使用统一的错误处理
-                    error = classify_error(resp.status_code, error_msg)
-                    print(format_error_log(error, current_account.id))
-                    
-                    # 账号封禁 - 禁用账号
-                    if error.should_disable_account:
-                        current_account.enabled = False
-                        from ..credential import CredentialStatus
-                        current_account.status = CredentialStatus.SUSPENDED
-                        print(f"[Gemini] 账号 {current_account.id} 已被禁用 (封禁)")
-                    
-                    # 配额超限 - 标记冷却
-                    if error.type == ErrorType.RATE_LIMITED:
-                        current_account.mark_quota_exceeded(error_msg[:100])
-                    
-                    # 尝试切换账号
-                    if error.should_switch_account:
-                        next_account = state.get_next_available_account(current_account.id)
-                        if next_account and retry < max_retries:
-                            print(f"[Gemini] 切换账号: {current_account.id} -> {next_account.id}")
-                            current_account = next_account
-                            headers["Authorization"] = f"Bearer {current_account.get_token()}"
-                            continue
-                    
-                    # 检查是否为内容长度超限错误
-                    if error.type == ErrorType.CONTENT_TOO_LONG:
-                        history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
-                            history, user_content
-                        )
-                        print(f"[Gemini] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
-                        truncated_history, should_retry = await history_manager.handle_length_error_async(
-                            history, retry, call_summary
+                # 检查是否为内容长度超限错误
+                if error.type == ErrorType.CONTENT_TOO_LONG:
+                    limit_predictor.record_request(kiro_request, ok=False)
+                    history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
+                        history, user_content
+                    )
+                    print(f"[Gemini] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
+                    truncated_history, should_retry = await history_manager.handle_length_error_async(
+                        history, retry, call_summary
+                    )
+                    if should_retry:
+                        print(f"[Gemini] 内容长度超限，{history_manager.truncate_info}")
+                        history = truncated_history
+                        kiro_request = build_kiro_request(
+                            user_content, model, history,
+                            tools=kiro_tools if kiro_tools else None,
+                            tool_results=tool_results if tool_results else None
                         )
-                        if should_retry:
-                            print(f"[Gemini] 内容长度超限，{history_manager.truncate_info}")
-                            history = truncated_history
-                            kiro_request = build_kiro_request(
-                                user_content, model, history,
-                                tools=kiro_tools if kiro_tools else None,
-                                tool_results=tool_results if tool_results else None
-                            )
-                            continue
-                        else:
-                            print(f"[Gemini] 内容长度超限但未重试: retry={retry}/{max_retries}")
-                    
-                    raise HTTPException(resp.status_code, error.user_message)
-                
-                # 使用完整解析以支持工具调用
-                result = parse_event_stream_full(resp.content)
-                current_account.request_count += 1
-                current_account.last_used = time.time()
-                get_rate_limiter().record_request(current_account.id)
-                break
+                        continue
+                    else:
+                        print(f"[Gemini] 内容长度超限但未重试: retry={retry}/{max_retries}")
                 
+                raise HTTPException(resp.status_code, error.user_message)
+            
+            limit_predictor.record_request(kiro_request, ok=True)
+            _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+            # 使用完整解析以支持工具调用
+            result = parse_event_stream_full(resp.content)
+            current_account.request_count += 1
+            current_account.last_used = time.time()
+            get_rate_limiter().record_request(current_account.id)
+            break
+            
         except HTTPException:
             raise
         except httpx.TimeoutException:
@@ -257,3 +275,236 @@ async def handle_generate_content(model_name: str, request: Request):
     
     # 使用转换函数生成 Gemini 格式响应
     return convert_kiro_response_to_gemini(result, model)
+
+
+# Kiro 错误 -> Gemini 错误状态
+_GEMINI_ERROR_STATUS = {
+    400: "INVALID_ARGUMENT",
+    401: "UNAUTHENTICATED",
+    403: "PERMISSION_DENIED",
+    404: "NOT_FOUND",
+    408: "DEADLINE_EXCEEDED",
+    429: "RESOURCE_EXHAUSTED",
+    503: "UNAVAILABLE",
+}
+
+
+def _handle_stream(kiro_request, headers, account, model, model_name, log_id, start_time, sse=True, history=None, user_content="", kiro_tools=None, tool_results=None, history_manager=None, request=None):
+    """流式响应：Kiro event-stream 帧到达即转换为 GenerateContentResponse 片段
+
+    alt=sse 时输出 SSE（data: {...}），否则按 Gemini REST 约定输出 JSON 数组。
+    文本增量直接转发；functionCall 的 args 必须完整，所以在工具调用结束时整体发送。
+    """
+    path = f"/v1/models/{model_name}:streamGenerateContent"
+    encoder = GeminiSSE(sse)
+
+    def _candidate(parts: list, finish_reason: str = None) -> dict:
+        candidate = {"content": {"parts": parts, "role": "model"}, "index": 0}
+        if finish_reason:
+            candidate["finishReason"] = finish_reason
+        return {"candidates": [candidate]}
+
+    def _error(code: int, message: str) -> bytes:
+        return encoder.data({"error": {
+            "code": code,
+            "message": message,
+            "status": _GEMINI_ERROR_STATUS.get(code, "INTERNAL"),
+        }})
+
+    def _log(current_account, status: int, error: str = None):
+        duration = (time.time() - start_time) * 1000
+        state.add_log(RequestLog(
+            id=log_id, timestamp=time.time(), method="POST", path=path,
+            model=model, account_id=current_account.id if current_account else None,
+            status=status, duration_ms=duration, error=error
+        ))
+        stats_manager.record_request(
+            account_id=current_account.id if current_account else "unknown",
+            model=model, success=status == 200, latency_ms=duration
+        )
+
+    async def generate():
+        nonlocal kiro_request, history, headers
+        current_account = account
+        retry_count = 0
+        max_retries = 2
+        # 已向客户端输出响应内容后不再重试（重试会重复已发送的内容），上游中断时发送错误后结束
+        output_started = False
+
+        while retry_count <= max_retries:
+            try:
+                async with open_upstream_stream(current_account, kiro_request, headers) as response:
+
+                    # 处理配额超限
+                    if response.status_code == 429 or is_quota_exceeded_error(response.status_code, ""):
+                        current_account.mark_quota_exceeded("Rate limited (stream)")
+                        next_account = state.get_next_available_account(current_account.id)
+                        if next_account and retry_count < max_retries:
+                            print(f"[Gemini] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                            current_account = next_account
+                            headers = current_account.build_headers()
+                            retry_count += 1
+                            continue
+                        yield _error(429, "All accounts rate limited")
+                        yield encoder.end()
+                        _log(current_account, 429, "All accounts rate limited")
+                        return
+
+                    # 处理可重试的服务端错误
+                    if is_retryable_error(response.status_code):
+                        if retry_count < max_retries:
+                            print(f"[Gemini] 服务端错误 {response.status_code}，重试 {retry_count + 1}/{max_retries}")
+                            retry_count += 1
+                            await asyncio.sleep(0.5 * (2 ** retry_count))
+                            continue
+                        yield _error(response.status_code, "Server error after retries")
+                        yield encoder.end()
+                        _log(current_account, response.status_code, "Server error after retries")
+                        return
+
+                    if response.status_code != 200:
+                        error_str = (await response.aread()).decode(errors="replace")
+
+                        error = classify_error(response.status_code, error_str)
+                        print(format_error_log(error, current_account.id))
+
+                        # 账号封禁 - 禁用账号
+                        if error.should_disable_account:
+                            current_account.enabled = False
+                            from ..credential import CredentialStatus
+                            current_account.status = CredentialStatus.SUSPENDED
+                            print(f"[Gemini] 账号 {current_account.id} 已被禁用 (封禁)")
+
+                        # 配额超限 - 标记冷却
+                        if error.type == ErrorType.RATE_LIMITED:
+                            current_account.mark_quota_exceeded(error_str[:100])
+
+                        # 尝试切换账号
+                        if error.should_switch_account:
+                            next_account = state.get_next_available_account(current_account.id)
+                            if next_account and retry_count < max_retries:
+                                print(f"[Gemini] 切换账号: {current_account.id} -> {next_account.id}")
+                                current_account = next_account
+                                headers = current_account.build_headers()
+                                retry_count += 1
+                                continue
+
+                        # 内容长度超限，尝试截断重试
+                        if error.type == ErrorType.CONTENT_TOO_LONG:
+                            limit_predictor.record_request(kiro_request, ok=False)
+                        if error.type == ErrorType.CONTENT_TOO_LONG and history_manager:
+                            async def api_caller(prompt: str) -> str:
+                                return await _call_kiro_for_summary(prompt, headers)
+                            truncated_history, should_retry = await history_manager.handle_length_error_async(
+                                history, retry_count, api_caller
+                            )
+                            if should_retry:
+                                print(f"[Gemini] 内容长度超限，{history_manager.truncate_info}")
+                                history = truncated_history
+                                kiro_request = build_kiro_request(
+                                    user_content, model, history,
+                                    tools=kiro_tools if kiro_tools else None,
+                                    tool_results=tool_results if tool_results else None
+                                )
+                                retry_count += 1
+                                continue
+
+                        yield _error(response.status_code, error.user_message)
+                        yield encoder.end()
+                        _log(current_account, response.status_code, error.user_message)
+                        return
+
+                    limit_predictor.record_request(kiro_request, ok=True)
+                    _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+
+                    decoder = EventStreamDecoder()
+                    accumulator = ResponseAccumulator()
+                    coalescer = DeltaCoalescer()
+
+                    async for chunk in iter_coalesced(response.aiter_bytes(), coalescer):
+                        if chunk is None:
+                            output_started = True
+                            yield encoder.text(coalescer.flush())
+                            continue
+                        out = []
+                        for event in decoder.feed(chunk):
+                            tool_use = accumulator.add(event)
+                            if isinstance(event, TextDelta):
+                                merged = coalescer.add(event.text)
+                                if merged:
+                                    out.append(encoder.text(merged))
+                            elif tool_use:
+                                if coalescer.pending:
+                                    out.append(encoder.text(coalescer.flush()))
+                                out.append(encoder.data(_candidate([
+                                    {"functionCall": {"name": tool_use["name"], "args": tool_use["input"]}}
+                                ])))
+                        if out:
+                            output_started = True
+                            yield b"".join(out)
+
+                    if coalescer.pending:
+                        yield encoder.text(coalescer.flush())
+
+                    # 未收到 stop 片段的工具调用在结束时补发
+                    sent = {t["id"] for t in accumulator.tool_uses}
+                    result = accumulator.to_result()
+                    parts = [
+                        {"functionCall": {"name": t["name"], "args": t["input"]}}
+                        for t in result["tool_uses"] if t["id"] not in sent
+                    ]
+
+                    # 与限制学习共用计数缓存，不再重新序列化整个请求
+                    prompt_tokens = measure_kiro_request(kiro_request).tokens
+                    output_tokens = count_tokens(accumulator.text)
+                    for tool_use in result["tool_uses"]:
+                        output_tokens += token_counter.count_value(tool_use["input"])
+                    final = _candidate(parts or [{"text": ""}], "STOP")
+                    final["usageMetadata"] = {
+                        "promptTokenCount": prompt_tokens,
+                        "candidatesTokenCount": output_tokens,
+                        "totalTokenCount": prompt_tokens + output_tokens,
+                    }
+                    final["modelVersion"] = model_name.replace("models/", "")
+                    yield encoder.data(final)
+                    yield encoder.end()
+
+                    current_account.request_count += 1
+                    current_account.last_used = time.time()
+                    get_rate_limiter().record_request(current_account.id)
+                    _log(current_account, 200)
+                    return
+
+            except httpx.TimeoutException:
+                if retry_count < max_retries and not output_started:
+                    print(f"[Gemini] 请求超时，重试 {retry_count + 1}/{max_retries}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _error(408, "Request timeout after retries")
+                yield encoder.end()
+                _log(current_account, 408, "Request timeout after retries")
+                return
+            except httpx.ConnectError:
+                if retry_count < max_retries and not output_started:
+                    print(f"[Gemini] 连接错误，重试 {retry_count + 1}/{max_retries}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _error(502, "Connection error after retries")
+                yield encoder.end()
+                _log(current_account, 502, "Connection error after retries")
+                return
+            except Exception as e:
+                if is_retryable_error(None, e) and retry_count < max_retries and not output_started:
+                    print(f"[Gemini] 网络错误，重试 {retry_count + 1}/{max_retries}: {type(e).__name__}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _error(500, str(e))
+                yield encoder.end()
+                _log(current_account, 500, str(e))
+                return
+
+    media_type = "text/event-stream" if sse else "application/json"
+    return StreamingResponse(guard_stream(request, generate()), media_type=media_type)
@@ -1,5 +1,4 @@
 """OpenAI 协议处理 - /v1/chat/completions"""
-import json
 import uuid
 import time
 import asyncio
@@ -8,22 +7,60 @@ from datetime import datetime
 from fastapi import Request, HTTPException
 from fastapi.responses import StreamingResponse
 
+from .. import jsonfast
 from ..config import KIRO_API_URL, map_model_name
 from ..core import state, is_retryable_error, stats_manager
 from ..core.state import RequestLog
 from ..core.history_manager import HistoryManager, get_history_config, is_content_length_error
 from ..core.error_handler import classify_error, ErrorType, format_error_log
 from ..core.rate_limiter import get_rate_limiter
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream, is_quota_exceeded_error
+from ..core.tokenizer import token_counter, count_tokens
+from ..core.limit_predictor import limit_predictor
+from ..core.summarizer import background_summarizer
+from ..core.http_client import get_http_client
+from ..core.stream_guard import open_upstream_stream, guard_stream
+from ..core.sse import OpenAIChunkSSE, DeltaCoalescer, iter_coalesced, encode_data, DONE, KEEPALIVE_COMMENT, get_sse_config
+from ..providers.event_stream import EventStreamDecoder, ResponseAccumulator, TextDelta, ToolUseDelta
+from ..kiro_api import build_kiro_request, parse_event_stream, is_quota_exceeded_error, encode_kiro_request
 from ..converters import generate_session_id, convert_openai_messages_to_kiro, extract_images_from_content
 
 
+async def _call_kiro_for_summary(prompt: str, headers: dict) -> str:
+    """调用 Kiro API 生成摘要"""
+    req = build_kiro_request(prompt, "claude-haiku-4.5", [])
+    try:
+        client = get_http_client()
+        resp = await client.post(KIRO_API_URL, content=encode_kiro_request(req), headers=headers, timeout=60)
+        if resp.status_code == 200:
+            return parse_event_stream(resp.content)
+    except Exception as e:
+        print(f"[Summary] API 调用失败: {e}")
+    return ""
+
+
+def _schedule_background_summary(history_manager, history, user_content, account, headers):
+    """响应成功后在后台为下一轮预生成摘要
+
+    下一轮的历史由本轮预处理前的完整历史加上本轮消息和回复组成。
+    """
+    if not history_manager:
+        return
+    history = history_manager.source_history or history
+    async def api_caller(prompt: str) -> str:
+        return await _call_kiro_for_summary(prompt, headers)
+    background_summarizer.schedule(history_manager, history, user_content, account, api_caller)
+
+
+def _count_prompt_tokens(messages: list) -> int:
+    return token_counter.count_messages(messages)
+
+
 async def handle_chat_completions(request: Request):
     """处理 /v1/chat/completions 请求"""
     start_time = time.time()
     log_id = uuid.uuid4().hex[:8]
     
-    body = await request.json()
+    body = jsonfast.loads(await request.body())
     model = map_model_name(body.get("model", "claude-sonnet-4"))
     messages = body.get("messages", [])
     stream = body.get("stream", False)
@@ -39,79 +76,31 @@ async def handle_chat_completions(request: Request):
     if not account:
         raise HTTPException(503, "All accounts are rate limited or unavailable")
     
-    # 检查 token 是否即将过期，尝试刷新
-    if account.is_token_expiring_soon(5):
-        print(f"[OpenAI] Token 即将过期，尝试刷新: {account.id}")
-        success, msg = await account.refresh_token()
-        if not success:
-            print(f"[OpenAI] Token 刷新失败: {msg}")
-    
-    token = account.get_token()
-    if not token:
-        raise HTTPException(500, f"Failed to get token for account {account.name}")
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
     
-    # 使用账号的动态 Machine ID（提前构建，供摘要使用）
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
-    
-    # 限速检查
-    rate_limiter = get_rate_limiter()
-    can_request, wait_seconds, reason = rate_limiter.can_request(account.id)
-    if not can_request:
-        print(f"[OpenAI] 限速: {reason}")
-        await asyncio.sleep(wait_seconds)
+    # 提前返回流：准备阶段（token 刷新、摘要）期间先发送 role 块和 keep-alive
+    if stream and get_sse_config().early_preamble:
+        return StreamingResponse(
+            guard_stream(request, _early_stream(account, model, log_id, start_time, session_id, messages, tools, tool_choice, include_usage), keepalive=KEEPALIVE_COMMENT),
+            media_type="text/event-stream",
+        )
     
-    # 使用增强的转换函数
-    user_content, history, tool_results, kiro_tools = convert_openai_messages_to_kiro(
-        messages, model, tools, tool_choice
-    )
+    kiro_request, headers, history, user_content, images, kiro_tools, tool_results, history_manager = \
+        await _prepare_request(account, model, session_id, messages, tools, tool_choice)
     
-    # 历史消息预处理
-    history_manager = HistoryManager(get_history_config(), cache_key=session_id)
+    if stream:
+        return _handle_stream(
+            kiro_request, headers, account, model, log_id, start_time,
+            history=history, user_content=user_content, images=images,
+            kiro_tools=kiro_tools, tool_results=tool_results,
+            history_manager=history_manager,
+            include_usage=include_usage,
+            prompt_tokens=_count_prompt_tokens(messages),
+            request=request,
+        )
     
     async def call_summary(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            async with httpx.AsyncClient(verify=False, timeout=60) as client:
-                resp = await client.post(KIRO_API_URL, json=req, headers=headers)
-                if resp.status_code == 200:
-                    return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Summary] API 调用失败: {e}")
-        return ""
-
-    # 检查是否需要智能摘要或错误重试预摘要
-    if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
-        history = await history_manager.pre_process_async(history, user_content, call_summary)
-    else:
-        history = history_manager.pre_process(history, user_content)
-    
-    # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
-    from ..converters import fix_history_alternation
-    history = fix_history_alternation(history)
-    
-    if history_manager.was_truncated:
-        print(f"[OpenAI] {history_manager.truncate_info}")
-
-    
-    # 提取最后一条消息中的图片
-    images = []
-    if messages:
-        last_msg = messages[-1]
-        if last_msg.get("role") == "user":
-            _, images = extract_images_from_content(last_msg.get("content", ""))
-    
-    kiro_request = build_kiro_request(
-        user_content, model, history, 
-        images=images,
-        tools=kiro_tools if kiro_tools else None,
-        tool_results=tool_results if tool_results else None
-    )
+        return await _call_kiro_for_summary(prompt, headers)
     
     error_msg = None
     status_code = 200
@@ -122,97 +111,94 @@ async def handle_chat_completions(request: Request):
     try:
       for retry in range(max_retries + 1):
         try:
-            async with httpx.AsyncClient(verify=False, timeout=120) as client:
-                resp = await client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-                status_code = resp.status_code
+            client = get_http_client()
+            resp = await client.post(KIRO_API_URL, content=encode_kiro_request(kiro_request), headers=headers, timeout=120)
+            status_code = resp.status_code
+            
+            # 处理配额超限
+            if resp.status_code == 429 or is_quota_exceeded_error(resp.status_code, resp.text):
+                current_account.mark_quota_exceeded("Rate limited")
+                
+                # 尝试切换账号
+                next_account = state.get_next_available_account(current_account.id)
+                if next_account and retry < max_retries:
+                    print(f"[OpenAI] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                    current_account = next_account
+                    token = current_account.get_token()
+                    headers = current_account.build_headers(token)
+                    continue
+                
+                raise HTTPException(429, "All accounts rate limited")
+            
+            # 处理可重试的服务端错误
+            if is_retryable_error(resp.status_code):
+                if retry < max_retries:
+                    print(f"[OpenAI] 服务端错误 {resp.status_code}，重试 {retry + 1}/{max_retries}")
+                    await asyncio.sleep(0.5 * (2 ** retry))
+                    continue
+                raise HTTPException(resp.status_code, f"Server error after {max_retries} retries")
+            
+            if resp.status_code != 200:
+                error_msg = resp.text
+                print(f"[OpenAI] Kiro API error {resp.status_code}: {resp.text[:500]}")
+                
+                # 使用统一的错误处理
+                error = classify_error(resp.status_code, error_msg)
+                print(format_error_log(error, current_account.id))
+                
+                # 账号封禁 - 禁用账号
+                if error.should_disable_account:
+                    current_account.enabled = False
+                    from ..credential import CredentialStatus
+                    current_account.status = CredentialStatus.SUSPENDED
+                    print(f"[OpenAI] 账号 {current_account.id} 已被禁用 (封禁)")
                 
-                # 处理配额超限
-                if resp.status_code == 429 or is_quota_exceeded_error(resp.status_code, resp.text):
-                    current_account.mark_quota_exceeded("Rate limited")
-                    
-                    # 尝试切换账号
+                # 配额超限 - 标记冷却
+                if error.type == ErrorType.RATE_LIMITED:
+                    current_account.mark_quota_exceeded(error_msg[:100])
+                
+                # 尝试切换账号
+                if error.should_switch_account:
                     next_account = state.get_next_available_account(current_account.id)
                     if next_account and retry < max_retries:
-                        print(f"[OpenAI] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                        print(f"[OpenAI] 切换账号: {current_account.id} -> {next_account.id}")
                         current_account = next_account
-                        token = current_account.get_token()
-                        creds = current_account.get_credentials()
-                        headers = build_headers(
-                            token,
-                            machine_id=current_account.get_machine_id(),
-                            profile_arn=creds.profile_arn if creds else None,
-                            client_id=creds.client_id if creds else None
-                        )
-                        continue
-                    
-                    raise HTTPException(429, "All accounts rate limited")
-                
-                # 处理可重试的服务端错误
-                if is_retryable_error(resp.status_code):
-                    if retry < max_retries:
-                        print(f"[OpenAI] 服务端错误 {resp.status_code}，重试 {retry + 1}/{max_retries}")
-                        await asyncio.sleep(0.5 * (2 ** retry))
+                        headers = current_account.build_headers()
                         continue
-                    raise HTTPException(resp.status_code, f"Server error after {max_retries} retries")
                 
-                if resp.status_code != 200:
-                    error_msg = resp.text
-                    print(f"[OpenAI] Kiro API error {resp.status_code}: {resp.text[:500]}")
-                    
-                    # 使用统一的错误处理
-                    error = classify_error(resp.status_code, error_msg)
-                    print(format_error_log(error, current_account.id))
-                    
-                    # 账号封禁 - 禁用账号
-                    if error.should_disable_account:
-                        current_account.enabled = False
-                        from ..credential import CredentialStatus
-                        current_account.status = CredentialStatus.SUSPENDED
-                        print(f"[OpenAI] 账号 {current_account.id} 已被禁用 (封禁)")
-                    
-                    # 配额超限 - 标记冷却
-                    if error.type == ErrorType.RATE_LIMITED:
-                        current_account.mark_quota_exceeded(error_msg[:100])
-                    
-                    # 尝试切换账号
-                    if error.should_switch_account:
-                        next_account = state.get_next_available_account(current_account.id)
-                        if next_account and retry < max_retries:
-                            print(f"[OpenAI] 切换账号: {current_account.id} -> {next_account.id}")
-                            current_account = next_account
-                            headers["Authorization"] = f"Bearer {current_account.get_token()}"
-                            continue
-                    
-                    # 检查是否为内容长度超限错误，尝试截断重试
-                    if error.type == ErrorType.CONTENT_TOO_LONG:
-                        history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
-                            history, user_content
-                        )
-                        print(f"[OpenAI] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
-                        truncated_history, should_retry = await history_manager.handle_length_error_async(
-                            history, retry, call_summary
+                # 检查是否为内容长度超限错误，尝试截断重试
+                if error.type == ErrorType.CONTENT_TOO_LONG:
+                    limit_predictor.record_request(kiro_request, ok=False)
+                    history_chars, user_chars, total_chars = history_manager.estimate_request_chars(
+                        history, user_content
+                    )
+                    print(f"[OpenAI] 内容长度超限: history={history_chars} chars, user={user_chars} chars, total={total_chars} chars")
+                    truncated_history, should_retry = await history_manager.handle_length_error_async(
+                        history, retry, call_summary
+                    )
+                    if should_retry:
+                        print(f"[OpenAI] 内容长度超限，{history_manager.truncate_info}")
+                        history = truncated_history
+                        kiro_request = build_kiro_request(
+                            user_content, model, history,
+                            images=images,
+                            tools=kiro_tools if kiro_tools else None,
+                            tool_results=tool_results if tool_results else None
                         )
-                        if should_retry:
-                            print(f"[OpenAI] 内容长度超限，{history_manager.truncate_info}")
-                            history = truncated_history
-                            kiro_request = build_kiro_request(
-                                user_content, model, history,
-                                images=images,
-                                tools=kiro_tools if kiro_tools else None,
-                                tool_results=tool_results if tool_results else None
-                            )
-                            continue
-                        else:
-                            print(f"[OpenAI] 内容长度超限但未重试: retry={retry}/{max_retries}")
-                    
-                    raise HTTPException(resp.status_code, error.user_message)
-                
-                content = parse_event_stream(resp.content)
-                current_account.request_count += 1
-                current_account.last_used = time.time()
-                get_rate_limiter().record_request(current_account.id)
-                break
+                        continue
+                    else:
+                        print(f"[OpenAI] 内容长度超限但未重试: retry={retry}/{max_retries}")
                 
+                raise HTTPException(resp.status_code, error.user_message)
+            
+            limit_predictor.record_request(kiro_request, ok=True)
+            _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+            content = parse_event_stream(resp.content)
+            current_account.request_count += 1
+            current_account.last_used = time.time()
+            get_rate_limiter().record_request(current_account.id)
+            break
+            
         except HTTPException:
             raise
         except httpx.TimeoutException:
@@ -263,31 +249,6 @@ async def handle_chat_completions(request: Request):
             latency_ms=duration
         )
     
-    if stream:
-        async def generate():
-            for chunk in [content[i:i+20] for i in range(0, len(content), 20)]:
-                data = {
-                    "id": f"chatcmpl-{log_id}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": model,
-                    "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]
-                }
-                yield f"data: {json.dumps(data)}\n\n"
-                await asyncio.sleep(0.02)
-            
-            end_data = {
-                "id": f"chatcmpl-{log_id}",
-                "object": "chat.completion.chunk",
-                "created": int(time.time()),
-                "model": model,
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
-            }
-            yield f"data: {json.dumps(end_data)}\n\n"
-            yield "data: [DONE]\n\n"
-        
-        return StreamingResponse(generate(), media_type="text/event-stream")
-    
     return {
         "id": f"chatcmpl-{log_id}",
         "object": "chat.completion",
@@ -300,3 +261,350 @@ async def handle_chat_completions(request: Request):
         }],
         "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
     }
+
+
+async def _prepare_request(account, model, session_id, messages, tools, tool_choice):
+    """准备 Kiro 请求：token 刷新、限速、消息转换和历史预处理
+
+    返回 (kiro_request, headers, history, user_content, images, kiro_tools, tool_results, history_manager)，
+    无法获取 token 时抛出 HTTPException。
+    """
+    # 检查 token 是否即将过期，尝试刷新
+    if account.is_token_expiring_soon(5):
+        print(f"[OpenAI] Token 即将过期，尝试刷新: {account.id}")
+        success, msg = await account.refresh_token()
+        if not success:
+            print(f"[OpenAI] Token 刷新失败: {msg}")
+    
+    token = account.get_token()
+    if not token:
+        raise HTTPException(500, f"Failed to get token for account {account.name}")
+    
+    # 使用账号的动态 Machine ID（提前构建，供摘要使用）
+    headers = account.build_headers(token)
+    
+    # 限速检查
+    rate_limiter = get_rate_limiter()
+    can_request, wait_seconds, reason = rate_limiter.can_request(account.id)
+    if not can_request:
+        print(f"[OpenAI] 限速: {reason}")
+        await asyncio.sleep(wait_seconds)
+    
+    # 使用增强的转换函数
+    user_content, history, tool_results, kiro_tools = convert_openai_messages_to_kiro(
+        messages, model, tools, tool_choice
+    )
+    
+    # 历史消息预处理
+    history_manager = HistoryManager(get_history_config(), cache_key=session_id)
+    
+    async def call_summary(prompt: str) -> str:
+        return await _call_kiro_for_summary(prompt, headers)
+
+    # 检查是否需要智能摘要或错误重试预摘要
+    if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
+        history = await history_manager.pre_process_async(history, user_content, call_summary, tool_results)
+    else:
+        history = history_manager.pre_process(history, user_content, tool_results)
+    
+    # 提取最后一条消息中的图片
+    images = []
+    if messages:
+        last_msg = messages[-1]
+        if last_msg.get("role") == "user":
+            _, images = extract_images_from_content(last_msg.get("content", ""))
+    images, user_content = history_manager.limit_images(images, user_content)
+    
+    # 按该模型学到的上限预先截断
+    history = history_manager.fit_learned_limit(history, user_content, model, kiro_tools, images, tool_results)
+    
+    # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
+    from ..converters import fix_history_alternation
+    history = fix_history_alternation(history)
+    
+    if history_manager.was_truncated:
+        print(f"[OpenAI] {history_manager.truncate_info}")
+    
+    kiro_request = build_kiro_request(
+        user_content, model, history, 
+        images=images,
+        tools=kiro_tools if kiro_tools else None,
+        tool_results=tool_results if tool_results else None
+    )
+    
+    return kiro_request, headers, history, user_content, images, kiro_tools, tool_results, history_manager
+
+
+async def _early_stream(account, model, log_id, start_time, session_id, messages, tools, tool_choice, include_usage):
+    """先发送 role 块再准备请求，准备阶段的错误以流内 error 块返回"""
+    sse = OpenAIChunkSSE(f"chatcmpl-{log_id}", int(start_time), model, include_usage)
+    yield sse.chunk({"role": "assistant", "content": ""})
+    
+    try:
+        kiro_request, headers, history, user_content, images, kiro_tools, tool_results, history_manager = \
+            await _prepare_request(account, model, session_id, messages, tools, tool_choice)
+    except Exception as e:
+        status = e.status_code if isinstance(e, HTTPException) else 500
+        error_msg = str(e.detail) if isinstance(e, HTTPException) else str(e)
+        print(f"[OpenAI] 请求准备失败: {error_msg}")
+        yield _stream_error(error_msg, "api_error", status)
+        yield DONE
+        duration = (time.time() - start_time) * 1000
+        state.add_log(RequestLog(
+            id=log_id, timestamp=time.time(), method="POST", path="/v1/chat/completions",
+            model=model, account_id=account.id, status=status, duration_ms=duration, error=error_msg
+        ))
+        stats_manager.record_request(account_id=account.id, model=model, success=False, latency_ms=duration)
+        return
+    
+    stream = _stream_events(
+        kiro_request, headers, account, model, log_id, start_time,
+        history=history, user_content=user_content, images=images,
+        kiro_tools=kiro_tools, tool_results=tool_results,
+        history_manager=history_manager,
+        include_usage=include_usage,
+        prompt_tokens=_count_prompt_tokens(messages),
+        preamble_sent=True,
+    )
+    async for chunk in stream:
+        yield chunk
+
+
+def _stream_error(message: str, error_type: str = "api_error", code=None) -> bytes:
+    """流内错误块（OpenAI 兼容客户端按 error 字段识别）"""
+    return encode_data({"error": {"message": message, "type": error_type, "code": code}})
+
+
+def _handle_stream(kiro_request, headers, account, model, log_id, start_time, history=None, user_content="", images=None, kiro_tools=None, tool_results=None, history_manager=None, include_usage=False, prompt_tokens=0, request=None):
+    """流式响应：Kiro event-stream 帧到达即转换为 chat.completion.chunk
+
+    首字节之前的配额超限 / 服务端错误 / 封禁会切换账号或重试，与 Anthropic 流式路径一致。
+    """
+    stream = _stream_events(
+        kiro_request, headers, account, model, log_id, start_time,
+        history=history, user_content=user_content, images=images,
+        kiro_tools=kiro_tools, tool_results=tool_results,
+        history_manager=history_manager,
+        include_usage=include_usage, prompt_tokens=prompt_tokens,
+    )
+    return StreamingResponse(guard_stream(request, stream, keepalive=KEEPALIVE_COMMENT), media_type="text/event-stream")
+
+
+def _stream_events(kiro_request, headers, account, model, log_id, start_time, history=None, user_content="", images=None, kiro_tools=None, tool_results=None, history_manager=None, include_usage=False, prompt_tokens=0, preamble_sent=False):
+    """流式块生成器；preamble_sent 为 True 时 role 块已由 _early_stream 发送
+
+    只在开始输出响应内容之前重试或切换账号；之后上游中断时发送一个流内 error 块和 [DONE] 后结束。
+    """
+    sse = OpenAIChunkSSE(f"chatcmpl-{log_id}", int(start_time), model, include_usage)
+
+    def _log(current_account, status: int, error: str = None):
+        duration = (time.time() - start_time) * 1000
+        state.add_log(RequestLog(
+            id=log_id, timestamp=time.time(), method="POST", path="/v1/chat/completions",
+            model=model, account_id=current_account.id if current_account else None,
+            status=status, duration_ms=duration, error=error
+        ))
+        stats_manager.record_request(
+            account_id=current_account.id if current_account else "unknown",
+            model=model, success=status == 200, latency_ms=duration
+        )
+
+    async def generate():
+        nonlocal kiro_request, history, headers
+        current_account = account
+        retry_count = 0
+        max_retries = 2
+        # role 块只发送一次；已向客户端输出响应内容后不再重试（重试会重复已发送的块）
+        role_sent = preamble_sent
+        output_started = False
+
+        while retry_count <= max_retries:
+            try:
+                async with open_upstream_stream(current_account, kiro_request, headers) as response:
+
+                    # 处理配额超限
+                    if response.status_code == 429 or is_quota_exceeded_error(response.status_code, ""):
+                        current_account.mark_quota_exceeded("Rate limited (stream)")
+                        next_account = state.get_next_available_account(current_account.id)
+                        if next_account and retry_count < max_retries:
+                            print(f"[OpenAI] 配额超限，切换账号: {current_account.id} -> {next_account.id}")
+                            current_account = next_account
+                            headers = current_account.build_headers()
+                            retry_count += 1
+                            continue
+                        yield _stream_error("All accounts rate limited", "rate_limit_error", 429)
+                        yield DONE
+                        _log(current_account, 429, "All accounts rate limited")
+                        return
+
+                    # 处理可重试的服务端错误
+                    if is_retryable_error(response.status_code):
+                        if retry_count < max_retries:
+                            print(f"[OpenAI] 服务端错误 {response.status_code}，重试 {retry_count + 1}/{max_retries}")
+                            retry_count += 1
+                            await asyncio.sleep(0.5 * (2 ** retry_count))
+                            continue
+                        yield _stream_error("Server error after retries", "api_error", response.status_code)
+                        yield DONE
+                        _log(current_account, response.status_code, "Server error after retries")
+                        return
+
+                    if response.status_code != 200:
+                        error_str = (await response.aread()).decode(errors="replace")
+                        print(f"[OpenAI] Kiro API error {response.status_code}: {error_str[:500]}")
+
+                        error = classify_error(response.status_code, error_str)
+                        print(format_error_log(error, current_account.id))
+
+                        # 账号封禁 - 禁用账号
+                        if error.should_disable_account:
+                            current_account.enabled = False
+                            from ..credential import CredentialStatus
+                            current_account.status = CredentialStatus.SUSPENDED
+                            print(f"[OpenAI] 账号 {current_account.id} 已被禁用 (封禁)")
+
+                        # 配额超限 - 标记冷却
+                        if error.type == ErrorType.RATE_LIMITED:
+                            current_account.mark_quota_exceeded(error_str[:100])
+
+                        # 尝试切换账号
+                        if error.should_switch_account:
+                            next_account = state.get_next_available_account(current_account.id)
+                            if next_account and retry_count < max_retries:
+                                print(f"[OpenAI] 切换账号: {current_account.id} -> {next_account.id}")
+                                current_account = next_account
+                                headers = current_account.build_headers()
+                                retry_count += 1
+                                continue
+
+                        # 内容长度超限，尝试截断重试
+                        if error.type == ErrorType.CONTENT_TOO_LONG:
+                            limit_predictor.record_request(kiro_request, ok=False)
+                        if error.type == ErrorType.CONTENT_TOO_LONG and history_manager:
+                            async def api_caller(prompt: str) -> str:
+                                return await _call_kiro_for_summary(prompt, headers)
+                            truncated_history, should_retry = await history_manager.handle_length_error_async(
+                                history, retry_count, api_caller
+                            )
+                            if should_retry:
+                                print(f"[OpenAI] 内容长度超限，{history_manager.truncate_info}")
+                                history = truncated_history
+                                kiro_request = build_kiro_request(
+                                    user_content, model, history,
+                                    images=images,
+                                    tools=kiro_tools if kiro_tools else None,
+                                    tool_results=tool_results if tool_results else None
+                                )
+                                retry_count += 1
+                                continue
+
+                        yield _stream_error(error.user_message, error.type.value, response.status_code)
+                        yield DONE
+                        _log(current_account, response.status_code, error.user_message)
+                        return
+
+                    limit_predictor.record_request(kiro_request, ok=True)
+                    _schedule_background_summary(history_manager, history, user_content, current_account, headers)
+
+                    # 正常处理响应
+                    if not role_sent:
+                        yield sse.chunk({"role": "assistant", "content": ""})
+                        role_sent = True
+
+                    decoder = EventStreamDecoder()
+                    accumulator = ResponseAccumulator()
+                    coalescer = DeltaCoalescer()
+                    tool_indexes = {}
+
+                    async for chunk in iter_coalesced(response.aiter_bytes(), coalescer):
+                        if chunk is None:
+                            output_started = True
+                            yield sse.content(coalescer.flush())
+                            continue
+
+                        out = []
+                        for event in decoder.feed(chunk):
+                            accumulator.add(event)
+
+                            if isinstance(event, TextDelta):
+                                merged = coalescer.add(event.text)
+                                if merged:
+                                    out.append(sse.content(merged))
+
+                            elif isinstance(event, ToolUseDelta) and event.tool_use_id:
+                                if coalescer.pending:
+                                    out.append(sse.content(coalescer.flush()))
+                                index = tool_indexes.get(event.tool_use_id)
+                                if index is None:
+                                    index = tool_indexes[event.tool_use_id] = len(tool_indexes)
+                                    out.append(sse.chunk({"tool_calls": [{
+                                        "index": index,
+                                        "id": event.tool_use_id,
+                                        "type": "function",
+                                        "function": {"name": event.name, "arguments": event.input},
+                                    }]}))
+                                elif event.input:
+                                    out.append(sse.chunk({"tool_calls": [{
+                                        "index": index,
+                                        "function": {"arguments": event.input},
+                                    }]}))
+
+                        # 同一网络块解出的事件合并为一次发送
+                        if out:
+                            output_started = True
+                            yield b"".join(out)
+
+                    tail = sse.content(coalescer.flush()) if coalescer.pending else b""
+                    finish_reason = "tool_calls" if tool_indexes else "stop"
+                    tail += sse.chunk({}, finish_reason)
+
+                    if include_usage:
+                        completion_tokens = count_tokens(accumulator.text)
+                        for tool_use in accumulator.to_result()["tool_uses"]:
+                            completion_tokens += token_counter.count_value(tool_use["input"])
+                        tail += sse.usage({
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        })
+
+                    yield tail + DONE
+
+                    current_account.request_count += 1
+                    current_account.last_used = time.time()
+                    get_rate_limiter().record_request(current_account.id)
+                    _log(current_account, 200)
+                    return
+
+            except httpx.TimeoutException:
+                if retry_count < max_retries and not output_started:
+                    print(f"[OpenAI] 请求超时，重试 {retry_count + 1}/{max_retries}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _stream_error("Request timeout after retries", "timeout_error", 408)
+                yield DONE
+                _log(current_account, 408, "Request timeout after retries")
+                return
+            except httpx.ConnectError:
+                if retry_count < max_retries and not output_started:
+                    print(f"[OpenAI] 连接错误，重试 {retry_count + 1}/{max_retries}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _stream_error("Connection error after retries", "connection_error", 502)
+                yield DONE
+                _log(current_account, 502, "Connection error after retries")
+                return
+            except Exception as e:
+                if is_retryable_error(None, e) and retry_count < max_retries and not output_started:
+                    print(f"[OpenAI] 网络错误，重试 {retry_count + 1}/{max_retries}: {type(e).__name__}")
+                    retry_count += 1
+                    await asyncio.sleep(0.5 * (2 ** retry_count))
+                    continue
+                yield _stream_error(str(e), "api_error", 500)
+                yield DONE
+                _log(current_account, 500, str(e))
+                return
+
+    return generate()
@@ -6,57 +6,86 @@ import json
 import uuid
 import time
 import asyncio
-import httpx
+from functools import partial
 from fastapi import Request, HTTPException
 from fastapi.responses import StreamingResponse
 
+from .. import jsonfast
 from ..config import KIRO_API_URL, map_model_name
 from ..core import state, is_retryable_error, stats_manager
 from ..core.state import RequestLog
-from ..core.history_manager import HistoryManager, get_history_config
+from ..core.history_manager import HistoryManager, get_history_config, is_content_length_error, image_stats
+from ..core.limit_predictor import limit_predictor
 from ..core.error_handler import classify_error, ErrorType, format_error_log
 from ..core.rate_limiter import get_rate_limiter
-from ..kiro_api import build_headers, build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error
+from ..core.summarizer import background_summarizer
+from ..core.http_client import get_http_client
+from ..core.stream_guard import open_upstream_stream, guard_stream
+from ..core.sse import ResponsesSSE, DeltaCoalescer, iter_coalesced, KEEPALIVE_COMMENT, get_sse_config
+from ..providers.event_stream import EventStreamDecoder, ResponseAccumulator, TextDelta
+from ..kiro_api import build_kiro_request, parse_event_stream, parse_event_stream_full, is_quota_exceeded_error, encode_kiro_request
+from ..converters import ConversionState, run_conversion, copy_entry, tool_spec_cache, parse_image_data_url
 
 
-def _convert_responses_input_to_kiro(input_data, instructions: str = None):
-    """将 Responses API 的 input 转换为 Kiro 格式
-    
-    Codex 发送的 input 格式:
-    - message (role=user): 用户消息
-    - message (role=assistant): 助手回复
-    - function_call: 工具调用
-    - function_call_output: 工具调用结果
-    
-    Kiro API 期望的格式:
-    - history: [userInputMessage, assistantResponseMessage, ...] 交替
-    - 当 assistant 有 toolUses 时，下一条 userInputMessage 必须包含对应的 toolResults
-    - 当前请求的 userInputMessage 只包含最新一轮的 toolResults
+async def _call_kiro_for_summary(prompt: str, headers: dict) -> str:
+    """调用 Kiro API 生成摘要"""
+    req = build_kiro_request(prompt, "claude-haiku-4.5", [])
+    try:
+        client = get_http_client()
+        resp = await client.post(KIRO_API_URL, content=encode_kiro_request(req), headers=headers, timeout=60)
+        if resp.status_code == 200:
+            return parse_event_stream(resp.content)
+    except Exception as e:
+        print(f"[Responses] Summary API 调用失败: {e}")
+    return ""
+
+
+def _schedule_background_summary(history_manager, history, user_content, account, headers):
+    """响应成功后在后台为下一轮预生成摘要
+
+    下一轮的历史由本轮预处理前的完整历史加上本轮消息和回复组成。
     """
-    history = []
-    user_content = ""
-    tool_results = []
-    model_id = "claude-sonnet-4"
-    first_user_msg_added = False
-    pending_images = []
-    
-    if isinstance(input_data, str):
-        if instructions:
-            return f"{instructions}\n\n{input_data}", history, tool_results, None
-        return input_data, history, tool_results, None
-    
-    if not isinstance(input_data, list):
-        return user_content, history, tool_results, None
-    
-    # 线性处理消息，跟踪状态
-    pending_user_texts = []
-    pending_tool_uses = []
-    pending_tool_outputs = []
-    last_was_assistant_with_tools = False
-    
-    for i, item in enumerate(input_data):
+    if not history_manager:
+        return
+    history = history_manager.source_history or history
+    async def api_caller(prompt: str) -> str:
+        return await _call_kiro_for_summary(prompt, headers)
+    background_summarizer.schedule(history_manager, history, user_content, account, api_caller)
+
+
+class _ResponsesConversion(ConversionState):
+    """_convert_responses_input_to_kiro 的逐条转换状态"""
+
+    def __init__(self, instructions: str = None):
+        super().__init__()
+        self.instructions = instructions
+        self.first_user_msg_added = False
+        self.pending_images = []
+        self.image_rounds = []  # pending_images 中每张图片所在的用户轮次
+        self.user_turns = 0
+        self.pending_user_texts = []
+        self.pending_tool_uses = []
+        self.pending_tool_outputs = []
+        self.last_was_assistant_with_tools = False
+
+    def fold(self, upto: int = None):
+        # Responses 的历史由 handler 调用 fix_history_alternation 修复，这里不并入
+        pass
+
+    def snapshot(self) -> "_ResponsesConversion":
+        state = super().snapshot()
+        state.pending_images = list(self.pending_images)
+        state.image_rounds = list(self.image_rounds)
+        state.pending_user_texts = list(self.pending_user_texts)
+        state.pending_tool_uses = list(self.pending_tool_uses)
+        state.pending_tool_outputs = list(self.pending_tool_outputs)
+        return state
+
+    def step(self, item: dict, index: int, is_last: bool):
+        history = self.history
+        model_id = self.model_id
+        instructions = self.instructions
         item_type = item.get("type", "")
-        is_last = (i == len(input_data) - 1)
         
         if item_type == "message":
             role = item.get("role", "user")
@@ -73,30 +102,26 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                     if c_type in ("input_text", "output_text", "text"):
                         text_parts.append(c.get("text", ""))
                     elif c_type == "input_image":
-                        image_url = c.get("image_url", "")
-                        if image_url.startswith("data:"):
-                            import re
-                            match = re.match(r'data:image/(\w+);base64,(.+)', image_url)
-                            if match:
-                                images.append({
-                                    "format": match.group(1),
-                                    "source": {"bytes": match.group(2)}
-                                })
+                        image = parse_image_data_url(c.get("image_url", ""))
+                        if image:
+                            images.append(image)
             
             text = "\n".join(text_parts) if text_parts else ""
             
             if role == "user":
+                self.user_turns += 1
                 if images:
-                    pending_images.extend(images)
-                pending_user_texts.append(text)
+                    self.pending_images.extend(images)
+                    self.image_rounds.extend([self.user_turns] * len(images))
+                self.pending_user_texts.append(text)
             
             elif role == "assistant":
                 # 遇到 assistant 消息，先处理之前的 user 消息
-                if pending_user_texts:
-                    combined_user = "\n\n".join(pending_user_texts)
-                    if not first_user_msg_added and instructions:
+                if self.pending_user_texts:
+                    combined_user = "\n\n".join(self.pending_user_texts)
+                    if not self.first_user_msg_added and instructions:
                         combined_user = f"{instructions}\n\n{combined_user}"
-                        first_user_msg_added = True
+                        self.first_user_msg_added = True
                     
                     user_msg = {
                         "userInputMessage": {
@@ -106,15 +131,15 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                         }
                     }
                     # 如果上一个 assistant 有工具调用，这个 user 消息需要带 toolResults
-                    if pending_tool_outputs:
+                    if self.pending_tool_outputs:
                         user_msg["userInputMessage"]["userInputMessageContext"] = {
-                            "toolResults": pending_tool_outputs
+                            "toolResults": self.pending_tool_outputs
                         }
-                        pending_tool_outputs = []
+                        self.pending_tool_outputs = []
                     
                     history.append(user_msg)
-                    pending_user_texts = []
-                elif pending_tool_outputs:
+                    self.pending_user_texts = []
+                elif self.pending_tool_outputs:
                     # 没有 user 消息，但有工具结果，创建一个带 toolResults 的 user 消息
                     user_msg = {
                         "userInputMessage": {
@@ -122,12 +147,12 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                             "modelId": model_id,
                             "origin": "AI_EDITOR",
                             "userInputMessageContext": {
-                                "toolResults": pending_tool_outputs
+                                "toolResults": self.pending_tool_outputs
                             }
                         }
                     }
                     history.append(user_msg)
-                    pending_tool_outputs = []
+                    self.pending_tool_outputs = []
                 
                 # 添加 assistant 消息
                 assistant_msg = {
@@ -135,13 +160,13 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                         "content": text or "I understand."
                     }
                 }
-                if pending_tool_uses:
-                    assistant_msg["assistantResponseMessage"]["toolUses"] = pending_tool_uses
-                    pending_tool_uses = []
-                    last_was_assistant_with_tools = True
+                if self.pending_tool_uses:
+                    assistant_msg["assistantResponseMessage"]["toolUses"] = self.pending_tool_uses
+                    self.pending_tool_uses = []
+                    self.last_was_assistant_with_tools = True
                 else:
                     # 没有 toolUses 时不添加这个字段
-                    last_was_assistant_with_tools = False
+                    self.last_was_assistant_with_tools = False
                 
                 history.append(assistant_msg)
         
@@ -157,14 +182,14 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                 "input": args
             }
             
-            # 如果上一条是 assistant 消息，添加 toolUses
+            # 如果上一条是 assistant 消息，添加 toolUses（写时复制，缓存中的条目不变）
             if history and "assistantResponseMessage" in history[-1]:
-                if "toolUses" not in history[-1]["assistantResponseMessage"]:
-                    history[-1]["assistantResponseMessage"]["toolUses"] = []
-                history[-1]["assistantResponseMessage"]["toolUses"].append(tool_use)
-                last_was_assistant_with_tools = True
+                last = copy_entry(history[-1])
+                last["assistantResponseMessage"].setdefault("toolUses", []).append(tool_use)
+                history[-1] = last
+                self.last_was_assistant_with_tools = True
             else:
-                pending_tool_uses.append(tool_use)
+                self.pending_tool_uses.append(tool_use)
         
         elif item_type == "function_call_output":
             call_id = item.get("call_id", "")
@@ -173,7 +198,7 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
             # 跳过没有 call_id 的 tool output
             if not call_id:
                 print(f"[Responses] Warning: function_call_output without call_id, skipping")
-                continue
+                return
             
             if isinstance(output, str):
                 output_str = output
@@ -185,16 +210,50 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                 output_str = str(output)
                 status = "success"
             
-            pending_tool_outputs.append({
+            self.pending_tool_outputs.append({
                 "content": [{"text": output_str}],
                 "status": status,
                 "toolUseId": call_id
             })
+
+
+def _convert_responses_input_to_kiro(input_data, instructions: str = None):
+    """将 Responses API 的 input 转换为 Kiro 格式
+    
+    Codex 发送的 input 格式:
+    - message (role=user): 用户消息
+    - message (role=assistant): 助手回复
+    - function_call: 工具调用
+    - function_call_output: 工具调用结果
+    
+    Kiro API 期望的格式:
+    - history: [userInputMessage, assistantResponseMessage, ...] 交替
+    - 当 assistant 有 toolUses 时，下一条 userInputMessage 必须包含对应的 toolResults
+    - 当前请求的 userInputMessage 只包含最新一轮的 toolResults
+    
+    除最后一项外的 input 按前缀缓存，每轮只转换新增的项。
+    """
+    history = []
+    user_content = ""
+    tool_results = []
+    
+    if isinstance(input_data, str):
+        if instructions:
+            return f"{instructions}\n\n{input_data}", history, tool_results, None
+        return input_data, history, tool_results, None
+    
+    if not isinstance(input_data, list):
+        return user_content, history, tool_results, None
+    
+    # 线性处理消息，跟踪状态
+    state = run_conversion("responses", [instructions], input_data, _ResponsesConversion(instructions))
+    history = list(state.history)
+    pending_tool_outputs = state.pending_tool_outputs
     
     # 处理剩余的消息
-    if pending_user_texts:
-        user_content = "\n\n".join(pending_user_texts)
-        if not first_user_msg_added and instructions:
+    if state.pending_user_texts:
+        user_content = "\n\n".join(state.pending_user_texts)
+        if not state.first_user_msg_added and instructions:
             user_content = f"{instructions}\n\n{user_content}"
     elif pending_tool_outputs:
         user_content = "Please continue based on the tool results."
@@ -214,15 +273,19 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
                 ctx = user.get("userInputMessageContext", {})
                 has_tool_results = bool(ctx.get("toolResults"))
                 
-                # 确保配对一致
+                # 确保配对一致（条目可能来自前缀缓存，先复制再修改）
                 if has_tool_uses and not has_tool_results:
                     # assistant 有 toolUses 但 user 没有 toolResults，清除 toolUses
                     print(f"[Responses] Warning: history[{i}] has toolUses but history[{i+1}] has no toolResults, removing toolUses")
-                    assistant.pop("toolUses", None)
+                    history[i] = copy_entry(history[i])
+                    history[i]["assistantResponseMessage"].pop("toolUses", None)
                 elif not has_tool_uses and has_tool_results:
                     # assistant 没有 toolUses 但 user 有 toolResults，清除 toolResults
                     print(f"[Responses] Warning: history[{i}] has no toolUses but history[{i+1}] has toolResults, removing toolResults")
-                    user.pop("userInputMessageContext", None)
+                    history[i + 1] = copy_entry(history[i + 1])
+                    history[i + 1]["userInputMessage"].pop("userInputMessageContext", None)
+    
+    history = [copy_entry(h) for h in history]
     
     # 调试日志
     print(f"[Responses] Converted: history={len(history)}, tool_results={len(tool_results)}")
@@ -236,11 +299,30 @@ def _convert_responses_input_to_kiro(input_data, instructions: str = None):
             tu_count = len(arm.get("toolUses", []) or []) if has_tu_field else 0
             print(f"[Responses]   history[{i}]: assistantResponseMessage, has_toolUses_field={has_tu_field}, toolUses_count={tu_count}")
     
-    images = pending_images if pending_images else None
+    # 只保留最近 image_keep_turns 轮的图片，更早的图片每轮都会重复发送，替换为说明文字
+    images = None
+    if state.pending_images:
+        keep_turns = get_history_config().image_keep_turns
+        images = [
+            image for image, turn in zip(state.pending_images, state.image_rounds)
+            if keep_turns <= 0 or turn > state.user_turns - keep_turns
+        ]
+        stripped = len(state.pending_images) - len(images)
+        if stripped:
+            image_stats.stripped += stripped
+            user_content = f"{user_content}\n\n[已省略较早轮次的 {stripped} 张图片]"
+        images = images or None
     return user_content, history, tool_results, images
 
 
 def _convert_tools_to_kiro(tools: list) -> list:
+    """将 Responses API 的 tools 转换为 Kiro 格式（结果缓存共享，不要原地修改）"""
+    if not tools:
+        return None
+    return tool_spec_cache.get("responses", tools, _build_kiro_tools) or None
+
+
+def _build_kiro_tools(tools: list) -> list:
     """将 Responses API 的 tools 转换为 Kiro 格式
     
     Codex Responses API 工具格式:
@@ -354,7 +436,7 @@ async def handle_responses(request: Request):
     start_time = time.time()
     log_id = uuid.uuid4().hex[:12]
     
-    body = await request.json()
+    body = jsonfast.loads(await request.body())
     model = map_model_name(body.get("model", "gpt-4o"))
     input_data = body.get("input", "")
     instructions = body.get("instructions", "")
@@ -365,13 +447,113 @@ async def handle_responses(request: Request):
         raise HTTPException(400, "input required")
     
     import hashlib
-    session_str = json.dumps(input_data[:3] if isinstance(input_data, list) else str(input_data)[:100], sort_keys=True, default=str)
+    session_str = jsonfast.dumps(input_data[:3] if isinstance(input_data, list) else str(input_data)[:100], sort_keys=True, default=str)
     session_id = hashlib.sha256(session_str.encode()).hexdigest()[:16]
     account = state.get_available_account(session_id)
     
     if not account:
         raise HTTPException(503, "All accounts are rate limited or unavailable")
     
+    # 提前返回流：准备阶段（token 刷新、转换）期间先发送 response.created 和 keep-alive
+    if stream and get_sse_config().early_preamble:
+        return StreamingResponse(
+            guard_stream(request, _early_stream(account, model, log_id, start_time, session_id, input_data, instructions, tools), keepalive=KEEPALIVE_COMMENT),
+            media_type="text/event-stream",
+        )
+    
+    kiro_request, headers, schedule_summary = await _prepare_request(account, model, session_id, input_data, instructions, tools)
+    
+    if stream:
+        return await _handle_stream(kiro_request, headers, account, model, log_id, start_time, request=request, schedule_summary=schedule_summary)
+    
+    # 非流式
+    status_code = 0
+    error_msg = None
+    try:
+        client = get_http_client()
+        resp = await client.post(KIRO_API_URL, content=encode_kiro_request(kiro_request), headers=headers, timeout=120)
+        status_code = resp.status_code
+        if resp.status_code != 200:
+            error_msg = resp.text[:500]
+            if is_content_length_error(resp.status_code, resp.text):
+                limit_predictor.record_request(kiro_request, ok=False)
+            raise HTTPException(resp.status_code, resp.text)
+
+        limit_predictor.record_request(kiro_request, ok=True)
+        schedule_summary()
+        result = parse_event_stream_full(resp.content)
+        account.request_count += 1
+        account.last_used = time.time()
+        get_rate_limiter().record_request(account.id)
+
+        return _build_response(result, model, log_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        status_code = 500
+        raise
+    finally:
+        duration = (time.time() - start_time) * 1000
+        state.add_log(RequestLog(
+            id=log_id,
+            timestamp=time.time(),
+            method="POST",
+            path="/v1/responses",
+            model=model,
+            account_id=account.id if account else None,
+            status=status_code,
+            duration_ms=duration,
+            error=error_msg
+        ))
+        stats_manager.record_request(
+            account_id=account.id if account else "unknown",
+            model=model,
+            success=status_code == 200,
+            latency_ms=duration
+        )
+
+
+def _build_response(result: dict, model: str, response_id: str) -> dict:
+    """构建非流式响应"""
+    text = "".join(result.get("content", []))
+    output = []
+    
+    if text:
+        output.append({
+            "type": "message",
+            "id": f"msg_{response_id}",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}]
+        })
+    
+    for tool_use in result.get("tool_uses", []):
+        output.append({
+            "type": "function_call",
+            "id": tool_use.get("id", f"call_{uuid.uuid4().hex[:12]}"),
+            "call_id": tool_use.get("id", f"call_{uuid.uuid4().hex[:12]}"),
+            "name": tool_use.get("name", ""),
+            "arguments": json.dumps(tool_use.get("input", {}))
+        })
+    
+    return {
+        "id": f"resp_{response_id}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "status": "completed",
+        "model": model,
+        "output": output,
+        "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
+    }
+
+
+async def _prepare_request(account, model, session_id, input_data, instructions, tools):
+    """准备 Kiro 请求：token 刷新、限速和输入转换，返回 (kiro_request, headers, schedule_summary)
+
+    schedule_summary 在上游成功响应后调用，为下一轮预生成摘要。
+
+    无法获取 token 时抛出 HTTPException。
+    """
     if account.is_token_expiring_soon(5):
         await account.refresh_token()
     
@@ -379,13 +561,7 @@ async def handle_responses(request: Request):
     if not token:
         raise HTTPException(500, f"Failed to get token for account {account.name}")
     
-    creds = account.get_credentials()
-    headers = build_headers(
-        token,
-        machine_id=account.get_machine_id(),
-        profile_arn=creds.profile_arn if creds else None,
-        client_id=creds.client_id if creds else None
-    )
+    headers = account.build_headers(token)
     
     rate_limiter = get_rate_limiter()
     can_request, wait_seconds, _ = rate_limiter.can_request(account.id)
@@ -407,21 +583,19 @@ async def handle_responses(request: Request):
     
     # 创建摘要 API 调用函数
     async def api_caller(prompt: str) -> str:
-        req = build_kiro_request(prompt, "claude-haiku-4.5", [])
-        try:
-            async with httpx.AsyncClient(verify=False, timeout=60) as client:
-                resp = await client.post(KIRO_API_URL, json=req, headers=headers)
-                if resp.status_code == 200:
-                    return parse_event_stream(resp.content)
-        except Exception as e:
-            print(f"[Responses] Summary API 调用失败: {e}")
-        return ""
+        return await _call_kiro_for_summary(prompt, headers)
     
     # 检查是否需要智能摘要或错误重试预摘要
     if history_manager.should_summarize(history) or history_manager.should_pre_summary_for_error_retry(history, user_content):
-        history = await history_manager.pre_process_async(history, user_content, api_caller)
+        history = await history_manager.pre_process_async(history, user_content, api_caller, tool_results)
     else:
-        history = history_manager.pre_process(history, user_content)
+        history = history_manager.pre_process(history, user_content, tool_results)
+    
+    kiro_tools = _convert_tools_to_kiro(tools)
+    images, user_content = history_manager.limit_images(images, user_content)
+    
+    # 按该模型学到的上限预先截断
+    history = history_manager.fit_learned_limit(history, user_content, model, kiro_tools, images, tool_results)
     
     # 摘要/截断后再次修复历史交替和 toolUses/toolResults 配对
     history = fix_history_alternation(history)
@@ -429,8 +603,6 @@ async def handle_responses(request: Request):
     if history_manager.was_truncated:
         print(f"[Responses] {history_manager.truncate_info}")
     
-    kiro_tools = _convert_tools_to_kiro(tools)
-    
     # 调试：打印 input 结构
     if isinstance(input_data, list):
         for i, item in enumerate(input_data):
@@ -511,88 +683,67 @@ async def handle_responses(request: Request):
                 del ctx["tools"]
         print(f"[Responses] Kiro request structure: {json.dumps(debug_request, indent=2)}")
     
-    if stream:
-        return await _handle_stream(kiro_request, headers, account, model, log_id, start_time)
+    schedule_summary = partial(_schedule_background_summary, history_manager, history, user_content, account, headers)
+    return kiro_request, headers, schedule_summary
+
+
+def _response_created(response_id: str, created_at: int, model: str) -> str:
+    """response.created 事件"""
+    return _sse("response.created", {
+        "type": "response.created",
+        "response": {
+            "id": response_id,
+            "object": "response",
+            "created_at": created_at,
+            "status": "in_progress",
+            "model": model,
+            "output": []
+        }
+    })
+
+
+async def _early_stream(account, model, log_id, start_time, session_id, input_data, instructions, tools):
+    """先发送 response.created 再准备请求，准备阶段的错误以 response.failed 返回"""
+    yield _response_created(f"resp_{log_id}", int(start_time), model)
     
-    # 非流式
-    status_code = 0
-    error_msg = None
     try:
-        async with httpx.AsyncClient(verify=False, timeout=120) as client:
-            resp = await client.post(KIRO_API_URL, json=kiro_request, headers=headers)
-            status_code = resp.status_code
-            if resp.status_code != 200:
-                error_msg = resp.text[:500]
-                raise HTTPException(resp.status_code, resp.text)
-
-            result = parse_event_stream_full(resp.content)
-            account.request_count += 1
-            account.last_used = time.time()
-            get_rate_limiter().record_request(account.id)
-
-            return _build_response(result, model, log_id)
-    except HTTPException:
-        raise
+        kiro_request, headers, schedule_summary = await _prepare_request(account, model, session_id, input_data, instructions, tools)
     except Exception as e:
-        error_msg = str(e)
-        status_code = 500
-        raise
-    finally:
+        status = e.status_code if isinstance(e, HTTPException) else 500
+        error_msg = str(e.detail) if isinstance(e, HTTPException) else str(e)
+        print(f"[Responses] 请求准备失败: {error_msg}")
+        yield _sse("response.failed", {
+            "type": "response.failed",
+            "response": {
+                "id": f"resp_{log_id}",
+                "object": "response",
+                "status": "failed",
+                "error": {"code": "api_error", "message": error_msg[:200]}
+            }
+        })
         duration = (time.time() - start_time) * 1000
         state.add_log(RequestLog(
-            id=log_id,
-            timestamp=time.time(),
-            method="POST",
-            path="/v1/responses",
-            model=model,
-            account_id=account.id if account else None,
-            status=status_code,
-            duration_ms=duration,
-            error=error_msg
+            id=log_id, timestamp=time.time(), method="POST", path="/v1/responses (stream)",
+            model=model, account_id=account.id, status=status, duration_ms=duration, error=error_msg[:200]
         ))
-        stats_manager.record_request(
-            account_id=account.id if account else "unknown",
-            model=model,
-            success=status_code == 200,
-            duration_ms=duration
-        )
-
-
-def _build_response(result: dict, model: str, response_id: str) -> dict:
-    """构建非流式响应"""
-    text = "".join(result.get("content", []))
-    output = []
-    
-    if text:
-        output.append({
-            "type": "message",
-            "id": f"msg_{response_id}",
-            "role": "assistant",
-            "content": [{"type": "output_text", "text": text, "annotations": []}]
-        })
-    
-    for tool_use in result.get("tool_uses", []):
-        output.append({
-            "type": "function_call",
-            "id": tool_use.get("id", f"call_{uuid.uuid4().hex[:12]}"),
-            "call_id": tool_use.get("id", f"call_{uuid.uuid4().hex[:12]}"),
-            "name": tool_use.get("name", ""),
-            "arguments": json.dumps(tool_use.get("input", {}))
-        })
+        stats_manager.record_request(account_id=account.id, model=model, success=False, latency_ms=duration)
+        return
     
-    return {
-        "id": f"resp_{response_id}",
-        "object": "response",
-        "created_at": int(time.time()),
-        "status": "completed",
-        "model": model,
-        "output": output,
-        "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0}
-    }
+    async for chunk in _stream_events(kiro_request, headers, account, model, log_id, start_time, preamble_sent=True, schedule_summary=schedule_summary):
+        yield chunk
 
 
-async def _handle_stream(kiro_request, headers, account, model, log_id, start_time):
+async def _handle_stream(kiro_request, headers, account, model, log_id, start_time, request=None, schedule_summary=None):
     """流式处理 - Codex 期望的 SSE 格式"""
+    stream = _stream_events(kiro_request, headers, account, model, log_id, start_time, schedule_summary=schedule_summary)
+    return StreamingResponse(guard_stream(request, stream, keepalive=KEEPALIVE_COMMENT), media_type="text/event-stream")
+
+
+def _stream_events(kiro_request, headers, account, model, log_id, start_time, preamble_sent=False, schedule_summary=None):
+    """流式事件生成器；preamble_sent 为 True 时 response.created 已由 _early_stream 发送
+
+    schedule_summary 为 _prepare_request 返回的后台摘要回调，上游成功响应后调用。
+    """
     
     # 保存完整请求用于调试
     import os
@@ -606,7 +757,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
     async def generate():
         response_id = f"resp_{log_id}"
         item_id = f"msg_{log_id}"
-        created_at = int(time.time())
+        created_at = int(start_time)
         full_content = ""
         tool_uses = []
         error_occurred = False
@@ -614,150 +765,149 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
         print(f"[Responses] Request: model={model}, log_id={log_id}")
         
         try:
-            async with httpx.AsyncClient(verify=False, timeout=300) as client:
-                async with client.stream("POST", KIRO_API_URL, json=kiro_request, headers=headers) as response:
+            async with open_upstream_stream(account, kiro_request, headers) as response:
+                
+                if response.status_code != 200:
+                    error_text = await response.aread()
+                    error_msg = error_text.decode()[:500]
+                    print(f"[Responses] Kiro error: {response.status_code} - {error_msg[:200]}")
+                    if is_content_length_error(response.status_code, error_text.decode(errors="replace")):
+                        limit_predictor.record_request(kiro_request, ok=False)
                     
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        error_msg = error_text.decode()[:500]
-                        print(f"[Responses] Kiro error: {response.status_code} - {error_msg[:200]}")
+                    # 打印更多调试信息
+                    if response.status_code == 400:
+                        cs = kiro_request.get("conversationState", {})
+                        hist = cs.get("history", [])
+                        print(f"[Responses] 400 Debug: history_len={len(hist)}")
+                        if hist:
+                            # 检查每条 history 的详细结构
+                            for i, h in enumerate(hist[:5]):  # 只打印前5条
+                                if "userInputMessage" in h:
+                                    uim = h["userInputMessage"]
+                                    has_ctx = "userInputMessageContext" in uim
+                                    has_tr = has_ctx and "toolResults" in uim.get("userInputMessageContext", {})
+                                    content_len = len(uim.get("content", ""))
+                                    uim_keys = list(uim.keys())
+                                    print(f"[Responses]   hist[{i}]: user, keys={uim_keys}, content_len={content_len}, has_toolResults={has_tr}")
+                                elif "assistantResponseMessage" in h:
+                                    arm = h["assistantResponseMessage"]
+                                    arm_keys = list(arm.keys())
+                                    has_tu = "toolUses" in arm
+                                    tu_count = len(arm.get("toolUses", []) or []) if has_tu else 0
+                                    content_len = len(arm.get("content", "") or "")
+                                    print(f"[Responses]   hist[{i}]: assistant, keys={arm_keys}, content_len={content_len}, has_toolUses={has_tu}, toolUses_count={tu_count}")
+                                else:
+                                    print(f"[Responses]   hist[{i}]: UNKNOWN keys={list(h.keys())}")
+                            if len(hist) > 5:
+                                print(f"[Responses]   ... ({len(hist) - 5} more)")
                         
-                        # 打印更多调试信息
-                        if response.status_code == 400:
-                            cs = kiro_request.get("conversationState", {})
-                            hist = cs.get("history", [])
-                            print(f"[Responses] 400 Debug: history_len={len(hist)}")
-                            if hist:
-                                # 检查每条 history 的详细结构
-                                for i, h in enumerate(hist[:5]):  # 只打印前5条
-                                    if "userInputMessage" in h:
-                                        uim = h["userInputMessage"]
-                                        has_ctx = "userInputMessageContext" in uim
-                                        has_tr = has_ctx and "toolResults" in uim.get("userInputMessageContext", {})
-                                        content_len = len(uim.get("content", ""))
-                                        uim_keys = list(uim.keys())
-                                        print(f"[Responses]   hist[{i}]: user, keys={uim_keys}, content_len={content_len}, has_toolResults={has_tr}")
-                                    elif "assistantResponseMessage" in h:
-                                        arm = h["assistantResponseMessage"]
-                                        arm_keys = list(arm.keys())
-                                        has_tu = "toolUses" in arm
-                                        tu_count = len(arm.get("toolUses", []) or []) if has_tu else 0
-                                        content_len = len(arm.get("content", "") or "")
-                                        print(f"[Responses]   hist[{i}]: assistant, keys={arm_keys}, content_len={content_len}, has_toolUses={has_tu}, toolUses_count={tu_count}")
-                                    else:
-                                        print(f"[Responses]   hist[{i}]: UNKNOWN keys={list(h.keys())}")
-                                if len(hist) > 5:
-                                    print(f"[Responses]   ... ({len(hist) - 5} more)")
-                            
-                            # 打印 currentMessage 结构
-                            cm = cs.get("currentMessage", {})
-                            if "userInputMessage" in cm:
-                                uim = cm["userInputMessage"]
-                                print(f"[Responses] currentMessage: keys={list(uim.keys())}, content_len={len(uim.get('content', ''))}")
-                                if "userInputMessageContext" in uim:
-                                    ctx = uim["userInputMessageContext"]
-                                    print(f"[Responses]   context keys={list(ctx.keys())}")
-                                    if "toolResults" in ctx:
-                                        print(f"[Responses]   toolResults count={len(ctx['toolResults'])}")
-                                    if "tools" in ctx:
-                                        print(f"[Responses]   tools count={len(ctx['tools'])}")
-                        
-                        error_occurred = True
-                        
-                        # 映射错误代码
-                        error_code = "api_error"
-                        error_lower = error_msg.lower()
-                        if response.status_code == 429 or "rate limit" in error_lower or "throttl" in error_lower:
-                            error_code = "rate_limit_exceeded"
-                        elif "context" in error_lower or "too long" in error_lower or "content length" in error_lower:
-                            error_code = "context_length_exceeded"
-                        elif "quota" in error_lower or "insufficient" in error_lower:
-                            error_code = "insufficient_quota"
-                        elif response.status_code == 401 or response.status_code == 403:
-                            error_code = "authentication_error"
-                        
-                        yield _sse("response.failed", {
-                            "type": "response.failed",
-                            "response": {
-                                "id": response_id,
-                                "object": "response",
-                                "status": "failed",
-                                "error": {"code": error_code, "message": error_msg[:200]}
-                            }
-                        })
-                        duration = (time.time() - start_time) * 1000
-                        state.add_log(RequestLog(
-                            id=log_id,
-                            timestamp=time.time(),
-                            method="POST",
-                            path="/v1/responses (stream)",
-                            model=model,
-                            account_id=account.id if account else None,
-                            status=response.status_code,
-                            duration_ms=duration,
-                            error=error_msg[:200]
-                        ))
-                        stats_manager.record_request(
-                            account_id=account.id if account else "unknown",
-                            model=model,
-                            success=False,
-                            duration_ms=duration
-                        )
-                        return
+                        # 打印 currentMessage 结构
+                        cm = cs.get("currentMessage", {})
+                        if "userInputMessage" in cm:
+                            uim = cm["userInputMessage"]
+                            print(f"[Responses] currentMessage: keys={list(uim.keys())}, content_len={len(uim.get('content', ''))}")
+                            if "userInputMessageContext" in uim:
+                                ctx = uim["userInputMessageContext"]
+                                print(f"[Responses]   context keys={list(ctx.keys())}")
+                                if "toolResults" in ctx:
+                                    print(f"[Responses]   toolResults count={len(ctx['toolResults'])}")
+                                if "tools" in ctx:
+                                    print(f"[Responses]   tools count={len(ctx['tools'])}")
                     
-                    # 1. response.created
-                    yield _sse("response.created", {
-                        "type": "response.created",
+                    error_occurred = True
+                    
+                    # 映射错误代码
+                    error_code = "api_error"
+                    error_lower = error_msg.lower()
+                    if response.status_code == 429 or "rate limit" in error_lower or "throttl" in error_lower:
+                        error_code = "rate_limit_exceeded"
+                    elif "context" in error_lower or "too long" in error_lower or "content length" in error_lower:
+                        error_code = "context_length_exceeded"
+                    elif "quota" in error_lower or "insufficient" in error_lower:
+                        error_code = "insufficient_quota"
+                    elif response.status_code == 401 or response.status_code == 403:
+                        error_code = "authentication_error"
+                    
+                    yield _sse("response.failed", {
+                        "type": "response.failed",
                         "response": {
                             "id": response_id,
                             "object": "response",
-                            "created_at": created_at,
-                            "status": "in_progress",
-                            "model": model,
-                            "output": []
-                        }
-                    })
-                    
-                    # 2. response.output_item.added
-                    yield _sse("response.output_item.added", {
-                        "type": "response.output_item.added",
-                        "output_index": 0,
-                        "item": {
-                            "id": item_id,
-                            "type": "message",
-                            "status": "in_progress",
-                            "role": "assistant",
-                            "content": []
+                            "status": "failed",
+                            "error": {"code": error_code, "message": error_msg[:200]}
                         }
                     })
-                    
-                    # 3. 流式读取并发送 delta
-                    full_response = b""
-                    async for chunk in response.aiter_bytes():
-                        full_response += chunk
-                        
-                        # 尝试解析增量内容
-                        content = _extract_content_from_chunk(chunk)
-                        if content:
-                            full_content += content
-                            yield _sse("response.output_text.delta", {
-                                "type": "response.output_text.delta",
-                                "item_id": item_id,
-                                "output_index": 0,
-                                "content_index": 0,
-                                "delta": content
-                            })
-                    
-                    # 解析完整响应获取工具调用
-                    result = parse_event_stream_full(full_response)
-                    tool_uses = result.get("tool_uses", [])
-                    if not full_content:
-                        full_content = "".join(result.get("content", []))
-                    
-                    account.request_count += 1
-                    account.last_used = time.time()
-                    get_rate_limiter().record_request(account.id)
-                    
+                    duration = (time.time() - start_time) * 1000
+                    state.add_log(RequestLog(
+                        id=log_id,
+                        timestamp=time.time(),
+                        method="POST",
+                        path="/v1/responses (stream)",
+                        model=model,
+                        account_id=account.id if account else None,
+                        status=response.status_code,
+                        duration_ms=duration,
+                        error=error_msg[:200]
+                    ))
+                    stats_manager.record_request(
+                        account_id=account.id if account else "unknown",
+                        model=model,
+                        success=False,
+                        latency_ms=duration
+                    )
+                    return
+                
+                limit_predictor.record_request(kiro_request, ok=True)
+                if schedule_summary:
+                    schedule_summary()
+                
+                # 1. response.created
+                if not preamble_sent:
+                    yield _response_created(response_id, created_at, model)
+                
+                # 2. response.output_item.added
+                yield _sse("response.output_item.added", {
+                    "type": "response.output_item.added",
+                    "output_index": 0,
+                    "item": {
+                        "id": item_id,
+                        "type": "message",
+                        "status": "in_progress",
+                        "role": "assistant",
+                        "content": []
+                    }
+                })
+                
+                # 3. 流式读取并发送 delta
+                # 单遍解析：边解码边汇总文本和工具调用，不缓存原始响应
+                decoder = EventStreamDecoder()
+                accumulator = ResponseAccumulator()
+                coalescer = DeltaCoalescer()
+                encoder = ResponsesSSE(item_id)
+                async for chunk in iter_coalesced(response.aiter_bytes(), coalescer):
+                    if chunk is None:
+                        yield encoder.text_delta(coalescer.flush())
+                        continue
+                    out = []
+                    for event in decoder.feed(chunk):
+                        accumulator.add(event)
+                        if isinstance(event, TextDelta):
+                            merged = coalescer.add(event.text)
+                            if merged:
+                                out.append(encoder.text_delta(merged))
+                    if out:
+                        yield b"".join(out)
+                if coalescer.pending:
+                    yield encoder.text_delta(coalescer.flush())
+                
+                result = accumulator.to_result()
+                tool_uses = result["tool_uses"]
+                full_content = accumulator.text
+                
+                account.request_count += 1
+                account.last_used = time.time()
+                get_rate_limiter().record_request(account.id)
+                
         except Exception as e:
             error_occurred = True
             yield _sse("response.failed", {
@@ -784,7 +934,7 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
                 account_id=account.id if account else "unknown",
                 model=model,
                 success=False,
-                duration_ms=duration
+                latency_ms=duration
             )
             return
         
@@ -873,46 +1023,12 @@ async def _handle_stream(kiro_request, headers, account, model, log_id, start_ti
             account_id=account.id if account else "unknown",
             model=model,
             success=True,
-            duration_ms=duration
+            latency_ms=duration
         )
 
-    return StreamingResponse(generate(), media_type="text/event-stream")
+    return generate()
 
 
 def _sse(event_type: str, data: dict) -> str:
     """生成 SSE 格式的事件"""
-    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
-
-
-def _extract_content_from_chunk(chunk: bytes) -> str:
-    """从 AWS event-stream chunk 中提取文本内容"""
-    content = ""
-    pos = 0
-    
-    while pos < len(chunk):
-        if pos + 12 > len(chunk):
-            break
-        
-        total_len = int.from_bytes(chunk[pos:pos+4], 'big')
-        if total_len == 0 or total_len > len(chunk) - pos:
-            break
-        
-        headers_len = int.from_bytes(chunk[pos+4:pos+8], 'big')
-        payload_start = pos + 12 + headers_len
-        payload_end = pos + total_len - 4
-        
-        if payload_start < payload_end:
-            try:
-                payload = json.loads(chunk[payload_start:payload_end].decode('utf-8'))
-                if 'assistantResponseEvent' in payload:
-                    c = payload['assistantResponseEvent'].get('content')
-                    if c:
-                        content += c
-                elif 'content' in payload and 'toolUseId' not in payload:
-                    content += payload['content']
-            except:
-                pass
-        
-        pos += total_len
-    
-    return content
+    return f"event: {event_type}\ndata: {jsonfast.dumps(data)}\n\n"
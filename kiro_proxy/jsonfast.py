@@ -0,0 +1,69 @@
+"""JSON 编解码 - 安装了 orjson 时使用 orjson，否则回退标准库
+
+请求解析、event-stream 帧、SSE 事件、请求体编码、历史大小估算都在热路径上。
+两个后端输出一致：紧凑分隔符、非 ASCII 字符不转义（UTF-8），
+所以会话 ID、历史大小等由 JSON 文本派生的值不随后端变化。
+"""
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson else 0
+_SORT_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS) if orjson else 0
+
+_std_loads = json.JSONDecoder().decode
+_std_compact = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+_use_orjson = ORJSON_AVAILABLE
+
+
+def backend() -> str:
+    """当前使用的后端"""
+    return "orjson" if _use_orjson else "json"
+
+
+def set_backend(name: str) -> str:
+    """切换后端（"orjson" / "json"），返回切换前的后端；orjson 未安装时保持标准库"""
+    global _use_orjson
+    previous = backend()
+    _use_orjson = name == "orjson" and ORJSON_AVAILABLE
+    return previous
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """解析 JSON；格式错误时抛出 ValueError（json.JSONDecodeError）"""
+    if _use_orjson:
+        return orjson.loads(data)
+    if not isinstance(data, str):
+        data = bytes(data).decode("utf-8")
+    return _std_loads(data)
+
+
+def dumpb(obj: Any, sort_keys: bool = False, default: Optional[Callable] = None) -> bytes:
+    """编码为 UTF-8 JSON bytes"""
+    if _use_orjson:
+        try:
+            return orjson.dumps(obj, default=default, option=_SORT_OPTIONS if sort_keys else _OPTIONS)
+        except TypeError:
+            # 超出 64 位的整数等 orjson 不支持的值，交给标准库
+            pass
+    if sort_keys or default is not None:
+        return json.dumps(
+            obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=default
+        ).encode()
+    return _std_compact(obj).encode()
+
+
+def dumps(obj: Any, sort_keys: bool = False, default: Optional[Callable] = None) -> str:
+    """编码为 JSON 字符串"""
+    if _use_orjson:
+        return dumpb(obj, sort_keys, default).decode()
+    if sort_keys or default is not None:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=default)
+    return _std_compact(obj)
@@ -47,6 +47,11 @@ def build_kiro_request(
     )
 
 
+def encode_kiro_request(request: dict) -> bytes:
+    """编码 Kiro API 请求体（预序列化的工具列表直接拼接）"""
+    return _default_provider.encode_request(request)
+
+
 def parse_event_stream(raw: bytes) -> str:
     """解析 AWS event-stream 格式，返回文本内容"""
     return _default_provider.parse_response_text(raw)
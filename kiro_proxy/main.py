@@ -1,8 +1,8 @@
 """Kiro API Proxy - 主应用"""
 import json
 import uuid
-import httpx
 import sys
+import asyncio
 from pathlib import Path
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
@@ -11,10 +11,12 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from .config import MODELS_URL
 from .core import state, scheduler, stats_manager
+from .core.http_client import upstream, get_http_client
+from .core.summarizer import background_summarizer
 from .handlers import anthropic, openai, gemini, admin
 from .handlers import responses as responses_handler
 from .web import get_html_page
-from .credential import generate_machine_id, get_kiro_version
+from .credential import generate_machine_id, get_kiro_version, get_system_info
 
 
 def get_resource_path(relative_path: str) -> Path:
@@ -27,10 +29,19 @@ def get_resource_path(relative_path: str) -> Path:
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     # 启动时
+    # 预先检测版本和系统信息（涉及子进程调用），避免在请求路径上阻塞事件循环
+    await asyncio.to_thread(get_kiro_version)
+    await asyncio.to_thread(get_system_info)
+    for acc in state.accounts:
+        acc.get_header_template()
+    await upstream.start()
     await scheduler.start()
+    await background_summarizer.start()
     yield
     # 关闭时
+    await background_summarizer.stop()
     await scheduler.stop()
+    await upstream.stop()
 
 
 app = FastAPI(title="Kiro API Proxy", docs_url="/docs", redoc_url=None, lifespan=lifespan)
@@ -81,22 +92,21 @@ async def models():
             "amz-sdk-invocation-id": str(uuid.uuid4()),
             "Authorization": f"Bearer {token}",
         }
-        async with httpx.AsyncClient(verify=False, timeout=30) as client:
-            resp = await client.get(MODELS_URL, headers=headers, params={"origin": "AI_EDITOR"})
-            if resp.status_code == 200:
-                data = resp.json()
-                return {
-                    "object": "list",
-                    "data": [
-                        {
-                            "id": m["modelId"],
-                            "object": "model",
-                            "owned_by": "kiro",
-                            "name": m["modelName"],
-                        }
-                        for m in data.get("models", [])
-                    ]
-                }
+        resp = await get_http_client().get(MODELS_URL, headers=headers, params={"origin": "AI_EDITOR"}, timeout=30)
+        if resp.status_code == 200:
+            data = resp.json()
+            return {
+                "object": "list",
+                "data": [
+                    {
+                        "id": m["modelId"],
+                        "object": "model",
+                        "owned_by": "kiro",
+                        "name": m["modelName"],
+                    }
+                    for m in data.get("models", [])
+                ]
+            }
     except Exception:
         pass
     
@@ -141,6 +151,12 @@ async def gemini_generate(model_name: str, request: Request):
     return await gemini.handle_generate_content(model_name, request)
 
 
+@app.post("/v1beta/models/{model_name}:streamGenerateContent")
+@app.post("/v1/models/{model_name}:streamGenerateContent")
+async def gemini_stream_generate(model_name: str, request: Request):
+    return await gemini.handle_generate_content(model_name, request, stream=True)
+
+
 # ==================== 管理 API ====================
 
 @app.get("/api/status")
@@ -435,14 +451,14 @@ async def remote_login_page(session_id: str):
 
 # ==================== 历史消息管理 API ====================
 
-from .core import get_history_config, update_history_config, TruncateStrategy
+from .core import get_history_config, update_history_config, TruncateStrategy, limit_predictor
 from .core.rate_limiter import get_rate_limiter
 
 @app.get("/api/settings/history")
 async def api_get_history_config():
     """获取历史消息管理配置"""
     config = get_history_config()
-    return config.to_dict()
+    return {**config.to_dict(), "learned_limits": limit_predictor.to_dict()}
 
 
 @app.post("/api/settings/history")
@@ -450,7 +466,14 @@ async def api_update_history_config(request: Request):
     """更新历史消息管理配置"""
     data = await request.json()
     update_history_config(data)
-    return {"ok": True, "config": get_history_config().to_dict()}
+    return {"ok": True, "config": get_history_config().to_dict(), "learned_limits": limit_predictor.to_dict()}
+
+
+@app.delete("/api/settings/history/limits")
+async def api_reset_history_limits(model: str = None):
+    """清除学到的上下文长度上限（可按模型）"""
+    limit_predictor.reset(model)
+    return {"ok": True, "learned_limits": limit_predictor.to_dict()}
 
 
 # ==================== 限速配置 API ====================
@@ -484,6 +507,54 @@ async def api_update_rate_limit_config(request: Request):
     }}
 
 
+# ==================== 上游连接池配置 API ====================
+
+@app.get("/api/settings/upstream")
+async def api_get_upstream_config():
+    """获取上游连接池配置"""
+    from dataclasses import asdict
+    return {**asdict(upstream.config), "stats": upstream.get_pool_stats()}
+
+
+@app.post("/api/settings/upstream")
+async def api_update_upstream_config(request: Request):
+    """更新上游连接池配置（新请求立即使用新连接池）"""
+    from dataclasses import asdict
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise HTTPException(400, "配置必须是 JSON 对象")
+    try:
+        upstream.update_config(**data)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"ok": True, "config": asdict(upstream.config)}
+
+
+# ==================== SSE 输出配置 API ====================
+
+@app.get("/api/settings/sse")
+async def api_get_sse_config():
+    """获取 SSE 输出配置（增量合并、提前前导、keep-alive）"""
+    from dataclasses import asdict
+    from .core.sse import get_sse_config
+    return asdict(get_sse_config())
+
+
+@app.post("/api/settings/sse")
+async def api_update_sse_config(request: Request):
+    """更新 SSE 输出配置（对新的流生效）"""
+    from dataclasses import asdict
+    from .core.sse import update_sse_config
+    data = await request.json()
+    if not isinstance(data, dict):
+        raise HTTPException(400, "配置必须是 JSON 对象")
+    try:
+        config = update_sse_config(**data)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"ok": True, "config": asdict(config)}
+
+
 # ==================== 文档 API ====================
 
 # 文档标题映射
@@ -559,6 +630,5 @@ def run(port: int = 8080):
 
 
 if __name__ == "__main__":
-    import sys
     port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
     run(port)
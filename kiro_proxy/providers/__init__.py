@@ -1,5 +1,13 @@
 """Provider 模块"""
 from .base import BaseProvider
 from .kiro import KiroProvider
+from .event_stream import (
+    EventStreamDecoder, EventStreamError, ResponseAccumulator,
+    TextDelta, ToolUseDelta, MeteringEvent, ExceptionEvent,
+)
 
-__all__ = ["BaseProvider", "KiroProvider"]
+__all__ = [
+    "BaseProvider", "KiroProvider",
+    "EventStreamDecoder", "EventStreamError", "ResponseAccumulator",
+    "TextDelta", "ToolUseDelta", "MeteringEvent", "ExceptionEvent",
+]
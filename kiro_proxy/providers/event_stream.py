@@ -0,0 +1,324 @@
+"""AWS event-stream 增量解码
+
+Kiro 的 generateAssistantResponse 以 AWS event-stream 二进制帧返回。每一帧：
+
+    [total_len:4][headers_len:4][prelude_crc:4][headers][payload][message_crc:4]
+
+网络分块 (aiter_bytes) 不保证按帧边界切分，所以解码器保留未解析完的尾部
+字节，下次 feed 时与新数据拼接后继续解析，不会丢失跨块的帧。
+"""
+import struct
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Union
+
+from .. import jsonfast
+
+_PRELUDE = struct.Struct(">III")
+_PRELUDE_LEN = 12
+_CRC_LEN = 4
+_MIN_FRAME_LEN = _PRELUDE_LEN + _CRC_LEN
+
+# 单帧上限，超过视为流已损坏
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# 同一种事件的头部字节完全相同，按原始字节缓存解析结果
+_HEADER_CACHE: Dict[bytes, Dict[str, Any]] = {}
+_HEADER_CACHE_SIZE = 256
+
+
+class EventStreamError(ValueError):
+    """event-stream 帧损坏"""
+
+
+@dataclass
+class TextDelta:
+    """assistantResponseEvent - 文本增量"""
+    text: str
+
+
+@dataclass
+class ToolUseDelta:
+    """toolUseEvent - 工具调用片段（input 为 JSON 字符串片段）"""
+    tool_use_id: str
+    name: str = ""
+    input: str = ""
+    stop: bool = False
+
+
+@dataclass
+class MeteringEvent:
+    """meteringEvent / contextUsageEvent 等计量信息"""
+    event_type: str
+    data: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class ExceptionEvent:
+    """流内异常（:message-type 为 exception / error）"""
+    exception_type: str
+    message: str = ""
+
+
+StreamEvent = Union[TextDelta, ToolUseDelta, MeteringEvent, ExceptionEvent]
+
+
+def _get_headers(buf, start: int, end: int) -> Dict[str, Any]:
+    """获取帧头部（带缓存）"""
+    raw = bytes(buf[start:end])
+    headers = _HEADER_CACHE.get(raw)
+    if headers is None:
+        headers = _parse_headers(raw, 0, len(raw))
+        if len(_HEADER_CACHE) < _HEADER_CACHE_SIZE:
+            _HEADER_CACHE[raw] = headers
+    return headers
+
+
+def _parse_headers(buf, start: int, end: int) -> Dict[str, Any]:
+    """解析帧头部，返回 {name: value}"""
+    headers = {}
+    pos = start
+    while pos < end:
+        name_len = buf[pos]
+        pos += 1
+        name = bytes(buf[pos:pos + name_len]).decode("utf-8", errors="replace")
+        pos += name_len
+        value_type = buf[pos]
+        pos += 1
+
+        if value_type == 7 or value_type == 6:
+            # string / bytes: 2 字节长度 + 内容
+            (value_len,) = struct.unpack_from(">H", buf, pos)
+            pos += 2
+            raw = bytes(buf[pos:pos + value_len])
+            pos += value_len
+            value = raw.decode("utf-8", errors="replace") if value_type == 7 else raw
+        elif value_type == 0 or value_type == 1:
+            value = value_type == 0
+        elif value_type == 2:
+            (value,) = struct.unpack_from(">b", buf, pos)
+            pos += 1
+        elif value_type == 3:
+            (value,) = struct.unpack_from(">h", buf, pos)
+            pos += 2
+        elif value_type == 4:
+            (value,) = struct.unpack_from(">i", buf, pos)
+            pos += 4
+        elif value_type == 5 or value_type == 8:
+            (value,) = struct.unpack_from(">q", buf, pos)
+            pos += 8
+        elif value_type == 9:
+            value = bytes(buf[pos:pos + 16])
+            pos += 16
+        else:
+            raise EventStreamError(f"unknown header value type {value_type}")
+
+        headers[name] = value
+    return headers
+
+
+def _to_event(headers: Dict[str, Any], payload: Any) -> Optional[StreamEvent]:
+    """把帧头部和 JSON payload 转换为类型化事件"""
+    message_type = headers.get(":message-type", "event")
+    if message_type in ("exception", "error"):
+        exception_type = headers.get(":exception-type") or headers.get(":error-code") or "UnknownException"
+        message = ""
+        if isinstance(payload, dict):
+            message = payload.get("message") or payload.get("Message") or ""
+        elif isinstance(payload, str):
+            message = payload
+        return ExceptionEvent(exception_type, message)
+
+    if not isinstance(payload, dict):
+        return None
+
+    event_type = headers.get(":event-type")
+    if event_type is None:
+        # 缺少 :event-type 时按 payload 结构判断
+        if "assistantResponseEvent" in payload:
+            event_type = "assistantResponseEvent"
+            payload = payload["assistantResponseEvent"]
+        elif "toolUseId" in payload:
+            event_type = "toolUseEvent"
+        elif "content" in payload:
+            event_type = "assistantResponseEvent"
+        else:
+            return None
+
+    if event_type == "assistantResponseEvent":
+        if "assistantResponseEvent" in payload:
+            payload = payload["assistantResponseEvent"]
+        text = payload.get("content")
+        return TextDelta(text) if text else None
+
+    if event_type == "toolUseEvent":
+        return ToolUseDelta(
+            tool_use_id=payload.get("toolUseId", ""),
+            name=payload.get("name", ""),
+            input=payload.get("input", "") or "",
+            stop=bool(payload.get("stop", False)),
+        )
+
+    return MeteringEvent(event_type, payload)
+
+
+class EventStreamDecoder:
+    """有状态的 event-stream 解码器
+
+    用法::
+
+        decoder = EventStreamDecoder()
+        async for chunk in response.aiter_bytes():
+            for event in decoder.feed(chunk):
+                ...
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self.bytes_fed = 0
+        self.frames_decoded = 0
+        self.error: Optional[str] = None
+
+    @property
+    def pending_bytes(self) -> int:
+        """尚未组成完整帧的字节数"""
+        return len(self._buffer)
+
+    def feed(self, data: bytes) -> List[StreamEvent]:
+        """输入一块数据，返回其中完整帧解码出的事件
+
+        帧损坏时记录 error 并丢弃后续数据（已解码的事件照常返回）。
+        """
+        if not data or self.error:
+            return []
+        self.bytes_fed += len(data)
+        buf = self._buffer
+        buf += data
+
+        events = []
+        pos = 0
+        end = len(buf)
+        try:
+            while end - pos >= _PRELUDE_LEN:
+                total_len, headers_len, prelude_crc = _PRELUDE.unpack_from(buf, pos)
+                if total_len < _MIN_FRAME_LEN or total_len > self.max_frame_size \
+                        or headers_len > total_len - _MIN_FRAME_LEN:
+                    raise EventStreamError(f"invalid frame length {total_len}")
+                if zlib.crc32(buf[pos:pos + 8]) != prelude_crc:
+                    raise EventStreamError("prelude checksum mismatch")
+                if end - pos < total_len:
+                    break
+
+                headers_start = pos + _PRELUDE_LEN
+                payload_start = headers_start + headers_len
+                payload_end = pos + total_len - _CRC_LEN
+                headers = _get_headers(buf, headers_start, payload_start) if headers_len else {}
+
+                payload = None
+                if payload_start < payload_end:
+                    raw = bytes(buf[payload_start:payload_end])
+                    try:
+                        payload = jsonfast.loads(raw)
+                    except ValueError:
+                        text = raw.decode("utf-8", errors="replace")
+                        try:
+                            payload = jsonfast.loads(text)
+                        except ValueError:
+                            payload = text
+
+                self.frames_decoded += 1
+                event = _to_event(headers, payload)
+                if event is not None:
+                    events.append(event)
+                pos += total_len
+        except (EventStreamError, struct.error, IndexError) as e:
+            self.error = str(e)
+            print(f"[EventStream] 帧解析失败，丢弃剩余数据: {e}")
+            buf.clear()
+            return events
+
+        if pos:
+            del buf[:pos]
+        return events
+
+
+class ResponseAccumulator:
+    """把事件序列单遍汇总为 parse_response 的结果结构
+
+    工具调用在收到 stop 片段时立即组装并释放输入片段，流式场景下占用的内存
+    只和当前未完成的工具输入有关，不需要缓存完整的原始响应再解析一遍。
+    """
+
+    def __init__(self):
+        self.content: List[str] = []
+        self.exceptions: List[ExceptionEvent] = []
+        self.metering: List[MeteringEvent] = []
+        self._tools: Dict[str, dict] = {}
+
+    @property
+    def text(self) -> str:
+        return "".join(self.content)
+
+    @property
+    def tool_uses(self) -> List[dict]:
+        """已完成的工具调用（按首次出现顺序）"""
+        return [tool["result"] for tool in self._tools.values() if tool["result"] is not None]
+
+    def add(self, event: StreamEvent) -> Optional[dict]:
+        """处理一个事件；某个工具调用完成时返回组装好的 tool_use"""
+        if isinstance(event, TextDelta):
+            self.content.append(event.text)
+        elif isinstance(event, ToolUseDelta):
+            if not event.tool_use_id:
+                return None
+            tool = self._tools.get(event.tool_use_id)
+            if tool is None:
+                tool = self._tools[event.tool_use_id] = {
+                    "id": event.tool_use_id,
+                    "name": event.name,
+                    "input_parts": [],
+                    "result": None,
+                }
+            elif tool["result"] is not None:
+                # stop 之后的片段忽略
+                return None
+            if event.name and not tool["name"]:
+                tool["name"] = event.name
+            if event.input:
+                tool["input_parts"].append(event.input)
+            if event.stop:
+                return self._finish_tool(tool)
+        elif isinstance(event, ExceptionEvent):
+            self.exceptions.append(event)
+        elif isinstance(event, MeteringEvent):
+            self.metering.append(event)
+        return None
+
+    @staticmethod
+    def _finish_tool(tool: dict) -> dict:
+        input_str = "".join(tool["input_parts"])
+        try:
+            input_json = jsonfast.loads(input_str) if input_str else {}
+        except ValueError:
+            input_json = {"raw": input_str}
+        tool["input_parts"] = []
+        tool["result"] = {
+            "type": "tool_use",
+            "id": tool["id"],
+            "name": tool["name"],
+            "input": input_json,
+        }
+        return tool["result"]
+
+    def to_result(self) -> Dict[str, Any]:
+        for tool in self._tools.values():
+            if tool["result"] is None:
+                self._finish_tool(tool)
+        tool_uses = self.tool_uses
+
+        return {
+            "content": self.content,
+            "tool_uses": tool_uses,
+            "stop_reason": "tool_use" if tool_uses else "end_turn",
+        }
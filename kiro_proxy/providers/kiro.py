@@ -1,15 +1,36 @@
 """Kiro Provider"""
-import json
+import time
 import uuid
 from typing import Dict, Any, List, Optional, Tuple
 
 from .base import BaseProvider
+from .event_stream import EventStreamDecoder, ResponseAccumulator
+from .. import jsonfast
 from ..credential import (
     KiroCredentials, TokenRefresher,
     generate_machine_id, get_kiro_version, get_system_info
 )
 
 
+# 编码请求体时替代预序列化工具列表的占位字符串（每个进程随机）
+_TOOLS_PLACEHOLDER = f"__kiro_tools_{uuid.uuid4().hex}__"
+_TOOLS_PLACEHOLDER_JSON = jsonfast.dumpb(_TOOLS_PLACEHOLDER)
+
+
+class KiroRequest(dict):
+    """Kiro API 请求体
+
+    首次编码后保存 JSON bytes，重试和切换账号时直接复用（请求 ID 保持不变）。
+    编码后不要再修改请求体；需要修改时重新 build_request。
+    """
+    __slots__ = ("encoded", "encode_ms")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.encoded: Optional[bytes] = None
+        self.encode_ms = 0.0
+
+
 class KiroProvider(BaseProvider):
     """Kiro/CodeWhisperer Provider"""
     
@@ -29,10 +50,7 @@ class KiroProvider(BaseProvider):
         return self.API_URL
     
     def get_machine_id(self) -> str:
-        """获取基于凭证的 Machine ID"""
-        if self._machine_id:
-            return self._machine_id
-        
+        """获取基于凭证的 Machine ID（按小时变化，内部已缓存哈希结果）"""
         if self.credentials:
             self._machine_id = generate_machine_id(
                 self.credentials.profile_arn,
@@ -43,14 +61,12 @@ class KiroProvider(BaseProvider):
         
         return self._machine_id
     
-    def build_headers(
-        self, 
-        token: str, 
-        agent_mode: str = "vibe",
-        **kwargs
-    ) -> Dict[str, str]:
-        """构建 Kiro API 请求头"""
-        machine_id = kwargs.get("machine_id") or self.get_machine_id()
+    @staticmethod
+    def build_header_template(machine_id: str, agent_mode: str = "vibe") -> Dict[str, str]:
+        """构建请求头的静态部分（不含 invocation id 和 Authorization）
+        
+        同一账号在同一小时内 machine_id 不变，结果可以缓存复用。
+        """
         kiro_version = get_kiro_version()
         os_name, node_version = get_system_info()
         
@@ -60,12 +76,27 @@ class KiroProvider(BaseProvider):
             "x-amzn-kiro-agent-mode": agent_mode,
             "x-amz-user-agent": f"aws-sdk-js/1.0.0 KiroIDE-{kiro_version}-{machine_id}",
             "user-agent": f"aws-sdk-js/1.0.0 ua/2.1 os/{os_name} lang/js md/nodejs#{node_version} api/codewhispererruntime#1.0.0 m/E KiroIDE-{kiro_version}-{machine_id}",
-            "amz-sdk-invocation-id": str(uuid.uuid4()),
             "amz-sdk-request": "attempt=1; max=1",
-            "Authorization": f"Bearer {token}",
-            "Connection": "close",
         }
     
+    @staticmethod
+    def stamp_headers(template: Dict[str, str], token: str) -> Dict[str, str]:
+        """基于模板生成单次请求的请求头（填充 invocation id 和 Authorization）"""
+        headers = dict(template)
+        headers["amz-sdk-invocation-id"] = str(uuid.uuid4())
+        headers["Authorization"] = f"Bearer {token}"
+        return headers
+    
+    def build_headers(
+        self, 
+        token: str, 
+        agent_mode: str = "vibe",
+        **kwargs
+    ) -> Dict[str, str]:
+        """构建 Kiro API 请求头"""
+        machine_id = kwargs.get("machine_id") or self.get_machine_id()
+        return self.stamp_headers(self.build_header_template(machine_id, agent_mode), token)
+    
     def build_request(
         self,
         messages: list = None,
@@ -103,7 +134,7 @@ class KiroProvider(BaseProvider):
         if context:
             user_input_message["userInputMessageContext"] = context
         
-        return {
+        return KiroRequest({
             "conversationState": {
                 "agentContinuationId": str(uuid.uuid4()),
                 "agentTaskType": "vibe",
@@ -112,97 +143,47 @@ class KiroProvider(BaseProvider):
                 "currentMessage": {"userInputMessage": user_input_message},
                 "history": history or []
             }
-        }
+        })
+    
+    @classmethod
+    def encode_request(cls, request: Dict[str, Any]) -> bytes:
+        """把请求体编码为 JSON bytes（jsonfast）
+
+        KiroRequest 只编码一次，之后返回保存的 bytes。
+        """
+        if not isinstance(request, KiroRequest):
+            return cls._encode(request)
+        if request.encoded is None:
+            started = time.perf_counter()
+            request.encoded = cls._encode(request)
+            request.encode_ms = (time.perf_counter() - started) * 1000
+        return request.encoded
+
+    @staticmethod
+    def _encode(request: Dict[str, Any]) -> bytes:
+        """工具列表带有预序列化 JSON（converters.KiroTools）时直接拼接，
+        不再重新编码几十个工具的 schema。不修改传入的请求体。
+        """
+        state = request.get("conversationState") or {}
+        message = (state.get("currentMessage") or {}).get("userInputMessage") or {}
+        context = message.get("userInputMessageContext") or {}
+        encoded = getattr(context.get("tools"), "encoded", None)
+        if encoded is None:
+            return jsonfast.dumpb(request)
+
+        context = dict(context, tools=_TOOLS_PLACEHOLDER)
+        message = dict(message, userInputMessageContext=context)
+        state = dict(state, currentMessage=dict(state["currentMessage"], userInputMessage=message))
+        body = jsonfast.dumpb(dict(request, conversationState=state))
+        head, _, tail = body.partition(_TOOLS_PLACEHOLDER_JSON)
+        return head + encoded + tail
     
     def parse_response(self, raw: bytes) -> Dict[str, Any]:
         """解析 AWS event-stream 格式响应"""
-        result = {
-            "content": [],
-            "tool_uses": [],
-            "stop_reason": "end_turn"
-        }
-        
-        tool_input_buffer = {}
-        pos = 0
-        
-        while pos < len(raw):
-            if pos + 12 > len(raw):
-                break
-            
-            total_len = int.from_bytes(raw[pos:pos+4], 'big')
-            headers_len = int.from_bytes(raw[pos+4:pos+8], 'big')
-            
-            if total_len == 0 or total_len > len(raw) - pos:
-                break
-            
-            header_start = pos + 12
-            header_end = header_start + headers_len
-            headers_data = raw[header_start:header_end]
-            event_type = None
-            
-            try:
-                headers_str = headers_data.decode('utf-8', errors='ignore')
-                if 'toolUseEvent' in headers_str:
-                    event_type = 'toolUseEvent'
-                elif 'assistantResponseEvent' in headers_str:
-                    event_type = 'assistantResponseEvent'
-            except:
-                pass
-            
-            payload_start = pos + 12 + headers_len
-            payload_end = pos + total_len - 4
-            
-            if payload_start < payload_end:
-                try:
-                    payload = json.loads(raw[payload_start:payload_end].decode('utf-8'))
-                    
-                    if 'assistantResponseEvent' in payload:
-                        e = payload['assistantResponseEvent']
-                        if 'content' in e:
-                            result["content"].append(e['content'])
-                    elif 'content' in payload and event_type != 'toolUseEvent':
-                        result["content"].append(payload['content'])
-                    
-                    if event_type == 'toolUseEvent' or 'toolUseId' in payload:
-                        tool_id = payload.get('toolUseId', '')
-                        tool_name = payload.get('name', '')
-                        tool_input = payload.get('input', '')
-                        
-                        if tool_id:
-                            if tool_id not in tool_input_buffer:
-                                tool_input_buffer[tool_id] = {
-                                    "id": tool_id,
-                                    "name": tool_name,
-                                    "input_parts": []
-                                }
-                            if tool_name and not tool_input_buffer[tool_id]["name"]:
-                                tool_input_buffer[tool_id]["name"] = tool_name
-                            if tool_input:
-                                tool_input_buffer[tool_id]["input_parts"].append(tool_input)
-                except:
-                    pass
-            
-            pos += total_len
-        
-        # 组装工具调用
-        for tool_id, tool_data in tool_input_buffer.items():
-            input_str = "".join(tool_data["input_parts"])
-            try:
-                input_json = json.loads(input_str)
-            except:
-                input_json = {"raw": input_str}
-            
-            result["tool_uses"].append({
-                "type": "tool_use",
-                "id": tool_data["id"],
-                "name": tool_data["name"],
-                "input": input_json
-            })
-        
-        if result["tool_uses"]:
-            result["stop_reason"] = "tool_use"
-        
-        return result
+        accumulator = ResponseAccumulator()
+        for event in EventStreamDecoder().feed(raw):
+            accumulator.add(event)
+        return accumulator.to_result()
     
     def parse_response_text(self, raw: bytes) -> str:
         """解析响应，只返回文本内容"""
@@ -29,6 +29,7 @@ import kiro_proxy.core.retry
 import kiro_proxy.core.browser
 import kiro_proxy.core.flow_monitor
 import kiro_proxy.core.usage
+import kiro_proxy.core.http_client
 import kiro_proxy.handlers
 import kiro_proxy.handlers.anthropic
 import kiro_proxy.handlers.openai
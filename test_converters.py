@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""测试协议转换的前缀缓存（不需要启动代理）"""
+
+from kiro_proxy.converters import convert_anthropic_messages_to_kiro, conversion_cache
+
+
+def _conversation(value):
+    return [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": [
+            {"type": "tool_use", "id": "t1", "name": "set", "input": {"p": value}},
+        ]},
+        {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": "t1", "content": "ok"},
+        ]},
+        {"role": "assistant", "content": "done"},
+        {"role": "user", "content": "next"},
+    ]
+
+
+def _tool_input(history):
+    for entry in history:
+        for tool_use in entry.get("assistantResponseMessage", {}).get("toolUses", []):
+            return tool_use["input"]
+
+
+def test_prefix_cache_hash_collisions():
+    """hash() 相同的不同内容不能命中彼此的缓存"""
+    # hash(-1) == hash(-2)，hash(2**61 - 1) == hash(0)，1 / 1.0 / True 相等
+    for first, second in [(-1, -2), (0, 2 ** 61 - 1), (1, 1.0), (1, True)]:
+        conversion_cache.clear()
+        _, history, _ = convert_anthropic_messages_to_kiro(_conversation(first))
+        assert _tool_input(history) == {"p": first}
+        _, history, _ = convert_anthropic_messages_to_kiro(_conversation(second))
+        value = _tool_input(history)["p"]
+        assert value == second and type(value) is type(second), (first, second, value)
+    # -1 / -2 的前缀摘要相同，命中时逐条比较后放弃
+    conversion_cache.clear()
+    collisions = conversion_cache.collisions
+    convert_anthropic_messages_to_kiro(_conversation(-1))
+    convert_anthropic_messages_to_kiro(_conversation(-2))
+    assert conversion_cache.collisions > collisions
+    print("   ✅ 前缀缓存不受 hash() 碰撞影响")
+
+
+def test_prefix_cache_reuse():
+    """相同前缀的下一轮复用缓存"""
+    conversion_cache.clear()
+    messages = _conversation(1)
+    convert_anthropic_messages_to_kiro(messages)
+    hits = conversion_cache.hits
+    convert_anthropic_messages_to_kiro(messages + [
+        {"role": "assistant", "content": "ok"},
+        {"role": "user", "content": "again"},
+    ])
+    assert conversion_cache.hits == hits + 1
+    print("   ✅ 前缀缓存命中")
+
+
+if __name__ == "__main__":
+    print("1. 测试前缀缓存碰撞...")
+    test_prefix_cache_hash_collisions()
+    print("\n2. 测试前缀缓存复用...")
+    test_prefix_cache_reuse()